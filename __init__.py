@@ -0,0 +1,25 @@
+"""
+thePeckingOrder: python side of the labview image acquisition / plane alignment loop
+
+the headless core (zmqComm, filters, planeAlignment, ...) only needs numpy and pyzmq.
+submodules are imported on first access so `import thePeckingOrder` stays cheap,
+and the gui (PyQt5, pyqtgraph, qdarkstyle) is only loaded from thePeckingOrder.gui
+"""
+
+import importlib
+
+_submodules = ('filters', 'instrumentation', 'planeAlignment', 'protocol', 'volumetric', 'zmqComm', 'gui')
+
+__all__ = list(_submodules)
+
+
+def __getattr__(name):
+    if name in _submodules:
+        module = importlib.import_module(f'{__name__}.{name}')
+        globals()[name] = module
+        return module
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_submodules))
@@ -0,0 +1,5 @@
+import sys
+
+from thePeckingOrder.runner import main
+
+sys.exit(main())
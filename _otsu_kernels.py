@@ -0,0 +1,75 @@
+"""
+numba kernels behind backends.otsu_scores_numba
+
+kept out of backends so importing it doesn't import numba, backends imports this on first use
+"""
+
+import numba
+import numpy as np
+
+
+@numba.njit(cache=True, nogil=True)
+def plane_kernel(image, target_mask, edges, inclusive):
+    h, w = image.shape
+    nbins = edges.size - 1
+    first, last = edges[0], edges[-1]
+
+    # all pixels equal: threshold is that value, same as threshold_otsu
+    if first == last:
+        threshold = image[0, 0]
+    else:
+        # histogram, binning exactly like np.histogram with uniform edges
+        counts = np.zeros(nbins)
+        norm = nbins / (last - first)
+        for i in range(h):
+            for j in range(w):
+                x = image[i, j]
+                idx = int((x - first) * norm)
+                if idx == nbins:
+                    idx -= 1
+                if x < edges[idx]:
+                    idx -= 1
+                elif idx != nbins - 1 and x >= edges[idx + 1]:
+                    idx += 1
+                counts[idx] += 1.0
+
+        # otsu on the histogram, same cumulative sums as filters.threshold_otsu
+        centers = (edges[:-1] + edges[1:]) / 2.
+        weight1 = np.cumsum(counts)
+        weight2 = np.cumsum(counts[::-1])[::-1]
+        weighted = counts * centers
+        mean1 = np.cumsum(weighted) / weight1
+        mean2 = (np.cumsum(weighted[::-1]) / weight2[::-1])[::-1]
+
+        best = -1.0
+        best_idx = 0
+        for k in range(nbins - 1):
+            variance = weight1[k] * weight2[k + 1] * (mean1[k] - mean2[k + 1]) ** 2
+            if variance > best:
+                best = variance
+                best_idx = k
+        threshold = centers[best_idx]
+
+    # binarize and intersect in the same pass
+    count = 0
+    intersection = 0
+    for i in range(h):
+        for j in range(w):
+            on = image[i, j] >= threshold if inclusive else image[i, j] > threshold
+            if on:
+                count += 1
+                if target_mask[i, j]:
+                    intersection += 1
+    return threshold, count, intersection
+
+
+@numba.njit(parallel=True, cache=True, nogil=True)
+def stack_kernel(stack, target_mask, edges, inclusive):
+    z = stack.shape[0]
+    thresholds = np.empty(z)
+    counts = np.empty(z, dtype=np.int64)
+    intersections = np.empty(z, dtype=np.int64)
+    for n in numba.prange(z):
+        thresholds[n], counts[n], intersections[n] = plane_kernel(stack[n], target_mask, edges[n], inclusive)
+    return thresholds, counts, intersections
+
@@ -0,0 +1,122 @@
+"""
+adaptive repetition count for stack acquisition
+
+gather_stack and Protocol take a fixed number of frames per plane and median them, enough
+to outvote the noise on a dim sample and far more than a bright one needs. AdaptiveReps
+scores each plane's running median against the target as frames come in and stops the plane
+once the winning plane of the stack so far, and its margin over the runner-up, hold still.
+
+    reps = AdaptiveReps.for_alignment(aligner, target, min_reps=2, max_reps=5)
+    stack = wt.gather_stack(spacing=3, reps=5, adaptive=reps)
+    reps.report()   # frames taken vs the fixed-rep budget
+"""
+
+import logging
+
+import numpy as np
+
+from thePeckingOrder import instrumentation, scratch
+
+
+log = logging.getLogger(__name__)
+
+
+class AdaptiveReps:
+    def __init__(self, score, min_reps=2, max_reps=5, tolerance=0.01, patience=1):
+        """
+        score: image -> similarity to the target, higher is better
+        min_reps: frames before a plane is first scored
+        max_reps: frames a plane never goes past, the fixed-rep count
+        tolerance: largest change in the winner's margin that still counts as stable
+        patience: stable updates in a row before a plane is done
+        """
+        assert(1 <= min_reps <= max_reps), 'need 1 <= min_reps <= max_reps'
+        self.score = score
+        self.min_reps = min_reps
+        self.max_reps = max_reps
+        self.tolerance = tolerance
+        self.patience = patience
+        self.start_stack()
+
+    @classmethod
+    def for_alignment(cls, aligner, target, **kwargs):
+        """scores with a planeAlignment.PlaneAlignment's metric against target (array or target.Target)"""
+        return cls(lambda image: float(aligner.score_stack(target, image)[0]), **kwargs)
+
+    def start_stack(self):
+        self.history = {}  # plane -> score of its running median after each scored frame
+        self.frames_used = {}
+        self.plane = None
+
+    def start_plane(self, plane):
+        self.plane = plane
+        self._frames = []
+        self._decision = None
+        self._stable = 0
+
+    def estimate(self):
+        return scratch.median(self._frames)
+
+    @property
+    def scores(self):
+        """latest score per plane"""
+        return {plane: history[-1] for plane, history in self.history.items()}
+
+    def _score_at(self, plane, n):
+        history = self.history[plane]
+        return history[min(n, len(history) + self.min_reps - 1) - self.min_reps]
+
+    def decision(self):
+        """
+        (winning plane, margin over the runner-up) over the planes scored so far
+        the median of more frames scores higher on its own, so the current plane is compared with
+        each earlier plane at the smaller of their frame counts
+        """
+        n = len(self._frames)
+        scores = {}
+        for plane in self.history:
+            if plane == self.plane:
+                continue
+            count = self.frames_used[plane]
+            scores[plane] = self._score_at(plane, count) - self._score_at(self.plane, min(n, count))
+        scores[self.plane] = 0.0
+        ranked = sorted(scores.items(), key=lambda item: -item[1])
+        best, best_score = ranked[0]
+        return best, best_score - (ranked[1][1] if len(ranked) > 1 else -self.history[self.plane][-1])
+
+    def add(self, frame):
+        """adds one frame of the current plane, True once the plane needs no more"""
+        self._frames.append(frame)
+        n = len(self._frames)
+        if n < self.min_reps:
+            return False
+        self.history.setdefault(self.plane, []).append(self.score(self.estimate()))
+        decision = self.decision()
+        if (self._decision is not None and decision[0] == self._decision[0]
+                and abs(decision[1] - self._decision[1]) <= self.tolerance):
+            self._stable += 1
+        else:
+            self._stable = 0
+        self._decision = decision
+        # never fewer frames than an earlier plane, a noisier median would be judged unfairly
+        enough = n >= max(self.frames_used.values(), default=0)
+        return n >= self.max_reps or (enough and self._stable >= self.patience)
+
+    def finish_plane(self):
+        """the plane's median, from however many frames it took"""
+        if not self._frames:
+            raise RuntimeError(f'no frames for plane {self.plane}')
+        self.frames_used[self.plane] = len(self._frames)
+        return self.estimate()
+
+    def report(self):
+        """frames taken for the stack against max_reps per plane"""
+        used = sum(self.frames_used.values())
+        budget = self.max_reps * len(self.frames_used)
+        return {'frames': used, 'budget': budget, 'saved': budget - used, 'per_plane': dict(self.frames_used)}
+
+    def log_report(self):
+        report = self.report()
+        instrumentation.inc('frames_saved_total', report['saved'])
+        log.info('adaptive reps: %d of %d frames (%s)', report['frames'], report['budget'], report['per_plane'])
+        return report
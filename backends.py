@@ -0,0 +1,127 @@
+"""
+compute backends for the otsu -> binarize -> intersect hot path
+
+'numpy' is the reference: filters.threshold_otsu per plane then a compare and count,
+several full passes with temporaries in between.
+'numba' (optional, pip install numba) fuses the histogram, otsu, binarize and
+intersection count into one kernel per plane and runs the planes in parallel.
+
+    backends.set_backend('numba')     # raises if numba is missing or disagrees with numpy
+    backends.set_backend('auto')      # numba when importable, numpy otherwise
+
+PECKINGORDER_BACKEND in the environment picks the backend the same way, when it is first needed.
+"""
+
+import importlib.util
+import logging
+import os
+import threading as tr
+
+import numpy as np
+
+from thePeckingOrder.filters import threshold_otsu
+
+
+# numba costs ~250 ms to import, the kernels (_otsu_kernels) are only imported once the numba
+# backend is used, and PECKINGORDER_BACKEND is applied on first use rather than at import
+HAVE_NUMBA = importlib.util.find_spec('numba') is not None
+
+
+log = logging.getLogger(__name__)
+
+NBINS = 256
+
+
+def otsu_scores_numpy(target_mask, stack, inclusive=False):
+    """
+    reference: per plane otsu threshold, binarize, count and intersect with target_mask
+    returns (thresholds, plane counts, intersections), each (Z,)
+    """
+    compare = np.greater_equal if inclusive else np.greater
+    z = len(stack)
+    thresholds = np.empty(z)
+    counts = np.empty(z, dtype=np.int64)
+    intersections = np.empty(z, dtype=np.int64)
+    for n, image in enumerate(stack):
+        thresholds[n] = threshold_otsu(image)
+        binary = compare(image, thresholds[n])
+        counts[n] = np.count_nonzero(binary)
+        intersections[n] = np.count_nonzero(binary & target_mask)
+    return thresholds, counts, intersections
+
+
+def otsu_scores_numba(target_mask, stack, inclusive=False):
+    """fused kernel, same outputs as otsu_scores_numpy"""
+    stack = np.asarray(stack)
+    if stack.dtype != np.float64:
+        # integer images get a per-value bincount histogram in threshold_otsu and float32 bins
+        # round differently, the medians alignment runs on are float64 anyway
+        return otsu_scores_numpy(target_mask, stack, inclusive)
+    # bin edges come from numpy so they are bit-identical to np.histogram's
+    lo = stack.min(axis=(1, 2))
+    hi = stack.max(axis=(1, 2))
+    edges = np.array([np.linspace(a, b, NBINS + 1) for a, b in zip(lo, hi)])
+    from thePeckingOrder._otsu_kernels import stack_kernel
+    return stack_kernel(stack, np.asarray(target_mask, dtype=np.bool_), edges, inclusive)
+
+
+BACKENDS = {'numpy': otsu_scores_numpy}
+if HAVE_NUMBA:
+    BACKENDS['numba'] = otsu_scores_numba
+
+# None until the first get_backend/otsu_scores/set_backend
+_active = None
+_active_lock = tr.Lock()
+
+
+def available():
+    return list(BACKENDS)
+
+
+def check_equivalence(backend, shape=(128, 120), n_planes=5, seed=0):
+    """runs backend and the numpy reference on random stacks, True when they agree"""
+    rng = np.random.default_rng(seed)
+    fxn = BACKENDS[backend]
+    for inclusive in (False, True):
+        stack = rng.gamma(2.0, 300.0, size=(n_planes,) + shape)
+        stack[0] = 7.0  # flat plane
+        target_mask = rng.random(shape) > 0.5
+        ref = otsu_scores_numpy(target_mask, stack, inclusive)
+        out = fxn(target_mask, stack, inclusive)
+        if not (np.allclose(ref[0], out[0]) and np.array_equal(ref[1], out[1]) and np.array_equal(ref[2], out[2])):
+            return False
+    return True
+
+
+def set_backend(name, verify=True):
+    """
+    'numpy', 'numba' or 'auto'. with verify the backend is checked against numpy first
+    """
+    global _active
+    if name == 'auto':
+        name = 'numba' if 'numba' in BACKENDS else 'numpy'
+    if name not in BACKENDS:
+        raise ValueError(f'backend {name!r} not available, have {available()}')
+    if verify and name != 'numpy' and not check_equivalence(name):
+        raise RuntimeError(f'backend {name!r} does not match the numpy reference')
+    _active = name
+    log.info('using %s backend', name)
+
+
+def get_backend():
+    """the active backend, on the first call the one PECKINGORDER_BACKEND picks (numpy without it)"""
+    global _active
+    if _active is None:
+        with _active_lock:
+            if _active is None:
+                name = os.environ.get('PECKINGORDER_BACKEND')
+                if name:
+                    set_backend(name)
+                else:
+                    _active = 'numpy'
+    return _active
+
+
+def otsu_scores(target_mask, stack, inclusive=False):
+    """(thresholds, counts, intersections) for stack against target_mask with the active backend"""
+    return BACKENDS[get_backend()](target_mask, stack, inclusive)
@@ -0,0 +1,870 @@
+"""
+benchmarks for the hot paths
+
+run from the folder that contains thePeckingOrder:
+    python -m thePeckingOrder.benchmarks importtime
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+PACKAGE_PARENT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENTRY_POINTS = {'package': 'thePeckingOrder',
+                'zmqComm': 'thePeckingOrder.zmqComm',
+                'planeAlignment': 'thePeckingOrder.planeAlignment',
+                'volumetric': 'thePeckingOrder.volumetric',
+                'protocol': 'thePeckingOrder.protocol',
+                'gui': 'thePeckingOrder.gui.alignment_gui'}
+
+
+def _parse_importtime(stderr):
+    """returns {module: (self_us, cumulative_us)} from `python -X importtime` output"""
+    timings = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        timings[name.strip()] = (int(self_us), int(cumulative_us))
+    return timings
+
+
+def importtime(modules=None, repeats=5, top=5):
+    """
+    imports each entry point in a fresh interpreter under -X importtime
+    returns {entry: {'cumulative_us': best of repeats, 'heaviest': [(module, cumulative_us), ...]}}
+    entries that fail to import (missing gui extras etc.) report the error instead
+    """
+    modules = modules or ENTRY_POINTS
+    env = dict(os.environ, PYTHONPATH=PACKAGE_PARENT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+
+    results = {}
+    for entry, module in modules.items():
+        best = None
+        for _ in range(repeats):
+            proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                                  capture_output=True, text=True, env=env, cwd=PACKAGE_PARENT)
+            if proc.returncode != 0:
+                best = {'error': proc.stderr.strip().splitlines()[-1]}
+                break
+            timings = _parse_importtime(proc.stderr)
+            total = timings[module][1]
+            if best is None or total < best['cumulative_us']:
+                # top-level modules only, so numpy doesn't show up as 40 numpy.* lines
+                roots = [(name, cum) for name, (_, cum) in timings.items()
+                         if '.' not in name.strip() or name.startswith('thePeckingOrder')]
+                heaviest = sorted(roots, key=lambda x: -x[1])[1:top + 1]
+                best = {'cumulative_us': total, 'heaviest': heaviest}
+        results[entry] = best
+    return results
+
+
+def _print_importtime(args):
+    results = importtime(repeats=args.repeats)
+    for entry, res in results.items():
+        if 'error' in res:
+            print(f'{entry:>16}: unavailable ({res["error"]})')
+            continue
+        print(f'{entry:>16}: {res["cumulative_us"] / 1000:8.1f} ms')
+        for name, cum in res['heaviest']:
+            print(f'{"":>18}{name:<40}{cum / 1000:8.1f} ms')
+
+
+def synthetic_volume(shape=(512, 480), n_planes=21, seed=0, noise=0.3):
+    """
+    smooth random 'tissue' volume (Z, H, W) plus a noisy copy of its middle plane as target
+    neighbouring planes share structure, so similarity falls off with distance from the middle
+    """
+    rng = np.random.default_rng(seed)
+    h, w = shape
+    # pad in z so the fft wrap-around doesn't make the end planes look alike
+    depth = n_planes + 16
+    field = rng.standard_normal((depth, h, w))
+    kz, ky, kx = np.meshgrid(np.fft.fftfreq(depth), np.fft.fftfreq(h), np.fft.rfftfreq(w), indexing='ij')
+    blur = np.exp(-((kz / 0.08) ** 2 + (ky / 0.03) ** 2 + (kx / 0.03) ** 2))
+    volume = np.fft.irfftn(np.fft.rfftn(field) * blur, s=field.shape)[8:8 + n_planes]
+    volume = (volume - volume.min()) / (volume.max() - volume.min()) * 4000 + 100
+    target = volume[n_planes // 2] + rng.normal(scale=noise * volume.std(), size=shape)
+    stack = volume + rng.normal(scale=noise * volume.std(), size=volume.shape)
+    return target, stack
+
+
+def _best_of(fxn, repeats):
+    best = np.inf
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        out = fxn()
+        best = min(best, time.perf_counter() - t0)
+    return best, out
+
+
+def similarity_metrics(shape=(512, 480), n_planes=(5, 21), repeats=5):
+    """
+    cost of each metric on one stack, with and without binarization, and whether it picks the right plane
+    returns [(metric, n_planes, total_s, metric_only_s, picked_correct), ...]
+    """
+    from thePeckingOrder import metrics
+    from thePeckingOrder.planeAlignment import PlaneAlignment
+
+    rows = []
+    for z in n_planes:
+        target, stack = synthetic_volume(shape, z)
+        for name, (fxn, binary) in metrics.METRICS.items():
+            pa = PlaneAlignment(target, stack, method='otsu', metric=name)
+            total, best_plane = _best_of(pa.match_calculator, repeats)
+            if binary:
+                t_in = target > pa.binarize_method(target)
+                s_in = np.array([p > pa.binarize_method(p) for p in stack])
+            else:
+                t_in, s_in = target, stack
+            metric_only, _ = _best_of(lambda: fxn(t_in, s_in), repeats)
+            rows.append((name, z, total, metric_only, best_plane == z // 2))
+    return rows
+
+
+def _print_similarity_metrics(args):
+    rows = similarity_metrics(shape=tuple(args.shape), n_planes=args.planes, repeats=args.repeats)
+    print(f'{"metric":>12} {"planes":>6} {"total ms":>10} {"metric ms":>10} {"correct":>8}')
+    for name, z, total, metric_only, correct in rows:
+        print(f'{name:>12} {z:>6} {total * 1000:>10.2f} {metric_only * 1000:>10.2f} {str(correct):>8}')
+
+
+def packed_masks(shape=(2048, 2048), n_planes=5, repeats=5):
+    """memory and dice cost of bool masks vs PackedMask at full frame size"""
+    from thePeckingOrder import masks, metrics
+
+    rng = np.random.default_rng(0)
+    stack = rng.random((n_planes,) + shape) > 0.5
+    target = stack[n_planes // 2].copy()
+    packed_stack = masks.PackedMask.from_bool(stack)
+    packed_target = masks.PackedMask.from_bool(target)
+
+    bool_s, _ = _best_of(lambda: metrics.dice(target, stack), repeats)
+    # fresh target object each call so the cached popcount doesn't flatter the packed path
+    packed_s, _ = _best_of(lambda: masks.PackedMask(packed_target.words, shape).dice(packed_stack), repeats)
+    return {'bool_bytes': stack.nbytes, 'packed_bytes': packed_stack.nbytes,
+            'bool_dice_s': bool_s, 'packed_dice_s': packed_s}
+
+
+def _print_packed_masks(args):
+    res = packed_masks(shape=tuple(args.shape), n_planes=args.planes, repeats=args.repeats)
+    print(f'mask memory: bool {res["bool_bytes"] / 1e6:.1f} MB, packed {res["packed_bytes"] / 1e6:.1f} MB')
+    print(f'dice per stack: bool {res["bool_dice_s"] * 1000:.2f} ms, packed {res["packed_dice_s"] * 1000:.2f} ms')
+
+
+def roi_scaling(shape=(1024, 1024), n_planes=5, fractions=(1.0, 0.5, 0.25, 0.1), repeats=5):
+    """alignment time for centred square rois covering a fraction of the frame"""
+    from thePeckingOrder.planeAlignment import PlaneAlignment
+    from thePeckingOrder.roi import ROI
+
+    target, stack = synthetic_volume(shape, n_planes)
+    rows = []
+    for frac in fractions:
+        side_h, side_w = int(shape[0] * frac ** 0.5), int(shape[1] * frac ** 0.5)
+        r0, c0 = (shape[0] - side_h) // 2, (shape[1] - side_w) // 2
+        region = ROI((r0, r0 + side_h), (c0, c0 + side_w))
+        pa = PlaneAlignment(target, stack, method='otsu', roi=region)
+        seconds, best = _best_of(pa.match_calculator, repeats)
+        rows.append((frac, seconds, best))
+    return rows
+
+
+def _print_roi_scaling(args):
+    print(f'{"area":>6} {"ms":>10} {"plane":>6}')
+    for frac, seconds, best in roi_scaling(shape=tuple(args.shape), n_planes=args.planes, repeats=args.repeats):
+        print(f'{frac:>6.2f} {seconds * 1000:>10.2f} {best:>6}')
+
+
+def move_plans(n_planes=(5, 7, 21)):
+    """
+    simulated seconds per alignment, old visit-return-correct path vs the planned folded path
+    averaged over every possible correction
+    """
+    from thePeckingOrder.planner import LEGACY_ORDER, MovePlanner, Plan
+
+    planner = MovePlanner()
+    sim = planner.simulator
+    rows = []
+    for n in n_planes:
+        offsets = planner.stack_offsets(n)
+        legacy = Plan(LEGACY_ORDER) if n == 5 else next(planner.candidates(offsets))
+        planned = planner.plan(offsets)
+        old = np.mean([sim.score(legacy, c, folded=False) for c in offsets])
+        new = np.mean([sim.score(planned, c, folded=True) for c in offsets])
+        rows.append((n, planned.order, old, new))
+    return rows
+
+
+def _print_move_plans(args):
+    for n, order, old, new in move_plans(args.planes):
+        print(f'{n:>3} planes: legacy {old:6.1f}s  planned {new:6.1f}s  order {order}')
+
+
+def compute_backends(shape=(512, 480), n_planes=(5, 21), repeats=5):
+    """fused otsu/binarize/intersect per available backend, returns [(backend, planes, seconds, matches numpy)]"""
+    from thePeckingOrder import backends
+
+    rows = []
+    for z in n_planes:
+        target, stack = synthetic_volume(shape, z)
+        target_mask = target > backends.threshold_otsu(target)
+        reference = backends.otsu_scores_numpy(target_mask, stack)
+        for name, fxn in backends.BACKENDS.items():
+            fxn(target_mask, stack)  # warm up / jit
+            seconds, out = _best_of(lambda: fxn(target_mask, stack), repeats)
+            same = np.array_equal(out[1], reference[1]) and np.array_equal(out[2], reference[2])
+            rows.append((name, z, seconds, same))
+    return rows
+
+
+def _print_compute_backends(args):
+    for name, z, seconds, same in compute_backends(tuple(args.shape), args.planes, args.repeats):
+        print(f'{name:>8} {z:>3} planes: {seconds * 1000:8.2f} ms  matches numpy: {same}')
+
+
+def worker_scaling(shape=(512, 480), n_planes=(5, 11, 21), max_workers=None, metric='dice_packed', repeats=5):
+    """match_calculator time with 1..max_workers threads, returns [(planes, workers, seconds)]"""
+    from thePeckingOrder.planeAlignment import PlaneAlignment
+
+    max_workers = max_workers or os.cpu_count() or 1
+    rows = []
+    for z in n_planes:
+        target, stack = synthetic_volume(shape, z)
+        for n in range(1, max_workers + 1):
+            pa = PlaneAlignment(target, stack, method='otsu', metric=metric, workers=n)
+            pa.match_calculator()  # pool start-up is a one-off, keep it out of the timing
+            seconds, _ = _best_of(pa.match_calculator, repeats)
+            rows.append((z, n, seconds))
+    return rows
+
+
+def _print_worker_scaling(args):
+    rows = worker_scaling(tuple(args.shape), args.planes, args.max_workers, args.metric, args.repeats)
+    serial = {z: seconds for z, n, seconds in rows if n == 1}
+    for z, n, seconds in rows:
+        print(f'{z:>3} planes {n:>3} workers: {seconds * 1000:8.2f} ms  x{serial[z] / seconds:4.2f}')
+
+
+def frame_decoding(shape=(512, 512), max_value=65535, fuzz_cases=500, repeats=10):
+    """
+    legacy json.loads path vs frames.ArrayDecoder per backend on one labview-style payload,
+    cropped like WalkyTalky does. returns [(decoder, seconds, speedup, fuzz ok)]
+    """
+    import json
+
+    from thePeckingOrder import frames
+    from thePeckingOrder.roi import LABVIEW_CROP
+
+    rng = np.random.default_rng(0)
+    payload = json.dumps(rng.integers(0, max_value + 1, size=shape).tolist(), separators=(',', ':')).encode()
+    reference, expected = _best_of(lambda: frames.decode_json(payload, LABVIEW_CROP), repeats)
+
+    rows = [('json', reference, 1.0, True)]
+    for backend in frames.available():
+        decoder = frames.ArrayDecoder(backend)
+        decoder(payload, LABVIEW_CROP)  # warm up / jit
+        seconds, out = _best_of(lambda: decoder(payload, LABVIEW_CROP), repeats)
+        same = np.array_equal(out, expected) and frames.check_equivalence(decoder, fuzz_cases)
+        rows.append((backend, seconds, reference / seconds, same))
+    return rows
+
+
+def _print_frame_decoding(args):
+    for name, seconds, speedup, same in frame_decoding(tuple(args.shape), args.max_value, args.fuzz, args.repeats):
+        target = '' if name == 'json' else ('  10x target met' if speedup >= 10 else '  short of the 10x target')
+        print(f'{name:>6}: {seconds * 1000:8.2f} ms  x{speedup:5.1f}  matches json: {same}{target}')
+
+
+def _frame_sequence(shape, n_frames, noise, seed=0):
+    """uint16 frames of one plane with fresh noise each, what a still fish looks like to the scope"""
+    rng = np.random.default_rng(seed)
+    base = synthetic_volume(shape, n_planes=1, seed=seed, noise=0)[0]
+    sequence = base + rng.normal(scale=noise * base.std(), size=(n_frames,) + tuple(shape))
+    return np.clip(sequence, 0, 65535).astype(np.uint16)
+
+
+def frame_transport(shape=(512, 512), n_frames=50, noise=0.05, encodings=None, keyframe_interval=10,
+                    link_bytes_per_s=125e6, port=5599):
+    """
+    each frames.encodings() entry on a sequence of frames: bytes per frame, encode and decode ms,
+    frames/s end to end through a local PUB/SUB pair (encode, send, receive, decode) and the frame
+    rate a link_bytes_per_s link (1 GbE by default) would cap it at
+    returns [(encoding, bytes_per_frame, encode_s, decode_s, e2e_fps, link_fps, lossless)]
+    """
+    import threading
+
+    import zmq
+
+    from thePeckingOrder import frames, replay, zmqComm
+    from thePeckingOrder.roi import ROI
+
+    sequence = _frame_sequence(shape, n_frames, noise)
+    rows = []
+    for encoding in encodings or frames.encodings():
+        encoder = frames.FrameEncoder(encoding, keyframe_interval)
+        t0 = time.perf_counter()
+        messages = [replay.encode_frame(image, 'frame', seq, encoder=encoder) for seq, image in enumerate(sequence)]
+        encode_s = (time.perf_counter() - t0) / n_frames
+
+        decoder = frames.FrameDecoder()
+        t0 = time.perf_counter()
+        decoded = [zmqComm.decode_frame(message, ROI(), decoder)[3] for message in messages]
+        decode_s = (time.perf_counter() - t0) / n_frames
+        lossless = all(np.array_equal(a, b) for a, b in zip(decoded, sequence))
+
+        context = zmq.Context()
+        pub = context.socket(zmq.PUB)
+        pub.setsockopt(zmq.SNDHWM, 0)
+        pub.bind(f'tcp://127.0.0.1:{port}')
+        sub = context.socket(zmq.SUB)
+        sub.setsockopt(zmq.RCVHWM, 0)
+        sub.setsockopt(zmq.SUBSCRIBE, b'')
+        sub.connect(f'tcp://127.0.0.1:{port}')
+        time.sleep(0.3)  # slow joiner
+
+        def publish():
+            sender = frames.FrameEncoder(encoding, keyframe_interval)
+            for seq, image in enumerate(sequence):
+                pub.send(replay.encode_frame(image, 'frame', seq, encoder=sender))
+
+        receiver = frames.FrameDecoder()
+        t0 = time.perf_counter()
+        thread = threading.Thread(target=publish)
+        thread.start()
+        for _ in range(n_frames):
+            zmqComm.decode_frame(sub.recv(), ROI(), receiver)
+        e2e_fps = n_frames / (time.perf_counter() - t0)
+        thread.join()
+        pub.close()
+        sub.close()
+        context.term()
+
+        bytes_per_frame = sum(len(message) for message in messages) / n_frames
+        rows.append((encoding, bytes_per_frame, encode_s, decode_s, e2e_fps, link_bytes_per_s / bytes_per_frame,
+                     lossless))
+    return rows
+
+
+def _print_frame_transport(args):
+    rows = frame_transport(tuple(args.shape), args.frames, args.noise, args.encodings, args.keyframe_interval,
+                           args.link_mbit * 1e6 / 8)
+    json_bytes = rows[0][1]
+    for encoding, size, encode_s, decode_s, e2e_fps, link_fps, lossless in rows:
+        print(f'{encoding:>11}: {size / 1024:8.1f} KiB/frame  x{json_bytes / size:5.1f}  '
+              f'encode {encode_s * 1000:6.2f} ms  decode {decode_s * 1000:6.2f} ms  '
+              f'end to end {e2e_fps:6.1f} fps  link cap {link_fps:7.1f} fps  lossless: {lossless}')
+
+
+def adaptive_repetitions(shape=(256, 256), stack_size=5, max_reps=5, frame_noise=(0.5, 2.0), trials=20,
+                         min_reps=2, tolerance=0.01, metric='dice_packed'):
+    """
+    simulated stack acquisitions, each plane's frames a volume plane plus fresh noise, scored against
+    a max_reps-frame target of a random plane: fixed 1..max_reps reps vs adaptive.AdaptiveReps
+    returns [(frame_noise, mode, frames per alignment, fraction of alignments on the right plane)]
+    """
+    from thePeckingOrder.adaptive import AdaptiveReps
+    from thePeckingOrder.planeAlignment import PlaneAlignment
+    from thePeckingOrder.target import Target
+
+    rows = []
+    for noise in frame_noise:
+        rng = np.random.default_rng(0)
+        _, volume = synthetic_volume(shape, n_planes=stack_size + 4, seed=1, noise=0)
+        scale = noise * volume.std()
+        fixed = {reps: [0, 0] for reps in range(1, max_reps + 1)}
+        adaptive = [0, 0]
+        for _ in range(trials):
+            truth = int(rng.integers(stack_size))
+            planes = volume[2:2 + stack_size]
+            target = Target(np.median(planes[truth] + rng.normal(scale=scale, size=(max_reps,) + shape), axis=0))
+            frames = planes[:, None] + rng.normal(scale=scale, size=(stack_size, max_reps) + shape)
+            aligner = PlaneAlignment(target, None, 'otsu', metric)
+
+            for reps in fixed:
+                aligner.image_stack = np.median(frames[:, :reps], axis=1)
+                fixed[reps][0] += reps * stack_size
+                fixed[reps][1] += aligner.match_calculator() == truth
+
+            control = AdaptiveReps.for_alignment(aligner, target, min_reps=min_reps, max_reps=max_reps,
+                                                 tolerance=tolerance)
+            stack = []
+            for plane in range(stack_size):
+                control.start_plane(plane)
+                for frame in frames[plane]:
+                    if control.add(frame):
+                        break
+                stack.append(control.finish_plane())
+            aligner.image_stack = stack
+            adaptive[0] += control.report()['frames']
+            adaptive[1] += aligner.match_calculator() == truth
+
+        for reps, (frames_taken, correct) in fixed.items():
+            rows.append((noise, f'fixed {reps}', frames_taken / trials, correct / trials))
+        rows.append((noise, 'adaptive', adaptive[0] / trials, adaptive[1] / trials))
+    return rows
+
+
+def _print_adaptive_repetitions(args):
+    rows = adaptive_repetitions(tuple(args.shape), args.stack_size, args.max_reps, args.noise, args.trials,
+                                args.min_reps, args.tolerance, args.metric)
+    for noise, mode, frames_taken, accuracy in rows:
+        print(f'noise {noise:4.2f} {mode:>9}: {frames_taken:5.1f} frames/alignment  {accuracy * 100:5.1f}% right plane')
+
+
+def frame_quality(shape=(512, 512), n_frames=200, corrupt=0.1, reps=5, policy='default', noise=0.05, repeats=5):
+    """
+    quality.FrameQuality on a uint16 frame sequence with a fraction of blank, saturated and shifted
+    (motion) frames mixed in: assess cost per frame, which frames each check caught and how far a
+    reps-frame median lands from the clean plane with and without rejection
+    returns {'assess_s', 'caught': {kind: (caught, total)}, 'false_rejections', 'median_error': (kept all, rejected)}
+    """
+    from thePeckingOrder import quality
+
+    rng = np.random.default_rng(0)
+    sequence = _frame_sequence(shape, n_frames, noise)
+    clean = np.median(sequence, axis=0)
+    kinds = np.where(rng.random(n_frames) < corrupt, rng.integers(1, 4, n_frames), 0)
+    names = {0: '', 1: 'blank', 2: 'saturated', 3: 'motion'}
+    for n in np.flatnonzero(kinds):
+        if kinds[n] == 1:
+            sequence[n] = sequence[n] // 20
+        elif kinds[n] == 2:
+            sequence[n] = np.minimum(sequence[n].astype(np.uint32) * 40, 65535)
+        else:
+            sequence[n] = np.roll(sequence[n], (int(rng.integers(8, 20)), int(rng.integers(8, 20))), axis=(0, 1))
+
+    checker = quality.FrameQuality(policy)
+    stats = [checker.assess(image) for image in sequence]
+    assess_s, _ = _best_of(lambda: quality.FrameQuality(policy).assess(sequence[1]), repeats)
+
+    caught = {name: (sum(1 for k, s in zip(kinds, stats) if k == kind and s.rejected),
+                     int(np.count_nonzero(kinds == kind))) for kind, name in names.items() if kind}
+    false_rejections = sum(1 for k, s in zip(kinds, stats) if k == 0 and s.rejected)
+
+    errors = [[], []]
+    for start in range(0, n_frames - reps, reps):
+        images = list(sequence[start:start + reps])
+        kept = quality.accepted(images, stats[start:start + reps]) or images
+        for n, batch in enumerate((images, kept)):
+            errors[n].append(np.abs(np.median(batch, axis=0) - clean).mean() / clean.mean())
+    return {'assess_s': assess_s, 'caught': caught, 'false_rejections': false_rejections,
+            'median_error': (float(np.mean(errors[0])), float(np.mean(errors[1])))}
+
+
+def _print_frame_quality(args):
+    result = frame_quality(tuple(args.shape), args.frames, args.corrupt, args.reps, args.policy)
+    print(f'assess: {result["assess_s"] * 1e6:8.1f} us/frame')
+    for name, (caught, total) in result['caught'].items():
+        print(f'{name:>10}: {caught} of {total} rejected')
+    print(f'{"clean":>10}: {result["false_rejections"]} rejected')
+    kept_all, rejected = result['median_error']
+    print(f'{args.reps}-frame median error vs clean plane: {kept_all:.4f} keeping everything, {rejected:.4f} with rejection')
+
+
+def tilted_target(volume, slope, seed=0, noise=0.1):
+    """target cut through volume at a slant: the plane index rises by slope per column across the frame"""
+    rng = np.random.default_rng(seed)
+    z, h, w = volume.shape
+    cols = np.arange(w)
+    depth = np.clip((z - 1) / 2 + slope * (cols - w / 2), 0, z - 1.001)
+    lower = np.floor(depth).astype(int)
+    fraction = depth - lower
+    target = volume[lower, :, cols].T * (1 - fraction) + volume[lower + 1, :, cols].T * fraction
+    return target + rng.normal(scale=noise * volume.std(), size=target.shape)
+
+
+def local_z_estimation(shape=(512, 512), n_planes=21, grid=(4, 4), slopes=(0.0, 0.005, 0.01),
+                       metrics=('dice_packed', 'ncc'), max_workers=None, repeats=3):
+    """
+    PlaneAlignment.local_z on stacks against a tilted target: fitted vs true tilt (planes per column),
+    global plane from the tile fit and from match_calculator, and the cost of both
+    returns [(metric, slope, fitted_slope, tiled_plane, full_frame_plane, tiled_s, full_frame_s, workers)]
+    """
+    from thePeckingOrder.planeAlignment import PlaneAlignment
+    from thePeckingOrder.target import Target
+
+    max_workers = int(max_workers or os.cpu_count() or 1)
+    _, volume = synthetic_volume(shape, n_planes, seed=0, noise=0)
+    stack = volume + np.random.default_rng(1).normal(scale=0.1 * volume.std(), size=volume.shape)
+    rows = []
+    for metric in metrics:
+        for slope in slopes:
+            for n in sorted({1, max_workers}):
+                pa = PlaneAlignment(Target(tilted_target(volume, slope)), stack, 'otsu', metric=metric, workers=n)
+                tiled_s, result = _best_of(lambda: pa.local_z(grid), repeats)
+                full_s, plane = _best_of(pa.match_calculator, repeats)
+                rows.append((metric, slope, result.tilt[1], result.plane, plane, tiled_s, full_s, n))
+    return rows
+
+
+def _print_local_z_estimation(args):
+    rows = local_z_estimation(tuple(args.shape), args.planes, tuple(args.grid), args.slopes, args.metrics,
+                              args.max_workers, args.repeats)
+    for metric, slope, fitted, tiled, full, tiled_s, full_s, n in rows:
+        print(f'{metric:>11} slope {slope:.4f} fitted {fitted:.4f}  plane {tiled:>2} (full frame {full:>2})  '
+              f'tiled {tiled_s * 1000:7.1f} ms  full frame {full_s * 1000:7.1f} ms  {n} workers')
+
+
+def pstim_channel(n_requests=50, delay=0.0, timeout=0.5, ports=(5625, 5626)):
+    """
+    pstim.PstimChannel against a local pstim.StandInPstim: round trips, the absent-pstim fallback
+    time and message size against the old pickled strings
+    returns {'compact': latency dict, 'legacy': latency dict, 'absent_s', 'bytes': (compact, pickled)}
+    """
+    import pickle
+
+    from thePeckingOrder import pstim
+
+    results = {}
+    for legacy in (False, True):
+        stand_in = pstim.StandInPstim(*ports, delay=delay, legacy=legacy)
+        channel = pstim.PstimChannel(*ports, timeout=timeout, legacy=legacy)
+        time.sleep(0.5)  # slow joiner, both ways
+        for _ in range(n_requests):
+            channel.wait(channel.request('pause'))
+        results['legacy' if legacy else 'compact'] = channel.latency()
+        channel.close()
+        stand_in.stop()
+
+    channel = pstim.PstimChannel(*ports, timeout=timeout)
+    t0 = time.perf_counter()
+    channel.wait(channel.request('pause'))
+    results['absent_s'] = time.perf_counter() - t0
+    channel.close()
+
+    results['bytes'] = (len(pstim.encode_msg('pause', n_requests)), len(pickle.dumps('pause')))
+    return results
+
+
+def _print_pstim_channel(args):
+    results = pstim_channel(args.requests, args.delay, args.timeout)
+    for name in ('compact', 'legacy'):
+        latency = results[name]
+        print(f'{name:>8}: {latency["count"]} round trips, median {latency["median"] * 1000:.2f} ms  '
+              f'p95 {latency["p95"] * 1000:.2f} ms  max {latency["max"] * 1000:.2f} ms')
+    print(f'no pstim: gave up after {results["absent_s"]:.2f} s (timeout {args.timeout} s)')
+    print(f'pause request: {results["bytes"][0]} bytes, pickled {results["bytes"][1]} bytes')
+
+
+def _rss_mb():
+    """resident memory of this process, the peak where /proc isn't there"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def _stand_in_rigs(ports, shape, fps, encoding, stop):
+    """labview stand-ins for multi_rig_scaling, run in a process of their own so they don't count against it"""
+    from thePeckingOrder import replay
+
+    frames = _frame_sequence(shape, 20, 0.05)
+    publishers = [replay.ReplayPublisher(frames, port, fps=fps, encoding=encoding) for port in ports]
+    stop.wait()
+    for publisher in publishers:
+        publisher.stop()
+
+
+def _measure_rigs(ports, shape, duration, align_every, compute_slots, workers, results):
+    """one multi_rig_scaling row, in a fresh process so memory isn't carried over from the last rig count"""
+    import threading
+
+    from thePeckingOrder import planeAlignment, rigs
+    from thePeckingOrder.roi import LABVIEW_CROP
+
+    # the rigs receive frames through the labview crop
+    target = LABVIEW_CROP.apply(_frame_sequence(shape, 1, 0.05)[0])
+    rss0 = _rss_mb()
+    controller = rigs.RigController(compute_slots=compute_slots, workers=workers)
+    for i, (port, command_port) in enumerate(ports):
+        controller.add_walky_talky(f'rig{i}', command_port, 'tcp://127.0.0.1:', port)
+    deadline = time.perf_counter() + 30
+    while time.perf_counter() < deadline and not all(rig.wt.images for rig in controller.rigs.values()):
+        time.sleep(0.1)
+
+    done = threading.Event()
+
+    def align(rig, offset):
+        aligner = planeAlignment.PlaneAlignment(target, None, 'otsu', workers=workers)
+        done.wait(offset)
+        while not done.wait(align_every):
+            stack = rig.wt.accepted_images()[-5:]
+            try:
+                rig.wt.make_current()
+            except IndexError:
+                pass
+            if stack:
+                with controller.scheduler.slot(rig.metrics):
+                    aligner.score_stack(target, np.asarray(stack))
+
+    received = sum(rig.status()['received'] for rig in controller.rigs.values())
+    cpu, t0 = time.process_time(), time.perf_counter()
+    # staggered like RigController.spread_alignments
+    threads = [threading.Thread(target=align, args=(rig, i * align_every / len(ports)))
+               for i, rig in enumerate(controller.rigs.values())]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    done.set()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - t0
+    cpu = time.process_time() - cpu
+    status = controller.status()
+    results.put({'rigs': len(ports), 'cpu': cpu / wall, 'rss_mb': _rss_mb(), 'growth_mb': _rss_mb() - rss0,
+                 'threads': threading.active_count(),
+                 'fps': (sum(status[name]['received'] for name in controller.rigs) - received) / wall,
+                 'dropped': sum(status[name]['dropped'] for name in controller.rigs),
+                 'wait': status['compute']['max_wait']})
+    controller.stop()
+
+
+def multi_rig_scaling(n_rigs=(1, 2, 4, 8), duration=10.0, shape=(256, 256), fps=10.0, encoding='json',
+                      align_every=2.0, compute_slots=1, workers='auto', base_port=5700):
+    """
+    rigs.RigController with n comms-only rigs on local stand-in publishers (another process), each
+    rig scoring a 5-frame stack against a target every align_every seconds through the controller's
+    scheduler. every rig count is measured in a fresh process
+    returns one row per n: cpu (cores busy), rss_mb (the process), growth_mb (over the process before
+    the rigs), threads (python), fps (frames received per second, all rigs), dropped, wait (longest
+    compute wait, s)
+    """
+    import multiprocessing
+
+    spawn = multiprocessing.get_context('spawn')
+    rows = []
+    for n in n_rigs:
+        ports = [(base_port + 2 * i, base_port + 2 * i + 1) for i in range(n)]
+        stop, results = spawn.Event(), spawn.Queue()
+        stand_ins = spawn.Process(target=_stand_in_rigs, args=([port for port, _ in ports], shape, fps, encoding, stop),
+                                  daemon=True)
+        stand_ins.start()
+        measure = spawn.Process(target=_measure_rigs,
+                                args=(ports, shape, duration, align_every, compute_slots, workers, results))
+        measure.start()
+        rows.append(results.get())
+        measure.join()
+        stop.set()
+        stand_ins.join()
+    return rows
+
+
+def _print_multi_rig_scaling(args):
+    rows = multi_rig_scaling(args.rigs, args.duration, (args.size, args.size), args.fps, args.encoding,
+                             args.align_every, args.slots, args.workers)
+    print(f'{args.size}x{args.size} {args.encoding} frames at {args.fps:g} fps per rig, a stack scored every '
+          f'{args.align_every:g} s per rig, {args.slots} compute slot(s)')
+    print(f'{"rigs":>5} {"cpu":>6} {"cpu/rig":>8} {"rss MB":>7} {"growth":>7} {"MB/rig":>7} {"threads":>8} '
+          f'{"frames/s":>9} {"dropped":>8} {"max wait":>9}')
+    for row in rows:
+        print(f'{row["rigs"]:>5} {row["cpu"]:>6.2f} {row["cpu"] / row["rigs"]:>8.3f} {row["rss_mb"]:>7.1f} '
+              f'{row["growth_mb"]:>7.1f} {row["growth_mb"] / row["rigs"]:>7.2f} {row["threads"]:>8} '
+              f'{row["fps"]:>9.1f} {row["dropped"]:>8} {row["wait"] * 1000:>7.1f}ms')
+
+
+def steady_state_allocations(shape=(512, 512), n_planes=5, reps=5, alignments=20, warmup=3, metric='dice_packed',
+                             workers=None):
+    """
+    tracemalloc over repeated alignments the way Karen runs them: the median of reps uint16 frames
+    per plane, then the stack scored against a target.Target. with the scratch arena on and off
+    returns {'arena'|'no arena': {'peak': median bytes allocated over an alignment's starting point at
+    its peak, 'temporaries': peak less the medians the alignment keeps, 'retained': bytes still held
+    per alignment after the warmup, 'reused': scratch bytes handed out again per alignment (allocations
+    avoided), 'seconds': median time per alignment}}
+    """
+    import tracemalloc
+
+    from thePeckingOrder import scratch
+    from thePeckingOrder.planeAlignment import PlaneAlignment
+    from thePeckingOrder.target import Target
+
+    rng = np.random.default_rng(0)
+    target, volume = synthetic_volume(shape, n_planes, noise=0.1)
+    lo, hi = volume.min(), volume.max()
+    scale = lambda image: (image - lo) / (hi - lo) * 4000 + 200
+    frames = [[np.clip(scale(plane) + rng.normal(scale=50, size=shape), 0, 65535).astype(np.uint16)
+               for _ in range(reps)] for plane in volume]
+    target = Target(scale(target), 'otsu')
+    output = n_planes * int(np.prod(shape)) * 8
+
+    results = {}
+    for enabled in (True, False):
+        scratch.ARENA.enabled = enabled
+        aligner = PlaneAlignment(target, None, 'otsu', metric=metric, workers=workers)
+
+        def align():
+            aligner.image_stack = [scratch.median(plane) for plane in frames]
+            aligner.match_calculator()
+
+        # traced from the start, so the previous alignment's medians being let go is counted too
+        tracemalloc.start()
+        for _ in range(warmup):
+            align()
+        start = tracemalloc.get_traced_memory()[0]
+        reused = scratch.ARENA.reused
+        peaks, times = [], []
+        for _ in range(alignments):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            t0 = time.perf_counter()
+            align()
+            times.append(time.perf_counter() - t0)
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+        retained = (tracemalloc.get_traced_memory()[0] - start) / alignments
+        tracemalloc.stop()
+        peak = float(np.median(peaks))
+        results['arena' if enabled else 'no arena'] = {'peak': peak, 'temporaries': peak - output,
+                                                       'retained': retained,
+                                                       'reused': (scratch.ARENA.reused - reused) / alignments,
+                                                       'seconds': float(np.median(times))}
+    scratch.ARENA.enabled = True
+    return results
+
+
+def _print_steady_state_allocations(args):
+    results = steady_state_allocations((args.size, args.size), args.planes, args.reps, args.alignments,
+                                       metric=args.metric, workers=args.workers)
+    print(f'{args.size}x{args.size}, {args.planes} planes x {args.reps} reps, {args.metric}, '
+          f'{args.alignments} alignments after warmup')
+    print(f'{"":>9} {"peak MB":>8} {"temp MB":>8} {"retained kB":>12} {"reused MB":>10} {"ms":>7}')
+    for name, row in results.items():
+        print(f'{name:>9} {row["peak"] / 2 ** 20:>8.2f} {row["temporaries"] / 2 ** 20:>8.2f} '
+              f'{row["retained"] / 2 ** 10:>12.2f} {row["reused"] / 2 ** 20:>10.2f} {row["seconds"] * 1000:>7.1f}')
+    frame = args.size * args.size * 8
+    arena = results['arena']
+    ok = arena['retained'] < 16 * 2 ** 10 and arena['temporaries'] < frame
+    print(f'steady state with the arena: {"ok" if ok else "FAIL"} '
+          f'(retained < 16 kB per alignment, temporaries < one float64 frame)')
+    return 0 if ok else 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='thePeckingOrder.benchmarks')
+    sub = parser.add_subparsers(dest='benchmark', required=True)
+
+    p = sub.add_parser('importtime', help='python -X importtime for each entry point')
+    p.add_argument('--repeats', type=int, default=5)
+    p.set_defaults(func=_print_importtime)
+
+    p = sub.add_parser('metrics', help='cost per similarity metric per stack')
+    p.add_argument('--shape', type=int, nargs=2, default=[512, 480])
+    p.add_argument('--planes', type=int, nargs='+', default=[5, 21])
+    p.add_argument('--repeats', type=int, default=5)
+    p.set_defaults(func=_print_similarity_metrics)
+
+    p = sub.add_parser('masks', help='bool vs bit-packed mask memory and dice cost')
+    p.add_argument('--shape', type=int, nargs=2, default=[2048, 2048])
+    p.add_argument('--planes', type=int, default=5)
+    p.add_argument('--repeats', type=int, default=5)
+    p.set_defaults(func=_print_packed_masks)
+
+    p = sub.add_parser('roi', help='alignment time vs roi area')
+    p.add_argument('--shape', type=int, nargs=2, default=[1024, 1024])
+    p.add_argument('--planes', type=int, default=5)
+    p.add_argument('--repeats', type=int, default=5)
+    p.set_defaults(func=_print_roi_scaling)
+
+    p = sub.add_parser('planner', help='simulated move/settle time per stack, legacy vs planned')
+    p.add_argument('--planes', type=int, nargs='+', default=[5, 7, 21])
+    p.set_defaults(func=_print_move_plans)
+
+    p = sub.add_parser('backends', help='otsu + binarize + intersect per compute backend')
+    p.add_argument('--shape', type=int, nargs=2, default=[512, 480])
+    p.add_argument('--planes', type=int, nargs='+', default=[5, 21])
+    p.add_argument('--repeats', type=int, default=5)
+    p.set_defaults(func=_print_compute_backends)
+
+    p = sub.add_parser('workers', help='stack scoring time from 1 to N threads')
+    p.add_argument('--shape', type=int, nargs=2, default=[512, 480])
+    p.add_argument('--planes', type=int, nargs='+', default=[5, 11, 21])
+    p.add_argument('--max_workers', type=int, default=None)
+    p.add_argument('--metric', default='dice_packed')
+    p.add_argument('--repeats', type=int, default=5)
+    p.set_defaults(func=_print_worker_scaling)
+
+    p = sub.add_parser('decode', help='json frame payload decoding, legacy vs ArrayDecoder, with a fuzz check')
+    p.add_argument('--shape', type=int, nargs=2, default=[512, 512])
+    p.add_argument('--max_value', type=int, default=65535)
+    p.add_argument('--fuzz', type=int, default=500, help='random payloads compared against json.loads')
+    p.add_argument('--repeats', type=int, default=10)
+    p.set_defaults(func=_print_frame_decoding)
+
+    p = sub.add_parser('transport', help='frame size, encode/decode cost and throughput per frame encoding')
+    p.add_argument('--shape', type=int, nargs=2, default=[512, 512])
+    p.add_argument('--frames', type=int, default=50)
+    p.add_argument('--noise', type=float, default=0.05, help='per-frame noise, fraction of the image std')
+    p.add_argument('--encodings', nargs='+', default=None, help='default: every frames.encodings()')
+    p.add_argument('--keyframe_interval', type=int, default=10)
+    p.add_argument('--link_mbit', type=float, default=1000, help='link the acquisition pc sends over')
+    p.set_defaults(func=_print_frame_transport)
+
+    p = sub.add_parser('reps', help='frames per alignment and accuracy, fixed vs adaptive repetitions')
+    p.add_argument('--shape', type=int, nargs=2, default=[256, 256])
+    p.add_argument('--stack_size', type=int, default=5)
+    p.add_argument('--max_reps', type=int, default=5)
+    p.add_argument('--noise', type=float, nargs='+', default=[0.5, 2.0], help='per-frame noise, fraction of the volume std')
+    p.add_argument('--trials', type=int, default=20)
+    p.add_argument('--min_reps', type=int, default=2)
+    p.add_argument('--tolerance', type=float, default=0.01)
+    p.add_argument('--metric', default='dice_packed')
+    p.set_defaults(func=_print_adaptive_repetitions)
+
+    p = sub.add_parser('quality', help='per-frame quality checks: cost, what they catch, effect on medians')
+    p.add_argument('--shape', type=int, nargs=2, default=[512, 512])
+    p.add_argument('--frames', type=int, default=200)
+    p.add_argument('--corrupt', type=float, default=0.1, help='fraction of blank/saturated/moved frames')
+    p.add_argument('--reps', type=int, default=5)
+    p.add_argument('--policy', default='default')
+    p.set_defaults(func=_print_frame_quality)
+
+    p = sub.add_parser('tiles', help='tiled local-z: tilt recovery and cost against the full-frame pass')
+    p.add_argument('--shape', type=int, nargs=2, default=[512, 512])
+    p.add_argument('--planes', type=int, default=21)
+    p.add_argument('--grid', type=int, nargs=2, default=[4, 4])
+    p.add_argument('--slopes', type=float, nargs='+', default=[0.0, 0.005, 0.01], help='planes per column')
+    p.add_argument('--metrics', nargs='+', default=['dice_packed', 'ncc'])
+    p.add_argument('--max_workers', default=None)
+    p.add_argument('--repeats', type=int, default=3)
+    p.set_defaults(func=_print_local_z_estimation)
+
+    p = sub.add_parser('pstim', help='pstim channel round trips against the local stand-in, and the timeout fallback')
+    p.add_argument('--requests', type=int, default=50)
+    p.add_argument('--delay', type=float, default=0.0, help='stand-in reply delay, s')
+    p.add_argument('--timeout', type=float, default=0.5)
+    p.set_defaults(func=_print_pstim_channel)
+
+    p = sub.add_parser('rigs', help='cpu and memory of one controller against the number of rigs, local stand-ins')
+    p.add_argument('--rigs', type=int, nargs='+', default=[1, 2, 4, 8])
+    p.add_argument('--duration', type=float, default=10.0, help='seconds measured per rig count')
+    p.add_argument('--size', type=int, default=256)
+    p.add_argument('--fps', type=float, default=10.0)
+    p.add_argument('--encoding', default='json', help='what the stand-ins send, see frames.encodings()')
+    p.add_argument('--align_every', type=float, default=2.0, help='seconds between stack scorings per rig')
+    p.add_argument('--slots', type=int, default=1, help='compute slots shared by the rigs')
+    p.add_argument('--workers', default='auto')
+    p.set_defaults(func=_print_multi_rig_scaling)
+
+    p = sub.add_parser('allocations', help='tracemalloc over repeated alignments, scratch arena on and off')
+    p.add_argument('--size', type=int, default=512)
+    p.add_argument('--planes', type=int, default=5)
+    p.add_argument('--reps', type=int, default=5)
+    p.add_argument('--alignments', type=int, default=20)
+    p.add_argument('--metric', default='dice_packed')
+    p.add_argument('--workers', default=None)
+    p.set_defaults(func=_print_steady_state_allocations)
+
+    args = parser.parse_args(argv)
+    # checks like allocations return 1 on failure, for the exit status
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,191 @@
+"""
+single owner for the labview command PUB socket
+
+zmq sockets aren't thread-safe, and Karen, Protocol, the gui timers and gather_stack
+all send commands from their own threads. everything goes through CommandDispatcher.send
+instead, which queues it and lets one sender thread touch the socket.
+
+- priority queue: emergency_reset() goes out ahead of anything routine already queued
+- coalescing: consecutive queued relative moves are merged into one net move, moves that
+  cancel out aren't sent at all
+- every command gets a sequence number, sent commands land in a bounded send log
+"""
+
+import collections
+import heapq
+import logging
+import re
+import threading as tr
+import time
+
+from thePeckingOrder import instrumentation
+
+
+log = logging.getLogger(__name__)
+
+EMERGENCY = 0
+ROUTINE = 10
+
+# relative move formats: labview piezo steps and the 'piezo: move_rel' protocol form
+_MOVE_PATTERNS = {'labview': re.compile(r'^\((pplus|pminus)\)(\d+)$'),
+                  'piezo': re.compile(r'^piezo: move_rel([+-]?\d+(?:\.\d+)?)$')}
+
+
+def _parse_move(msg):
+    """(family, signed amount) for a relative move command, None for anything else"""
+    text = msg.decode(errors='ignore').strip()
+    match = _MOVE_PATTERNS['labview'].match(text)
+    if match:
+        sign = 1 if match.group(1) == 'pplus' else -1
+        return 'labview', sign * int(match.group(2))
+    match = _MOVE_PATTERNS['piezo'].match(text)
+    if match:
+        return 'piezo', float(match.group(1))
+    return None
+
+
+def format_move(family, amount):
+    if family == 'labview':
+        return f'(pplus){amount}'.encode() if amount >= 0 else f'(pminus){abs(amount)}'.encode()
+    return f'piezo: move_rel{amount:+g}'.encode()
+
+
+class Command:
+    __slots__ = ('seq', 'msg', 'priority', 'enqueued', 'sent', 'merged', 'cancelled', 'move')
+
+    def __init__(self, seq, msg, priority):
+        self.seq = seq
+        self.msg = msg
+        self.priority = priority
+        self.enqueued = time.perf_counter()
+        self.sent = None
+        self.merged = 1
+        self.cancelled = False
+        self.move = _parse_move(msg)
+
+    @property
+    def latency(self):
+        """seconds between send() and the socket send, None while queued"""
+        return None if self.sent is None else self.sent - self.enqueued
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    def __repr__(self):
+        return f'Command(seq={self.seq}, msg={self.msg!r}, priority={self.priority})'
+
+
+class CommandDispatcher:
+    def __init__(self, publisher, log_size=1000, metrics=None):
+        """
+        publisher: zmqComm.Publisher, its socket is only used from the dispatcher thread from now on
+        log_size: sent commands kept in self.sent_log
+        metrics: instrumentation.Registry for the queue and latency metrics, the process-wide one by default
+        """
+        self.pub = publisher
+        self.metrics = metrics if metrics is not None else instrumentation.REGISTRY
+        self.sent_log = collections.deque(maxlen=log_size)
+
+        self._queue = []
+        self._seq = 0
+        self._tail = None  # last routine command still queued, candidate for coalescing
+        self._in_flight = 0
+        self._cond = tr.Condition()
+        self.running = True
+
+        self.thread = tr.Thread(target=self._sender, daemon=True)
+        self.thread.start()
+
+    def send(self, msg, priority=ROUTINE, coalesce=True):
+        """
+        queues msg (bytes or str) and returns its Command
+        a relative move queued right behind another unsent move of the same form is folded into it
+        """
+        if isinstance(msg, str):
+            msg = msg.encode()
+
+        with self._cond:
+            self._seq += 1
+            command = Command(self._seq, msg, priority)
+
+            tail = self._tail
+            if (coalesce and priority == ROUTINE and command.move is not None and tail is not None
+                    and tail.move is not None and tail.move[0] == command.move[0]):
+                family, amount = tail.move[0], tail.move[1] + command.move[1]
+                tail.move = (family, amount)
+                tail.msg = format_move(family, amount)
+                tail.merged += 1
+                # a net move of zero stays queued as a placeholder the sender skips, a later move can revive it
+                tail.cancelled = amount == 0
+                self.metrics.inc('commands_coalesced_total')
+                return tail
+
+            heapq.heappush(self._queue, command)
+            if priority == ROUTINE:
+                self._tail = command
+            self.metrics.set('command_queue_depth', len(self._queue))
+            self._cond.notify_all()
+        return command
+
+    def emergency_reset(self, cancel_pending=True):
+        """RESET ahead of everything queued, by default dropping the queued routine commands"""
+        if cancel_pending:
+            self.cancel_pending()
+        return self.send(b'RESET', priority=EMERGENCY, coalesce=False)
+
+    def cancel_pending(self):
+        with self._cond:
+            for command in self._queue:
+                command.cancelled = True
+            self._queue = []
+            self._tail = None
+            self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """blocks until everything queued so far is on the socket, False on timeout"""
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        with self._cond:
+            while self._queue or self._in_flight:
+                remaining = None if deadline is None else deadline - time.perf_counter()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _sender(self):
+        while True:
+            with self._cond:
+                while self.running and not self._queue:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                command = heapq.heappop(self._queue)
+                if command is self._tail:
+                    self._tail = None
+                self._in_flight += 1
+
+            try:
+                if command.cancelled:
+                    log.debug('skipped #%d %r (%d merged)', command.seq, command.msg, command.merged)
+                else:
+                    self.pub.socket.send(command.msg)
+                    command.sent = time.perf_counter()
+                    self.sent_log.append(command)
+                    self.metrics.inc('commands_sent_total')
+                    self.metrics.observe('command_latency_seconds', command.latency)
+                    log.debug('sent #%d %r (%d merged) after %.4fs', command.seq, command.msg,
+                              command.merged, command.latency)
+            except Exception:
+                log.exception('failed to send %r', command)
+            finally:
+                with self._cond:
+                    self._in_flight -= 1
+                    self._cond.notify_all()
+
+    def stop(self, timeout=5):
+        """sends what is already queued, then stops the sender thread"""
+        self.flush(timeout)
+        with self._cond:
+            self.running = False
+            self._cond.notify_all()
+        self.thread.join(timeout)
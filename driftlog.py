@@ -0,0 +1,191 @@
+"""
+append-only drift history for long sessions
+
+rows are fixed-size numpy records (time, kind, loss, best plane, move, duration,
+per-plane scores) held in two ring buffers: the raw rows, and a coarse tier where every
+`decimate` raw rows are averaged into one row per kind. both have fixed capacity, so a session
+that runs for days stays at 2 * capacity rows of 108 bytes (about 2 MB at the default 10_000,
+a few hours raw and weeks coarse at one loss sample a second), appends are O(1), and plots ask
+for downsampled() points, which only copies the two columns it plots.
+
+with a path every raw row is also appended to a flat binary file, DriftLog.load(path)
+memory-maps it back for offline analysis.
+"""
+
+import threading as tr
+import time
+
+import numpy as np
+
+
+LOSS = 0
+ALIGNMENT = 1
+
+MAX_PLANES = 21
+
+
+def record_dtype(max_planes=MAX_PLANES):
+    return np.dtype([('time', '<f8'),
+                     ('kind', 'u1'),
+                     ('n_scores', 'u1'),
+                     ('best', '<i2'),
+                     ('loss', '<f4'),
+                     ('move', '<f4'),
+                     ('duration', '<f4'),
+                     ('scores', '<f4', (max_planes,))])
+
+
+DTYPE = record_dtype()
+
+
+class _Ring:
+    def __init__(self, capacity, dtype):
+        self.data = np.zeros(capacity, dtype=dtype)
+        self.capacity = capacity
+        self.head = 0  # next write position
+        self.size = 0
+
+    def append(self, row):
+        self.data[self.head] = row
+        self.head = (self.head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def halves(self):
+        """the rows oldest first as one or two views into the ring, only valid until the next append"""
+        if self.size < self.capacity:
+            return (self.data[:self.size],)
+        return (self.data[self.head:], self.data[:self.head])
+
+    def oldest(self):
+        return self.halves()[0][0] if self.size else None
+
+    def view(self):
+        """rows oldest first, a copy"""
+        return np.concatenate(self.halves())
+
+
+class DriftLog:
+    def __init__(self, capacity=10_000, decimate=100, path=None, max_planes=MAX_PLANES):
+        """
+        capacity: rows kept per tier, raw covers capacity rows, coarse capacity * decimate
+        decimate: raw rows averaged into each coarse row
+        path: optional binary file every raw row is appended to
+        """
+        self.dtype = record_dtype(max_planes)
+        self.max_planes = max_planes
+        self.decimate = decimate
+        self.raw = _Ring(capacity, self.dtype)
+        self.coarse = _Ring(capacity, self.dtype)
+        self._pending = np.zeros(decimate, dtype=self.dtype)
+        self._n_pending = 0
+        self._lock = tr.Lock()
+
+        self.path = path
+        self._file = open(path, 'ab') if path is not None else None
+
+    def _row(self, kind, t, loss=np.nan, best=-1, move=np.nan, duration=np.nan, scores=()):
+        row = np.zeros((), dtype=self.dtype)
+        row['time'] = time.time() if t is None else t
+        row['kind'] = kind
+        row['loss'] = loss
+        row['best'] = best
+        row['move'] = move
+        row['duration'] = duration
+        scores = np.asarray(scores, dtype=np.float32)[:self.max_planes]
+        row['scores'][:] = np.nan
+        row['scores'][:scores.size] = scores
+        row['n_scores'] = scores.size
+        return row
+
+    def log_loss(self, loss, t=None):
+        """one similarity sample between the live frame and the target"""
+        self.append(self._row(LOSS, t, loss=loss))
+
+    def log_alignment(self, scores, best, move, duration=np.nan, t=None):
+        """one alignment: per-plane scores, chosen plane, applied move and how long it took"""
+        scores = np.asarray(scores, dtype=np.float32)
+        loss = scores[best] if scores.size else np.nan
+        self.append(self._row(ALIGNMENT, t, loss=loss, best=best, move=move, duration=duration, scores=scores))
+
+    def append(self, row):
+        with self._lock:
+            self.raw.append(row)
+            if self._file is not None:
+                self._file.write(row.tobytes())
+                self._file.flush()
+
+            self._pending[self._n_pending] = row
+            self._n_pending += 1
+            if self._n_pending == self.decimate:
+                for kind in (LOSS, ALIGNMENT):
+                    rows = self._pending[self._pending['kind'] == kind]
+                    if rows.size:
+                        self.coarse.append(self._summarize(rows, kind))
+                self._n_pending = 0
+
+    def _summarize(self, rows, kind):
+        """one coarse row for rows of a single kind, so losses and alignments keep their own averages"""
+        row = np.zeros((), dtype=self.dtype)
+        row['time'] = rows['time'].mean()
+        row['kind'] = kind
+        row['loss'] = np.nanmean(rows['loss']) if np.isfinite(rows['loss']).any() else np.nan
+        row['move'] = rows['move'].sum() if kind == ALIGNMENT else np.nan
+        row['best'] = rows['best'][-1] if kind == ALIGNMENT else -1
+        row['duration'] = np.nanmean(rows['duration']) if np.isfinite(rows['duration']).any() else np.nan
+        row['scores'][:] = np.nan
+        return row
+
+    def __len__(self):
+        return self.raw.size
+
+    def rows(self, kind=None, since=None):
+        """raw rows still held in memory, oldest first, a copy"""
+        with self._lock:
+            return np.concatenate([half[self._select(half, kind, since)] for half in self.raw.halves()])
+
+    @staticmethod
+    def _select(rows, kind=None, since=None, before=None):
+        keep = np.ones(rows.size, dtype=bool)
+        if since is not None:
+            keep &= rows['time'] >= since
+        if before is not None:
+            keep &= rows['time'] < before
+        if kind is not None:
+            keep &= rows['kind'] == kind
+        return keep
+
+    def alignments(self, since=None):
+        return self.rows(ALIGNMENT, since)
+
+    def downsampled(self, max_points=1500, field='loss', kind=LOSS, since=None):
+        """
+        (times, values) with at most max_points points for plotting
+        uses the raw tier while it still covers `since`, the coarse tier otherwise,
+        and averages neighbouring rows down to max_points
+        """
+        with self._lock:
+            parts = [(half, None) for half in self.raw.halves()]
+            oldest = self.raw.oldest()
+            if since is not None and oldest is not None and oldest['time'] > since:
+                parts = [(half, oldest['time']) for half in self.coarse.halves()] + parts
+            # only the plotted columns are copied out, never whole records
+            keep = [self._select(half, kind, since, before) for half, before in parts]
+            times = np.concatenate([half['time'][k] for (half, _), k in zip(parts, keep)])
+            values = np.concatenate([half[field][k] for (half, _), k in zip(parts, keep)]).astype(np.float64)
+
+        if times.size <= max_points:
+            return times, values
+        edges = np.linspace(0, times.size, max_points + 1).astype(np.intp)
+        counts = np.diff(edges)
+        return (np.add.reduceat(times, edges[:-1]) / counts,
+                np.add.reduceat(values, edges[:-1]) / counts)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @staticmethod
+    def load(path, max_planes=MAX_PLANES):
+        """memory-maps a drift file written with path=..."""
+        return np.memmap(path, dtype=record_dtype(max_planes), mode='r')
@@ -1,6 +1,8 @@
 # skimage wont install correctly sometimes so heres filters
 import numpy as np
 
+from thePeckingOrder import scratch
+
 dtype_range = {bool: (False, True),
                np.bool_: (False, True),
                np.bool8: (False, True),
@@ -41,10 +43,9 @@ def _offset_array(arr, low_boundary, high_boundary):
         # get smallest dtype that can hold both minimum and offset maximum
         offset_dtype = np.promote_types(np.min_scalar_type(dyn_range),
                                         np.min_scalar_type(low_boundary))
-        if arr.dtype != offset_dtype:
-            # prevent overflow errors when offsetting
-            arr = arr.astype(offset_dtype)
-        arr = arr - offset
+        # cast and offset in one pass into a scratch buffer, prevents overflow errors when offsetting
+        arr = np.subtract(arr, offset, out=scratch.get('offset_array', arr.shape, offset_dtype), dtype=offset_dtype,
+                          casting='unsafe')
     else:
         offset = 0
     return arr, offset
@@ -136,7 +137,8 @@ def histogram(image, nbins=256, source_range='image', normalize=False):
     """
 
 
-    image = image.flatten()
+    # a view, nothing here writes to it
+    image = image.ravel()
     # For integer types, histogramming with bincount is more efficient.
     if np.issubdtype(image.dtype, np.integer):
         hist, bin_centers = _bincount_histogram(image, source_range)
@@ -240,7 +242,8 @@ def threshold_otsu(image=None, nbins=256, *, hist=None):
     # value
     if image is not None:
         first_pixel = image.ravel()[0]
-        if np.all(image == first_pixel):
+        # two reductions instead of a full-frame comparison
+        if image.min() == image.max() == first_pixel:
             return first_pixel
 
     counts, bin_centers = _validate_image_histogram(image, hist, nbins)
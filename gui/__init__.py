@@ -0,0 +1,14 @@
+"""
+qt front end -- needs the gui extras: PyQt5, pyqtgraph, qdarkstyle
+alignment_gui is only imported when asked for
+"""
+
+import importlib
+
+
+def __getattr__(name):
+    if name == 'alignment_gui':
+        module = importlib.import_module(f'{__name__}.{name}')
+        globals()[name] = module
+        return module
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -1,29 +1,27 @@
-from thePeckingOrder import zmqComm, planeAlignment
+from thePeckingOrder import driftlog, instrumentation, pstim, zmqComm, planeAlignment, roi, scratch
+from thePeckingOrder.target import Target
 
 from PyQt5 import QtWidgets, uic, QtCore
 from PyQt5.Qt import QApplication
 
 from datetime import datetime as dt
 
-import qdarkstyle
-
 import threading as tr
 import pyqtgraph as pg
 import numpy as np
 
 import os
+import sys
 import logging
 import time
-import zmq
-
-logging.basicConfig(level=logging.INFO)
 
 
+log = logging.getLogger(__name__)
 exit_event = tr.Event()
 
 
 class PlaneAligner(QtWidgets.QMainWindow):
-    def __init__(self, walkytalky, stimBuddyPorts=None, *args, **kwargs):
+    def __init__(self, walkytalky, stimBuddyPorts=None, targetLibrary=None, driftPath=None, *args, **kwargs):
         super(PlaneAligner, self).__init__(*args, **kwargs)
 
         self.running = True
@@ -32,22 +30,36 @@ class PlaneAligner(QtWidgets.QMainWindow):
         uic.loadUi(self.UIpath, self)
 
         self.wt = walkytalky
+        # optional library.TargetLibrary, the gui target is kept in it under 'gui_target'
+        self.targetLibrary = targetLibrary
+        self.librarySaver = None
         self.alignmentStatus = False
         self.runningSequences = False
 
         # self.main_widget = QtWidgets.QWidget(self)
         # self.main_layout = QtWidgets.QVBoxLayout(self.main_widget)
 
-        try:
-            self.displayImg = self.wt.images[-1]
-        except IndexError:
-            self.displayImg = np.zeros([512,512])
+        if self.targetLibrary is not None and 'gui_target' in self.targetLibrary:
+            self.target = Target.from_entry(self.targetLibrary.load('gui_target'))
+            self.displayImg = np.asarray(self.target.image)
+        else:
+            try:
+                self.displayImg = self.wt.latest_frame(step=1)
+            except IndexError:
+                self.displayImg = np.zeros([512,512])
+            self.target = Target(self.displayImg)
+        # self.target keeps the threshold, masks and counts for every tick until update_image
+        self.targetBlank = not np.any(self.displayImg)
 
         self.lastAlignedTime = time.time()
 
         self.viewImages = pg.ImageView(parent=self.targetContainer)
         self.viewImages.setImage(self.displayImg, autoRange=False)
 
+        # alignment region: drag/resize on the target view, alignment only looks inside it
+        self.alignROI = pg.RectROI([0, 0], self.displayImg.shape[:2], pen='y')
+        self.viewImages.addItem(self.alignROI)
+
         self.viewLive = pg.ImageView(parent=self.currentPlane)
         self.viewLive.setImage(self.displayImg)
 
@@ -61,11 +73,13 @@ class PlaneAligner(QtWidgets.QMainWindow):
 
         self.n = 0
         self.img_lens = 0
-        self.losses = []
-        self.planes_n = []
+        # losses and alignments, bounded in memory, optionally mirrored to driftPath
+        self.drift = driftlog.DriftLog(path=driftPath)
+        self.t0 = time.time()
 
         self.graphWidget = pg.PlotWidget(parent=self.lossGraph, autoscale=True, history=1500)
         self.graphWidget.setGeometry(0, 0, self.lossGraph.width(), self.lossGraph.height())
+        self.lossCurve = self.graphWidget.plot()
 
         self.graphTimer = QtCore.QTimer()
         self.graphTimer.setInterval(1000)
@@ -90,47 +104,87 @@ class PlaneAligner(QtWidgets.QMainWindow):
         self.planeLabels = [self.plane0_val, self.plane1_val, self.plane2_val, self.plane3_val, self.plane4_val]
         [pval.setText(str(0)) for pval in self.planeLabels]
 
+        # stimBuddyPorts: wt_output / wt_input ports, optionally timeout, fallback and legacy, see pstim.PstimChannel
+        self.pstim = None
         if stimBuddyPorts:
-            self.pstimPub = zmqComm.Publisher(stimBuddyPorts['wt_output'])
-            self.pstimSub = zmqComm.Subscriber(stimBuddyPorts['wt_input'])
+            options = {key: stimBuddyPorts[key] for key in ('timeout', 'fallback', 'legacy') if key in stimBuddyPorts}
+            self.pstim = pstim.PstimChannel(stimBuddyPorts['wt_output'], stimBuddyPorts['wt_input'], **options)
+            # replies are picked up here instead of blocking the main thread on a recv
+            self.pstimTimer = QtCore.QTimer()
+            self.pstimTimer.setInterval(50)
+            self.pstimTimer.timeout.connect(self.pstim_msg_reception)
+            self.pstimTimer.start()
 
 
     def update_live(self):
-        try:
-            self.viewLive.setImage(self.wt.images[-1], autoRange=False)
-        except IndexError:
-            pass
+        with instrumentation.timer('gui_live_seconds'):
+            try:
+                # downsampled preview, only decoded because we display it
+                self.viewLive.setImage(self.wt.latest_frame(), autoRange=False)
+            except IndexError:
+                pass
+        # computed when the frame arrived, nothing to do here but show it
+        stats = self.wt.latest_stats
+        if stats is not None:
+            self.statusBar().showMessage(f'mean {stats.mean:.0f}  max {stats.max:.0f}  saturated {stats.saturated:.1%}  '
+                                         f'sharpness {stats.sharpness:.3f}  motion {stats.motion:.3f}  '
+                                         f'{stats.rejected or "ok"}')
 
     def flush(self):
         self.wt.make_current()
 
     def graphfxn(self):
-        curr_l = len(self.wt.images)
-        if curr_l != self.img_lens and np.sum(self.displayImg) != 0:
+        curr_l = self.wt.latest_seq
+        if curr_l != self.img_lens and not self.targetBlank:
             self.img_lens = curr_l
             self.n += 1
             try:
-                pa = planeAlignment.PlaneAlignment(self.wt.images[-1], self.displayImg, method='otsu')
-                loss = pa.lossReturn()
-                self.losses.append(loss)
-                self.planes_n.append(self.n)
-                self.graphWidget.plot(self.planes_n, self.losses)
+                with instrumentation.timer('gui_loss_seconds'):
+                    pa = planeAlignment.PlaneAlignment(self.target, self.wt.latest_frame(step=1), method='otsu',
+                                                       roi=self.current_roi())
+                    loss = pa.lossReturn()
+                self.drift.log_loss(loss)
+                times, losses = self.drift.downsampled(1500)
+                self.lossCurve.setData(times - self.t0, losses)
                 # self.graphWidget.setYRange(0, 1, padding=0)
             except IndexError:
                 pass
 
+    def current_roi(self):
+        slices, _ = self.alignROI.getArraySlice(self.displayImg, self.viewImages.getImageItem())
+        return roi.ROI.from_slices(slices)
+
     def update_image(self):
         n_frames = self.n_imgs.value()
-        self.displayImg = np.median(self.wt.images[-n_frames:], axis=0)
+        with instrumentation.timer('median_seconds'):
+            self.displayImg = scratch.median(self.wt.images[-n_frames:])
+        self.target.update(self.displayImg)
+        self.targetBlank = not np.any(self.displayImg)
         self.viewImages.setImage(self.displayImg, autoRange=False)
+        if self.targetLibrary is not None:
+            # writing the target is disk time, keep it off the gui thread
+            self.librarySaver = tr.Thread(target=self.save_target, args=(self.displayImg.copy(), n_frames), daemon=True)
+            self.librarySaver.start()
         self.output(f'target updated using{n_frames}', True)
 
+    def save_target(self, image, n_frames):
+        try:
+            self.targetLibrary.save('gui_target', image, n_frames=n_frames)
+        except Exception:
+            log.exception('saving the gui target to the library failed')
+
     def closeEvent(self, event):
         self.imgUpdater.stop()
         self.graphTimer.stop()
         self.flushTimer.stop()
+        if self.pstim is not None:
+            self.pstimTimer.stop()
+            self.pstim.close()
         self.running = False
         self.runningSequences = False
+        self.drift.close()
+        if self.librarySaver is not None:
+            self.librarySaver.join(timeout=5)
         pg.exit()
         try:
             self.wt.kill()
@@ -158,20 +212,25 @@ class PlaneAligner(QtWidgets.QMainWindow):
         sys.exit()
 
     def pstim_msg_reception(self):
-        # this will trigger alignment running from msgs in pstim
-        topic = self.pstimSub.socket.recv_string()
-        msg = self.pstimSub.socket.recv_pyobj()
-        print(f'we got a {topic} {msg}')
-        match topic:
-            case 'stimbuddy':
-                match msg:
-                    case 'proceed':
-                        self.output('received pause confirmation from pstim', True)
-                        self.run_alignment(safe=True)
-                    case _:
-                        print(f'{msg}: message not understood')
-            case _:
-                print(f'{topic}: topic not understood')
+        # this will trigger alignment running from msgs in pstim, polled, never waits
+        for event in self.pstim.poll():
+            if event.timed_out:
+                self.output(f'pstim did not answer in time, {event.kind}', True)
+            else:
+                self.output(f'received pause confirmation from pstim ({event.rtt * 1000:.0f} ms)', True)
+            match event.kind:
+                case 'proceed':
+                    # a timed-out pause may still have paused pstim, unpause after aligning either way
+                    self.run_alignment(safe=True)
+                case 'skip':
+                    # pstim may have paused without the reply getting here, don't leave it paused
+                    if event.timed_out:
+                        self.thankPstim()
+                    # try again next round
+                    self.kill_timers()
+                    self.run_alignment_sequence()
+                case _:
+                    self.output(f'{event.kind}: message not understood', True)
 
     def run_alignment_sequence(self):
         safetyMode = self.stimulusCheck.isChecked()
@@ -214,18 +273,18 @@ class PlaneAligner(QtWidgets.QMainWindow):
 
 
     def askPstimForPermission(self):
+        if self.pstim is None:
+            self.output('no pstim ports configured, aligning without a pause', True)
+            self.run_alignment()
+            return
         self.output('asked pstim to pause', True)
-        # asks pstim to pause
-        self.pstimPub.socket.send_string('alignment', zmq.SNDMORE)
-        self.pstimPub.socket.send_pyobj("pause")
-
-        self.pstim_msg_reception()
+        # asks pstim to pause, the reply (or the timeout fallback) comes through pstim_msg_reception
+        self.pstim.request('pause')
 
     def thankPstim(self):
         self.output('asked pstim to unpause', True)
         # resumes pstim
-        self.pstimPub.socket.send_string('alignment', zmq.SNDMORE)
-        self.pstimPub.socket.send_pyobj("unpause")
+        self.pstim.notify('unpause')
 
     def run_alignment(self, safe=False):
         self.output(f'alignment: status: initiated')
@@ -239,22 +298,42 @@ class PlaneAligner(QtWidgets.QMainWindow):
             4: stepSize*2
         }
 
-        self.wt.pub.socket.send(b"RESET")
-        time.sleep(1)
-        self.compStack = self.wt.gather_stack(spacing=stepSize, reps=self.n_reps.value())
-        pa = planeAlignment.PlaneAlignment(target=self.displayImg, stack=self.compStack, method='otsu')
-        self.myMatch = pa.match_calculator()
-        moveAmount = someMovementDictionary[self.myMatch]
-        if moveAmount != 0:
-            self.wt.move_piezo_n(moveAmount)
+        alignStart = time.time()
+        with instrumentation.timer('alignment_total_seconds'):
+            with instrumentation.timer('alignment_reset_seconds'):
+                self.wt.send(b"RESET")
+                time.sleep(1)
+            with instrumentation.timer('alignment_gather_seconds'):
+                try:
+                    self.compStack = self.wt.gather_stack(spacing=stepSize, reps=self.n_reps.value(), return_home=False)
+                except RuntimeError as error:
+                    # a plane got no frames at all, go back to the target and skip this alignment
+                    self.output(f'alignment: status: failed, {error}')
+                    self.wt.finish_stack(0)
+                    if safe:
+                        self.thankPstim()
+                    # try again next round
+                    self.kill_timers()
+                    self.run_alignment_sequence()
+                    return
+            with instrumentation.timer('alignment_match_seconds'):
+                pa = planeAlignment.PlaneAlignment(target=self.target, stack=self.compStack, method='otsu',
+                                                   roi=self.current_roi())
+                self.myMatch = pa.match_calculator()
+            moveAmount = someMovementDictionary[self.myMatch]
+            with instrumentation.timer('alignment_move_seconds'):
+                # return move and correction in one go
+                self.wt.finish_stack(moveAmount)
+        instrumentation.inc('alignments_total')
+        self.drift.log_alignment(pa.match_vals, self.myMatch, moveAmount, time.time() - alignStart)
         self.output(f'alignment: status: completed with {moveAmount} movement')
 
-        self.pstimPub.socket.send_string('alignment', zmq.SNDMORE)
-        self.pstimPub.socket.send_pyobj(f"movementAmount_{moveAmount}")
+        if self.pstim is not None:
+            self.pstim.notify('movement', moveAmount)
 
         textOut = self.scanningParams.toPlainText()
-        self.wt.pub.socket.send(textOut.encode())
-        self.wt.pub.socket.send(b"RUN")
+        self.wt.send(textOut.encode())
+        self.wt.send(b"RUN")
         if safe:
             self.thankPstim()
 
@@ -282,6 +361,11 @@ class PlaneAligner(QtWidgets.QMainWindow):
 
 
 def run():
+    # stylesheet is cosmetic, only needed once a window exists
+    import qdarkstyle
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
     app = QApplication([])
     app.setStyleSheet(qdarkstyle.load_stylesheet_pyqt5())
 
@@ -0,0 +1,330 @@
+"""
+counters and latency histograms for the hot paths (comms, alignment, gui)
+
+disabled by default: while off every call is one attribute check and returns,
+so the calls can stay in the per-frame loops permanently.
+
+    from thePeckingOrder import instrumentation
+    instrumentation.enable()
+    ...
+    instrumentation.snapshot()                  # in-process
+    instrumentation.serve_prometheus(9102)      # curl localhost:9102/metrics
+    instrumentation.JsonDumper('metrics.json')  # periodic dump
+
+a process driving several rigs gives each one a Registry(labels={'rig': name}), the same metric
+names then come out as one family with a rig label, see render_registries.
+"""
+
+import bisect
+import json
+import math
+import threading as tr
+import time
+
+
+# seconds -- covers a json decode (~ms) up through a full alignment (~10s)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(labels, **extra):
+    """'{rig="a",le="0.5"}' or '' without labels"""
+    labels = dict(labels or {}, **extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, doc='', labels=None):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.value = 0
+        self._lock = tr.Lock()
+
+    def inc(self, n=1):
+        with self._lock:
+            self.value += n
+
+    def snapshot(self):
+        return self.value
+
+    def prometheus(self):
+        return [f'{self.name}{_format_labels(self.labels)} {self.value}']
+
+
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name, doc='', labels=None):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        return self.value
+
+    def prometheus(self):
+        return [f'{self.name}{_format_labels(self.labels)} {self.value}']
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, doc='', buckets=DEFAULT_BUCKETS, labels=None):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+        self._lock = tr.Lock()
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[idx] += 1
+            self.sum += value
+            self.count += 1
+            if value > self.max:
+                self.max = value
+
+    def quantile(self, q):
+        """approximate quantile from the bucket upper bounds"""
+        if self.count == 0:
+            return math.nan
+        rank = q * self.count
+        running = 0
+        for bound, n in zip(self.buckets + (self.max,), self.counts):
+            running += n
+            if running >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count,
+                'sum': self.sum,
+                'mean': self.sum / self.count if self.count else math.nan,
+                'max': self.max,
+                'p50': self.quantile(0.5),
+                'p99': self.quantile(0.99)}
+
+    def prometheus(self):
+        lines = []
+        running = 0
+        for bound, n in zip(self.buckets, self.counts):
+            running += n
+            lines.append(f'{self.name}_bucket{_format_labels(self.labels, le=bound)} {running}')
+        lines.append(f'{self.name}_bucket{_format_labels(self.labels, le="+Inf")} {self.count}')
+        lines.append(f'{self.name}_sum{_format_labels(self.labels)} {self.sum}')
+        lines.append(f'{self.name}_count{_format_labels(self.labels)} {self.count}')
+        return lines
+
+
+class _Timer:
+    __slots__ = ('hist', 't0')
+
+    def __init__(self, hist):
+        self.hist = hist
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.t0)
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Registry:
+    """
+    holds every metric for one process (or one rig)
+    metrics are created on first use so call sites only need a name
+    labels: {name: value} put on every metric in prometheus output, e.g. {'rig': 'rig2'}
+    """
+    def __init__(self, prefix='peckingorder_', enabled=False, labels=None):
+        self.prefix = prefix
+        self.enabled = enabled
+        self.labels = labels
+        self.metrics = {}
+        self._lock = tr.Lock()
+
+    def _get(self, cls, name, **kwargs):
+        try:
+            return self.metrics[name]
+        except KeyError:
+            with self._lock:
+                if name not in self.metrics:
+                    self.metrics[name] = cls(self.prefix + name, labels=self.labels, **kwargs)
+                return self.metrics[name]
+
+    def counter(self, name, doc=''):
+        return self._get(Counter, name, doc=doc)
+
+    def gauge(self, name, doc=''):
+        return self._get(Gauge, name, doc=doc)
+
+    def histogram(self, name, doc='', buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, doc=doc, buckets=buckets)
+
+    def inc(self, name, n=1):
+        if not self.enabled:
+            return
+        self.counter(name).inc(n)
+
+    def set(self, name, value):
+        if not self.enabled:
+            return
+        self.gauge(name).set(value)
+
+    def observe(self, name, value):
+        if not self.enabled:
+            return
+        self.histogram(name).observe(value)
+
+    def timer(self, name):
+        """context manager recording the block duration into histogram `name`"""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self.histogram(name))
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in list(self.metrics.items())}
+
+    def render_prometheus(self):
+        return render_registries([self])
+
+    def reset(self):
+        with self._lock:
+            self.metrics = {}
+
+
+def render_registries(registries):
+    """
+    prometheus text for several registries at once, metrics of the same name (the per-rig copies)
+    grouped under one HELP/TYPE header as the format wants
+    """
+    families = {}
+    for registry in registries:
+        for metric in list(registry.metrics.values()):
+            families.setdefault(metric.name, []).append(metric)
+    lines = []
+    for name, metrics in families.items():
+        doc = next((metric.doc for metric in metrics if metric.doc), '')
+        if doc:
+            lines.append(f'# HELP {name} {doc}')
+        lines.append(f'# TYPE {name} {metrics[0].kind}')
+        for metric in metrics:
+            lines.extend(metric.prometheus())
+    return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def enable(registry=REGISTRY):
+    registry.enabled = True
+
+
+def disable(registry=REGISTRY):
+    registry.enabled = False
+
+
+def inc(name, n=1):
+    REGISTRY.inc(name, n)
+
+
+def set_gauge(name, value):
+    REGISTRY.set(name, value)
+
+
+def observe(name, value):
+    REGISTRY.observe(name, value)
+
+
+def timer(name):
+    return REGISTRY.timer(name)
+
+
+def snapshot():
+    return REGISTRY.snapshot()
+
+
+def render_prometheus():
+    return REGISTRY.render_prometheus()
+
+
+def serve_prometheus(port=9102, host='127.0.0.1', registry=REGISTRY):
+    """
+    serves registry.render_prometheus() (a Registry, or anything with that method such as
+    rigs.RigController) on http://host:port/metrics from a daemon thread
+    returns the server, call .shutdown() to stop it
+    """
+    # http.server drags in email/socketserver, keep it off the import path
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip('/') not in ('', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render_prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, int(port)), _Handler)
+    server.daemon_threads = True
+    tr.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class JsonDumper:
+    """periodically writes registry.snapshot() to a json file"""
+    def __init__(self, path, interval=10.0, registry=REGISTRY):
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+
+        self._stop = tr.Event()
+        self.thread = tr.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.dump()
+
+    def dump(self):
+        with open(self.path, 'w') as f:
+            json.dump({'time': time.time(), 'metrics': self.registry.snapshot()}, f, default=str)
+
+    def stop(self):
+        self._stop.set()
+        self.thread.join()
+        self.dump()
@@ -0,0 +1,149 @@
+"""
+on-disk library of target planes
+
+each target is a folder of .npy files (raw image, packed mask words, histogram)
+plus a small meta.json, so loading is an np.load(mmap_mode='r') per array and costs
+nothing until the data is touched.
+the fft the first version also stored is left out on purpose, nothing reads it.
+
+    lib = TargetLibrary('~/targets')
+    lib.save('fish3_plane2', targetImage)
+    entry = lib.load('fish3_plane2')
+    names, scores = lib.match(stack)      # (n_targets, n_planes) dice
+"""
+
+import json
+import os
+import shutil
+import threading as tr
+import time
+
+import numpy as np
+
+from thePeckingOrder import filters, masks
+
+
+_BINARIZE = {'mean': np.mean,
+             'otsu': filters.threshold_otsu}
+
+
+class LibraryEntry:
+    def __init__(self, name, path, mmap_mode='r'):
+        self.name = name
+        self.path = path
+
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+
+        self.image = np.load(os.path.join(path, 'image.npy'), mmap_mode=mmap_mode)
+        self.mask = masks.PackedMask(np.load(os.path.join(path, 'mask.npy'), mmap_mode=mmap_mode), self.image.shape,
+                                     count=self.meta['mask_count'])
+        self.histogram = np.load(os.path.join(path, 'hist.npy'), mmap_mode=mmap_mode)
+
+    @property
+    def threshold(self):
+        return self.meta['threshold']
+
+    @property
+    def method(self):
+        return self.meta['method']
+
+    def __repr__(self):
+        return f'LibraryEntry({self.name!r}, shape={self.image.shape}, method={self.method!r})'
+
+
+class TargetLibrary:
+    def __init__(self, path, method='otsu'):
+        """
+        path: folder holding the library, created if missing
+        method: binarization used for stored masks, same names as PlaneAlignment
+        """
+        assert(method in _BINARIZE.keys()), f'method must be approved method: {_BINARIZE.keys()}'
+        self.path = os.path.expanduser(path)
+        self.method = method
+        self.binarize_method = _BINARIZE[method]
+        self._entries = {}
+        # saves of the same name share a .tmp folder, one at a time
+        self._save_lock = tr.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    def names(self):
+        return sorted(name for name in os.listdir(self.path)
+                      if not name.endswith('.tmp') and os.path.isfile(os.path.join(self.path, name, 'meta.json')))
+
+    def __contains__(self, name):
+        return name in self.names()
+
+    @staticmethod
+    def check_name(name):
+        """names are single folder names in the library, nothing that could point outside it"""
+        if (not isinstance(name, str) or not name or name in ('.', '..') or name.endswith('.tmp')
+                or any(sep in name for sep in ('/', '\\', os.sep)) or '\0' in name):
+            raise ValueError(f'bad target name {name!r}: needs a plain folder name without path separators')
+        return name
+
+    def save(self, name, image, **meta):
+        """precomputes and writes everything alignment needs for this target, returns the loaded entry"""
+        self.check_name(name)
+        image = np.ascontiguousarray(image)
+        threshold = self.binarize_method(image)
+        mask = masks.PackedMask.from_bool(image > threshold)
+        counts, bin_centers = filters.histogram(image, nbins=256)
+
+        folder = os.path.join(self.path, name)
+        tmp = folder + '.tmp'
+        with self._save_lock:
+            shutil.rmtree(tmp, ignore_errors=True)
+            os.makedirs(tmp)
+
+            np.save(os.path.join(tmp, 'image.npy'), image)
+            np.save(os.path.join(tmp, 'mask.npy'), mask.words)
+            np.save(os.path.join(tmp, 'hist.npy'), np.stack([counts, bin_centers]).astype(np.float64))
+            with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+                json.dump(dict(meta, name=name, method=self.method, threshold=float(threshold),
+                               mask_count=int(mask.count()), shape=list(image.shape), dtype=str(image.dtype), saved=time.time()), f)
+
+            # swap in whole so a half-written target is never loaded
+            shutil.rmtree(folder, ignore_errors=True)
+            os.replace(tmp, folder)
+            self._entries.pop(name, None)
+        return self.load(name)
+
+    def load(self, name):
+        self.check_name(name)
+        if name not in self._entries:
+            folder = os.path.join(self.path, name)
+            if not os.path.isfile(os.path.join(folder, 'meta.json')):
+                raise KeyError(f'no target {name!r} in {self.path}')
+            self._entries[name] = LibraryEntry(name, folder)
+        return self._entries[name]
+
+    def delete(self, name):
+        self.check_name(name)
+        self._entries.pop(name, None)
+        shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+    def match(self, stack, names=None):
+        """
+        dice of every stored target against every plane of stack (Z, H, W)
+        the stack is binarized and packed once, each target is one AND + popcount pass
+
+        returns (names, scores) with scores shaped (n_targets, n_planes)
+        """
+        names = list(names) if names is not None else self.names()
+        entries = [self.load(name) for name in names]
+        stack = np.asarray(stack)
+        for entry in entries:
+            if entry.image.shape != stack.shape[1:]:
+                raise ValueError(f'target {entry.name!r} is {entry.image.shape}, stack planes are {stack.shape[1:]}')
+
+        stack_mask = masks.PackedMask.from_planes((image > self.binarize_method(image) for image in stack), stack.shape[1:],
+                                                  len(stack))
+        scores = np.array([stack_mask.dice(entry.mask) for entry in entries]).reshape(len(entries), len(stack))
+        return names, scores
+
+    def best_match(self, stack, names=None):
+        """(target name, plane index, score) of the best pairing"""
+        names, scores = self.match(stack, names)
+        t, z = np.unravel_index(np.argmax(scores), scores.shape)
+        return names[t], int(z), float(scores[t, z])
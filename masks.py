@@ -0,0 +1,180 @@
+"""
+bit-packed binary masks
+
+a (H, W) bool mask takes one byte per pixel, PackedMask stores the same pixels
+as uint64 words (64 pixels per word, 8x smaller) so intersections are a word-wise
+AND and counts are a popcount.
+"""
+
+import collections
+import threading as tr
+import weakref
+
+import numpy as np
+
+from thePeckingOrder import scratch
+
+# popcount of every possible byte, fallback for numpy < 2.0 without np.bitwise_count
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount(words, axis=None):
+    """number of set bits in an unsigned integer array, summed over axis"""
+    if hasattr(np, 'bitwise_count'):
+        counts = np.bitwise_count(words, out=scratch.get('popcount', words.shape, np.uint8))
+    else:
+        as_bytes = np.ascontiguousarray(words).view(np.uint8)
+        counts = np.take(_POPCOUNT_TABLE, as_bytes, out=scratch.get('popcount', as_bytes.shape, np.uint8))
+        if axis is not None and words.dtype.itemsize != 1:
+            # viewing as bytes stretched the last axis
+            counts = counts.reshape(words.shape + (words.dtype.itemsize,)).sum(axis=-1)
+    return counts.sum(axis=axis, dtype=np.int64)
+
+
+def pack_plane(mask, n_words, out=None):
+    """flattens one (H, W) bool plane into n_words uint64 words, zero padded, into out if given"""
+    packed = np.packbits(np.ravel(mask))
+    if out is None:
+        out = np.empty(n_words, dtype=np.uint64)
+    out_bytes = out.view(np.uint8)
+    out_bytes[:packed.size] = packed
+    out_bytes[packed.size:] = 0
+    return out
+
+
+class PackedMask:
+    """
+    one mask (H, W) or a stack of masks (Z, H, W) packed into words (..., n_words)
+    masks are treated as immutable, so the popcount is computed once and kept
+    """
+    def __init__(self, words, shape, count=None):
+        """count: known popcount (e.g. stored alongside the words), skips computing it"""
+        self.words = words
+        self.shape = tuple(shape)
+        self._count = count
+
+    @staticmethod
+    def n_words(plane_shape):
+        return -(-int(np.prod(plane_shape)) // 64)
+
+    @classmethod
+    def from_bool(cls, mask):
+        mask = np.asarray(mask, dtype=bool)
+        if mask.ndim == 2:
+            return cls(pack_plane(mask, cls.n_words(mask.shape)), mask.shape)
+        return cls.from_planes(mask, mask.shape[1:])
+
+    @classmethod
+    def from_planes(cls, planes, plane_shape, n_planes=None):
+        """
+        packs an iterable of bool planes one at a time as they are produced, never holding the whole bool stack
+        n_planes: number of planes when planes has no len() (a generator), sizes the words up front,
+            otherwise they grow as needed
+        """
+        if n_planes is None and hasattr(planes, '__len__'):
+            n_planes = len(planes)
+        n_words = cls.n_words(plane_shape)
+        words = np.empty((n_planes or 8, n_words), dtype=np.uint64)
+        n = 0
+        for plane in planes:
+            if n == len(words):
+                words = np.concatenate([words, np.empty_like(words)])
+            pack_plane(plane, n_words, out=words[n])
+            n += 1
+        if n < len(words):
+            words = words[:n].copy()
+        return cls(words, (n,) + tuple(plane_shape))
+
+    @property
+    def plane_shape(self):
+        return self.shape[-2:]
+
+    @property
+    def nbytes(self):
+        return self.words.nbytes
+
+    def __len__(self):
+        return self.shape[0] if self.words.ndim == 2 else 1
+
+    def __getitem__(self, idx):
+        if self.words.ndim == 1:
+            raise TypeError('single PackedMask is not indexable')
+        words = self.words[idx]
+        return PackedMask(words, words.shape[:-1] + self.shape[1:])
+
+    def __and__(self, other):
+        return PackedMask(self.words & other.words, np.broadcast_shapes(self.shape, other.shape))
+
+    def __or__(self, other):
+        return PackedMask(self.words | other.words, np.broadcast_shapes(self.shape, other.shape))
+
+    def count(self):
+        """set pixels, an int for one mask or a (Z,) array for a stack"""
+        if self._count is None:
+            self._count = popcount(self.words, axis=-1)
+        return self._count
+
+    def _combined(self, ufunc, other):
+        """words of self ufunc other in a scratch buffer, for counting only"""
+        shape = np.broadcast_shapes(self.words.shape, other.words.shape)
+        return ufunc(self.words, other.words, out=scratch.get('combined_words', shape, np.uint64))
+
+    def intersection(self, other):
+        return popcount(self._combined(np.bitwise_and, other), axis=-1)
+
+    def union(self, other):
+        return popcount(self._combined(np.bitwise_or, other), axis=-1)
+
+    def dice(self, other):
+        totals = self.count() + other.count()
+        return 2.0 * self.intersection(other) / np.maximum(totals, 1)
+
+    def jaccard(self, other):
+        return self.intersection(other) / np.maximum(self.union(other), 1)
+
+    def unpack(self):
+        n_pixels = int(np.prod(self.plane_shape))
+        flat = np.unpackbits(self.words.view(np.uint8).reshape(self.words.shape[:-1] + (self.words.shape[-1] * 8,)), axis=-1)
+        return flat[..., :n_pixels].reshape(self.shape).astype(bool)
+
+
+class MaskCache:
+    """
+    small LRU of binarized masks keyed on the source array object
+
+    entries hold a weakref to the source image, a hit needs the very same array
+    to still be alive. images are assumed not to be modified in place once binarized,
+    which holds for the medians and frames this package passes around.
+    """
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._lock = tr.Lock()
+
+    def get(self, image, key, build):
+        cache_key = (id(image), key)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None and entry[0]() is image:
+                self._entries.move_to_end(cache_key)
+                return entry[1]
+
+        value = build(image)
+        try:
+            ref = weakref.ref(image)
+        except TypeError:
+            return value  # not weak-referenceable (lists etc), don't cache
+
+        with self._lock:
+            self._entries[cache_key] = (ref, value)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+TARGET_MASKS = MaskCache()
@@ -0,0 +1,136 @@
+"""
+similarity metrics for plane matching
+
+every metric scores one target (H, W) against a whole stack (Z, H, W) in a single
+vectorized pass and returns a (Z,) float array, higher is more similar.
+binary metrics expect boolean masks (see PlaneAlignment), the rest take raw intensities.
+"""
+
+import numpy as np
+
+from thePeckingOrder import scratch
+from thePeckingOrder.masks import PackedMask
+
+
+def _as_stack(stack):
+    stack = np.asarray(stack)
+    if stack.ndim == 2:
+        stack = stack[None]
+    return stack
+
+
+def _float_rows(stack):
+    """(Z, H*W) float64 copy of stack in a scratch buffer, free to modify in place"""
+    z = stack.shape[0]
+    rows = scratch.get('float_rows', (z, stack[0].size), np.float64)
+    np.copyto(rows, stack.reshape(z, -1))
+    return rows
+
+
+def _combined(ufunc, target, stack):
+    return ufunc(stack, target, out=scratch.get('combined_mask', stack.shape, bool))
+
+
+def dice(target, stack):
+    stack = _as_stack(stack)
+    intersection = np.count_nonzero(_combined(np.bitwise_and, target, stack), axis=(1, 2))
+    totals = np.count_nonzero(stack, axis=(1, 2)) + np.count_nonzero(target)
+    return 2.0 * intersection / np.maximum(totals, 1)
+
+
+def jaccard(target, stack):
+    stack = _as_stack(stack)
+    intersection = np.count_nonzero(_combined(np.bitwise_and, target, stack), axis=(1, 2))
+    union = np.count_nonzero(_combined(np.bitwise_or, target, stack), axis=(1, 2))
+    return intersection / np.maximum(union, 1)
+
+
+def packed_dice(target, stack):
+    """
+    dice on bit-packed masks: 64 pixels per word, AND + popcount instead of byte sums
+    takes PackedMask (preferred, see PlaneAlignment) or bool arrays which get packed here
+    """
+    if not isinstance(target, PackedMask):
+        target = PackedMask.from_bool(target)
+    if not isinstance(stack, PackedMask):
+        stack = PackedMask.from_bool(_as_stack(stack))
+    return np.atleast_1d(stack.dice(target))
+
+
+def ncc(target, stack):
+    """zero-mean normalized cross-correlation, in [-1, 1]"""
+    stack = _as_stack(stack)
+    z = stack.shape[0]
+    t = np.asarray(target, dtype=np.float64).ravel()
+    t = t - t.mean()
+    s = _float_rows(stack)
+    s -= s.mean(axis=1, keepdims=True)
+    num = s @ t
+    den = np.sqrt(np.einsum('ij,ij->i', s, s) * (t @ t))
+    return np.divide(num, den, out=np.zeros(z), where=den > 0)
+
+
+def _quantize(images, lo, hi, bins):
+    scaled = (np.asarray(images, dtype=np.float64) - lo) * (bins / np.maximum(hi - lo, np.finfo(float).eps))
+    return np.clip(scaled, 0, bins - 1).astype(np.intp)
+
+
+def mutual_information(target, stack, bins=32):
+    """
+    mutual information (nats) of the joint intensity histogram, one bincount for the whole stack
+    each plane is binned over its own range so a plane's score doesn't depend on its neighbours
+    """
+    stack = _as_stack(stack)
+    z = stack.shape[0]
+    t_idx = _quantize(target, np.min(target), np.max(target), bins).ravel()
+    s_idx = _quantize(stack, stack.min(axis=(1, 2), keepdims=True), stack.max(axis=(1, 2), keepdims=True),
+                      bins).reshape(z, -1)
+
+    joint_idx = s_idx * bins + t_idx + (np.arange(z) * bins * bins)[:, None]
+    joint = np.bincount(joint_idx.ravel(), minlength=z * bins * bins).reshape(z, bins, bins).astype(np.float64)
+    joint /= t_idx.size
+
+    p_s = joint.sum(axis=2, keepdims=True)
+    p_t = joint.sum(axis=1, keepdims=True)
+    outer = p_s * p_t
+    nz = joint > 0
+    terms = np.zeros_like(joint)
+    terms[nz] = joint[nz] * np.log(joint[nz] / outer[nz])
+    return terms.sum(axis=(1, 2))
+
+
+def ssim_lite(target, stack):
+    """
+    single-window ssim over the whole frame: luminance, contrast and structure terms
+    without the gaussian sliding window, so one reduction per plane
+    """
+    stack = _as_stack(stack)
+    z = stack.shape[0]
+    t = np.asarray(target, dtype=np.float64).ravel()
+    s = _float_rows(stack)
+
+    data_range = max(float(t.max() - t.min()), np.finfo(float).eps)
+    c1 = (0.01 * data_range) ** 2
+    c2 = (0.03 * data_range) ** 2
+
+    mu_t = t.mean()
+    mu_s = s.mean(axis=1)
+    t0 = t - mu_t
+    s -= mu_s[:, None]
+    var_t = t0 @ t0 / t.size
+    var_s = np.einsum('ij,ij->i', s, s) / t.size
+    cov = s @ t0 / t.size
+
+    return ((2 * mu_s * mu_t + c1) * (2 * cov + c2)) / ((mu_s ** 2 + mu_t ** 2 + c1) * (var_s + var_t + c2))
+
+
+# name: (function, expects binarized inputs)
+METRICS = {'dice': (dice, True),
+           'jaccard': (jaccard, True),
+           'dice_packed': (packed_dice, True),
+           'ncc': (ncc, False),
+           'mi': (mutual_information, False),
+           'ssim': (ssim_lite, False)}
+
+# binary metrics that take PackedMask inputs directly
+PACKED_METRICS = ('dice_packed',)
@@ -2,46 +2,156 @@ import logging
 
 import numpy as np
 
+from thePeckingOrder import backends, instrumentation, masks, metrics, scratch, tiles, workers
 from thePeckingOrder.filters import threshold_otsu
+from thePeckingOrder.target import Target
 
-logging.basicConfig(level=logging.DEBUG)  # NOTSET, DEBUG, INFO, WARNING
+log = logging.getLogger(__name__)
+
+# binary metrics the compiled backends compute straight from counts and intersections
+FUSED_METRICS = ('dice', 'dice_packed', 'jaccard')
 
 
 class PlaneAlignment:
-    def __init__(self, target, stack, method):
+    def __init__(self, target, stack, method, metric='dice_packed', roi=None, workers=None):
         approved_methods = {'mean': np.mean,
                             'otsu': threshold_otsu}
 
         assert(method in approved_methods.keys()), f'method must be approved method: {approved_methods.keys()}'
+        assert(metric in metrics.METRICS.keys()), f'metric must be approved metric: {metrics.METRICS.keys()}'
         self.binarize_method = approved_methods[method]
+        self.method = method
+        self.metric = metric
+        # roi.ROI restricting thresholding and similarity to the tissue
+        self.roi = None if roi is None or roi.is_full_frame else roi
+        # threads for per-plane work, from the shared pools in workers.py ('auto' = one per core)
+        self.workers = workers
 
         self.target_image = target
         self.image_stack = stack
 
-    def match_calculator(self):
-        binary_imgs = [image > self.binarize_method(image) for image in self.image_stack]
-        target_image = self.target_image > self.binarize_method(self.target_image)
+    def score_stack(self, target, stack, inclusive=False):
+        """
+        scores target (H, W) against every plane of stack (Z, H, W) with self.metric
+        binary metrics threshold each plane against its own binarize_method value
+        target can be a target.Target, whose cached mask/count/normalized image are used as is,
+        a plain array's mask is kept in masks.TARGET_MASKS so repeat alignments against it skip that
+        with an roi set everything only sees the pixels inside it
+        otsu + dice/jaccard go through the fused kernel when a compiled backend is active
+        """
+        metric_fxn, binary = metrics.METRICS[self.metric]
+        # a list of plane medians (what gather_stack returns) goes into a reused buffer
+        stack = scratch.stack('score_stack', stack) if isinstance(stack, (list, tuple)) else np.asarray(stack)
+        if stack.ndim == 2:
+            stack = stack[None]
+
+        restrict = self.roi.pixels if self.roi is not None else (lambda image: image)
+        roi_key = self.roi.key if self.roi is not None else None
+        stack = restrict(stack)
+
+        if isinstance(target, Target) and target.method != self.method:
+            target = target.image
+
+        if binary and self.method == 'otsu' and self.metric in FUSED_METRICS and backends.get_backend() != 'numpy':
+            return self._fused_scores(target, stack, inclusive, restrict, roi_key)
+
+        if binary:
+            packed = self.metric in metrics.PACKED_METRICS
+            compare = np.greater_equal if inclusive else np.greater
+
+            def binarize(image):
+                image = restrict(image)
+                mask = compare(image, self.binarize_method(image))
+                return masks.PackedMask.from_bool(mask) if packed else mask
+
+            with instrumentation.timer('binarize_seconds'):
+                if isinstance(target, Target):
+                    target = target.mask(inclusive, packed, self.roi)
+                else:
+                    target = masks.TARGET_MASKS.get(target, (self.method, inclusive, packed, roi_key), binarize)
+                stack = self._binarize_stack(stack, compare, packed)
+        elif isinstance(target, Target):
+            # ncc doesn't care about the target's offset and scale, the others do
+            target = target.normalized(self.roi) if self.metric == 'ncc' else target.restricted(self.roi)
+        else:
+            target = restrict(np.asarray(target))
+
+        with instrumentation.timer('similarity_seconds'):
+            if workers.resolve(self.workers) <= 1:
+                return metric_fxn(target, stack)
+            return np.concatenate(workers.pool_map(lambda n: metric_fxn(target, stack[n:n + 1]),
+                                                   range(len(stack)), self.workers))
+
+    def _binarize_stack(self, stack, compare, packed):
+        """
+        thresholds and binarizes every plane, one plane per task on the worker pool
+        the result lives in scratch buffers, it is only good until the next call from this thread
+        """
+        plane_shape = stack.shape[1:]
+        if packed:
+            n_words = masks.PackedMask.n_words(plane_shape)
+            out = scratch.get('binarized_words', (len(stack), n_words), np.uint64)
+        else:
+            out = scratch.get('binarized', stack.shape, bool)
+
+        def binarize_plane(n):
+            image = stack[n]
+            if packed:
+                # the worker thread's own bool plane
+                mask = compare(image, self.binarize_method(image), out=scratch.get('plane_mask', plane_shape, bool))
+                masks.pack_plane(mask, n_words, out=out[n])
+            else:
+                compare(image, self.binarize_method(image), out=out[n])
+
+        workers.pool_map(binarize_plane, range(len(stack)), self.workers)
+        return masks.PackedMask(out, stack.shape) if packed else out
+
+    def _fused_scores(self, target, stack, inclusive, restrict, roi_key):
+        compare = np.greater_equal if inclusive else np.greater
+
+        def binarize(image):
+            image = restrict(image)
+            return compare(image, self.binarize_method(image))
+
+        if isinstance(target, Target):
+            target_count = target.count(inclusive, self.roi)
+            target = target.mask(inclusive, False, self.roi)
+        else:
+            target = masks.TARGET_MASKS.get(target, (self.method, inclusive, False, roi_key), binarize)
+            target_count = np.count_nonzero(target)
+        with instrumentation.timer('fused_seconds'):
+            _, counts, intersections = backends.otsu_scores(target, stack, inclusive)
+        if self.metric == 'jaccard':
+            return intersections / np.maximum(counts + target_count - intersections, 1)
+        return 2.0 * intersections / np.maximum(counts + target_count, 1)
 
-        self.match_vals = []
-        for n, q in enumerate(binary_imgs):
-            accuracy = self.calculate_similarity(target_image, q)
-            logging.debug(f'image {n} is {accuracy} accurate')
-            self.match_vals.append(accuracy)
-        return np.where(self.match_vals == np.max(self.match_vals))[0][0]
+    def match_calculator(self):
+        self.match_vals = list(self.score_stack(self.target_image, self.image_stack))
+        for n, accuracy in enumerate(self.match_vals):
+            log.debug('image %d is %s accurate', n, accuracy)
+        return int(np.argmax(self.match_vals))
+
+    def local_z(self, grid=(4, 4), inclusive=False):
+        """
+        best plane per tile of a grid, the tilt through them and a robust global plane, see tiles.LocalZ
+        for binary metrics and ncc/ssim, with self.method, self.roi and self.workers
+        match_vals gets the whole-frame scores summed from the tiles, so match_calculator isn't needed too
+        """
+        result = tiles.local_z(self.target_image, self.image_stack, grid, self.metric, self.method, inclusive, self.roi,
+                               self.workers)
+        self.match_vals = list(result.frame_scores)
+        return result
 
     def match_val_returns(self):
         return self.match_vals
 
     def lossReturn(self):
-        binary_img = self.image_stack >= self.binarize_method(self.image_stack)
-        target_image = self.target_image >= self.binarize_method(self.target_image)
-        return self.calculate_similarity(target_image, binary_img)
-
+        return self.score_stack(self.target_image, self.image_stack, inclusive=True)[0]
 
     @staticmethod
     def calculate_similarity(pred, true, k=1):
-        # only works on binarized inputs
-        intersection = np.sum(pred[true==k]) * 2.0
+        # only works on binarized inputs, the selection is a scratch mask rather than a gathered copy
+        intersection = np.sum(pred, where=np.equal(true, k, out=scratch.get('similarity', np.shape(true), bool))) * 2.0
         dice = intersection / (np.sum(pred) + np.sum(true))
         return dice
 
@@ -0,0 +1,101 @@
+"""
+piezo move planning for stack acquisition
+
+every piezo move costs a RESET/move/RUN/RESET cycle plus settle sleeps, which dwarfs
+the travel itself. the planner picks the acquisition order over the requested planes
+with the least travel and settles, and the final correction is folded into the move
+that leaves the stack (see WalkyTalky.finish_stack) instead of returning home first.
+
+positions are plane indices relative to the target plane (0), multiply by the
+stack spacing for piezo steps.
+"""
+
+import itertools
+
+
+class Plan:
+    def __init__(self, order, start=0):
+        """order: plane indices in acquisition order, the first one is where we start"""
+        self.order = list(order)
+        self.start = start
+
+    @property
+    def moves(self):
+        """relative moves between consecutive planes, starting from self.start"""
+        positions = [self.start] + self.order
+        return [b - a for a, b in zip(positions[:-1], positions[1:])]
+
+    @property
+    def end(self):
+        return self.order[-1]
+
+    def __repr__(self):
+        return f'Plan({self.order})'
+
+
+class MoveSimulator:
+    def __init__(self, seconds_per_step=0.01, settle_seconds=3.2, acquire_seconds=0.0):
+        """
+        seconds_per_step: piezo travel time per plane of distance
+        settle_seconds: fixed cost of one move cycle, gather_stack sleeps ~3.2s around each move
+        acquire_seconds: time to collect one plane's reps
+        """
+        self.seconds_per_step = seconds_per_step
+        self.settle_seconds = settle_seconds
+        self.acquire_seconds = acquire_seconds
+
+    def move_cost(self, distance):
+        if distance == 0:
+            return 0.0
+        return abs(distance) * self.seconds_per_step + self.settle_seconds
+
+    def score(self, plan, correction=0, folded=True):
+        """
+        seconds spent moving, settling and acquiring for plan, ending at the target plane + correction
+        folded=False is the old behaviour: return home, then a separate correction move
+        """
+        total = sum(self.move_cost(move) for move in plan.moves)
+        total += self.acquire_seconds * len(plan.order)
+        if folded:
+            total += self.move_cost(correction - plan.end)
+        else:
+            total += self.move_cost(plan.start - plan.end) + self.move_cost(correction - plan.start)
+        return total
+
+
+class MovePlanner:
+    def __init__(self, simulator=None, max_exhaustive=7):
+        """
+        simulator: MoveSimulator used to score candidate orders
+        max_exhaustive: up to this many planes every order is tried, beyond that only the sweeps
+        """
+        self.simulator = simulator or MoveSimulator()
+        self.max_exhaustive = max_exhaustive
+
+    @staticmethod
+    def stack_offsets(n_planes):
+        """plane indices centred on the target, e.g. 5 -> [-2, -1, 0, 1, 2]"""
+        below = (n_planes - 1) // 2
+        return list(range(-below, n_planes - below))
+
+    def candidates(self, offsets, start=0):
+        rest = sorted(p for p in offsets if p != start)
+        head = [start] if start in offsets else []
+        above = [p for p in rest if p > start]
+        below = [p for p in rest if p < start][::-1]
+
+        # on a line the shortest tour is: nearer side first, then sweep out the other side
+        yield Plan(head + above + below, start)
+        yield Plan(head + below + above, start)
+
+        if len(rest) <= self.max_exhaustive:
+            for order in itertools.permutations(rest):
+                yield Plan(head + list(order), start)
+
+    def plan(self, offsets, start=0, expected_correction=0):
+        """cheapest acquisition order, scored by the simulator with the exit move folded in"""
+        return min(self.candidates(offsets, start), key=lambda plan: self.simulator.score(plan, expected_correction))
+
+
+# what gather_stack did before the planner: +1, +1, -3, -1 then home
+LEGACY_ORDER = [0, 1, 2, -1, -2]
@@ -1,90 +1,160 @@
-from planeAlignment import PlaneAlignment as pa
-from zmqComm import WalkyTalky as wt
+from thePeckingOrder import scratch
+from thePeckingOrder.adaptive import AdaptiveReps
+from thePeckingOrder.planeAlignment import PlaneAlignment as pa
+from thePeckingOrder.target import Target
+from thePeckingOrder.zmqComm import FrameWait, WalkyTalky as wt
 
+import logging
 import time
-import json
 
 import numpy as np
 import threading as tr
 
 
+log = logging.getLogger(__name__)
+
+
 class Protocol:
-    def __init__(self, port_info, stack_size=7, n_reps=3, z_size=2.0):
+    def __init__(self, port_info, stack_size=7, n_reps=3, z_size=2.0, method='otsu', metric='dice_packed', roi=None,
+                 workers=None, adaptive_reps=False, min_reps=2, rep_tolerance=0.01, tiles=None):
+        """
+        port_info: outputPort, inputIP, inputPort and optionally policy/hwm/encoding/quality_policy/frame_timeout/saturation_value
+            for the WalkyTalky
+        method, metric, roi, workers: passed on to PlaneAlignment
+        adaptive_reps, min_reps, rep_tolerance: stack planes take between min_reps and n_reps frames,
+            stopping once the best plane is stable, see adaptive.AdaptiveReps. the target always takes n_reps
+        tiles: (rows, cols) grid, correct to the plane of a tilt fit over tiles, see tiles.local_z
+        """
         self.running = True
-        self.comms = wt(port_info['outputPort'], port_info['inputIP'], port_info['inputPort'], port_info['savePath'], subTopic=b'frame')
-        self.aligner = pa(None, None, method='otsu')
+        self.comms = wt(port_info['outputPort'], port_info['inputIP'], port_info['inputPort'],
+                        policy=port_info.get('policy', 'bounded'), hwm=port_info.get('hwm'), preview=False,
+                        encoding=port_info.get('encoding'), quality_policy=port_info.get('quality_policy', 'off'),
+                        frame_timeout=port_info.get('frame_timeout', 3.0),
+                        saturation_value=port_info.get('saturation_value'))
+        self.aligner = pa(None, None, method=method, metric=metric, roi=roi, workers=workers)
 
         self.n_reps = n_reps
+        self.adaptive_reps = adaptive_reps
+        self.min_reps = min_reps
+        self.rep_tolerance = rep_tolerance
+        # AdaptiveReps of the last stack, its report() has the frames taken
+        self.rep_control = None
         self.stack_size = stack_size
+        self.tiles = tiles
         self.z_size = z_size
 
-        self.comms.pub.socket.send(b' ')
+        # zmq slow joiner: give labview a moment to connect before the first command
+        time.sleep(0.5)
+        self.comms.send(b' ')
+
+    def _move(self, amount):
+        """relative piezo move, frames after it aren't compared against the plane before for motion"""
+        self.comms.send(f'piezo: move_rel{amount:+g}')
+        self.comms.quality.reset()
+
+    def _collect(self, tag, adaptive=None):
+        """
+        waits for the n_reps frames labview tags `tag` and returns their median
+        frames the tracker knows were dropped count towards n_reps, so a lossy
+        stream gives a median over fewer frames instead of hanging or eating the next plane's.
+        a tail that never shows up (no new frame for comms.frame_timeout) is counted dropped too
+        with adaptive (adaptive.AdaptiveReps, its plane already started) frames are fed to it as they
+        arrive and the rest of the finite run is cancelled once it has enough
+        """
+        seen = 0
+        wait = FrameWait(self.comms.frame_timeout)
+        while self.running and self.comms.frames.accounted(tag) < self.n_reps:
+            accounted = self.comms.frames.accounted(tag)
+            if wait.expired(accounted):
+                self.comms.frames.mark_dropped(tag, self.n_reps - accounted)
+                break
+            if adaptive is not None:
+                images = self.comms.frames_tagged(tag)
+                done = False
+                while not done and seen < len(images):
+                    done = adaptive.add(images[seen])
+                    seen += 1
+                if done:
+                    # stop the rest of the finite run, the same way gather_stack does
+                    self.comms.send(b'RESET')
+                    return adaptive.finish_plane()
+            time.sleep(0.001)
+        images = self.comms.frames_tagged(tag)
+        if len(images) < self.n_reps:
+            log.warning('%s: %d of %d frames received and accepted', tag, len(images), self.n_reps)
+        if not images:
+            raise RuntimeError(f'every {tag} frame was dropped or rejected')
+        if adaptive is not None:
+            for image in images[seen:]:
+                adaptive.add(image)
+            return adaptive.finish_plane()
+        return scratch.median(images)
 
     def run_image_gathering(self):
 
-        ## at the moment this assumes wt only receives messages that includes images
         ## attempting to leverage the image finite samples feature to grab each relative chunk of data
-        ## gets n reps, waits til its received, repeats across stacksize
+        ## gets n reps of each plane under its own zmq tag, waits til they're accounted for, repeats across stacksize
         ## if more convienient for labview we can protocolize the whole thing and send in one go
-        ## important piece is getting the images in a list of order [Target0..TargetN, img1_0...img1_N,...imgN_N]
-
 
         ## f's2 p0 "100 (p1 "20(s3 s5? p3 "20){self.stack_size}){self.n_reps}'
         ## outMsg = f'setProtocol: s2 p0 "100(p1 "20(s3 s5? p3 "20){self.stack_size}){self.n_reps}'.encode()
 
-        outMsg = f'setProtocol: s2 p0 "100(p1 "20(s3 s5? p3 "20){self.stack_size}){self.n_reps}'.encode()
-        someRunMsg = b'RUN'
+        # clear old frames and counts
+        try:
+            self.comms.make_current()
+        except IndexError:
+            pass # here if already empty
+        self.comms.frames.reset()
 
-        # send someRunMsg
-        startCaring = True # start paying attention to the images going out from scope
-        # self.comms.messages = [] # reflush the list of messages
+        self.comms.send(f'scanner: run_finite{self.n_reps} zmq: target')
+        target = self._collect('target')
 
-        self.comms.pub.socket.send_string(f'scanner: run_finite{self.n_reps} zmq: target')
+        self.rep_control = None
+        if self.adaptive_reps:
+            self.rep_control = AdaptiveReps.for_alignment(self.aligner, Target(target, self.aligner.method),
+                                                          min_reps=self.min_reps, max_reps=self.n_reps,
+                                                          tolerance=self.rep_tolerance)
 
-        # wait and get the full stack
-        while not len(self.comms.messages) >= self.n_reps:
-            pass
-
-        self.comms.pub.socket.send_string(f'piezo: move_rel{-self.z_size*(self.stack_size//self.n_reps)}')
+        # stack runs from -stack_size//2 to +stack_size//2 planes around the target
+        start = -self.z_size * (self.stack_size // 2)
+        self._move(start)
 
+        stack = []
         for n in range(self.stack_size):
-            self.comms.pub.socket.send_string(f'scanner: run_finite{self.n_reps} zmq: frame_{n}')
-
-            while not len(self.comms.messages) >= (self.n_reps * (n + 2)):
-                pass
+            if self.rep_control is not None:
+                self.rep_control.start_plane(n)
+            self.comms.send(f'scanner: run_finite{self.n_reps} zmq: frame_{n}')
+            stack.append(self._collect(f'frame_{n}', self.rep_control))
+            self._move(self.z_size)
 
-            self.comms.pub.socket.send_string(f'piezo: move_rel+{self.z_size}')
+        # where the piezo sits now, relative to the target
+        position = start + self.z_size * self.stack_size
+        return target, stack, position
 
     def run_alignment(self):
-        self.run_image_gathering()
-        split_lists = list(self.divide_chunks(self.comms.messages, self.n_reps))
-
-        self.aligner.target_image = np.median(split_lists[0], axis=0)
-        self.aligner.image_stack = [np.median(split_lists[n], axis=0) for n in range(len(split_lists[1:]))]
-        self.aligner.match_calculator()
-
-        top_match = np.where(self.aligner.match_vals == np.max(self.aligner.match_vals))[0][0]
-
-        # img stack val between 0 - stack size
-        move_correction = (top_match - (self.stack_size//self.n_reps)) * self.z_size
-        if move_correction >= 0:
-            move_correction = '+' + str(move_correction)
+        target, stack, position = self.run_image_gathering()
+        if not self.running:
+            return
+        if self.rep_control is not None:
+            self.rep_control.log_report()
+
+        self.aligner.target_image = Target(target, self.aligner.method)
+        self.aligner.image_stack = stack
+        if self.tiles:
+            # one pass: the full-frame scores come from the tile sums
+            local = self.aligner.local_z(self.tiles)
+            log.info('local z: %r, full frame picked plane %d', local, local.frame_plane)
+            top_match = local.plane
         else:
-            move_correction = '-' + str(move_correction)
+            top_match = self.aligner.match_calculator()
 
-        self.comms.pub.socket.send_string(f'piezo: move_rel{move_correction}')
+        # img stack val between 0 - stack size, relative to the piezo's current position
+        move_correction = (top_match - self.stack_size // 2) * self.z_size - position
+        self._move(move_correction)
 
     def kill(self):
         self.running = False
-
-
-
-    @staticmethod
-    def divide_chunks(l, n):
-        # looping till length l
-        for i in range(0, len(l), n):
-            yield l[i:i + n]
-
+        self.comms.close()
 
 # both frame and time protocol will likely have to become part of stimulusBuddy
 
@@ -94,12 +164,21 @@ class FrameProtocol(Protocol):
         # update every n frames of imaging
         self.frame_threshold = frame_threshold
 
-        # check len(self.comms.messages)
+        self.sequence_thread = tr.Thread(target=self.sequencer)
+        self.sequence_thread.start()
+
+        # check len(self.comms.images)
     def sequencer(self):
         while self.running:
-            if len(self.comms.messages) >= self.frame_threshold:
+            if len(self.comms.images) >= self.frame_threshold:
                 self.run_alignment()
-                self.comms.messages = []
+                self.comms.make_current()
+            time.sleep(0.01)
+
+    def kill(self):
+        self.running = False
+        self.sequence_thread.join()
+        super().kill()
 
 
 class TimeProtocol(Protocol):
@@ -119,15 +198,17 @@ class TimeProtocol(Protocol):
             if curr_t - self.time_0 >= self.t_threshold:
                 self.run_alignment()
                 self.time_0 = curr_t
+            time.sleep(0.01)
 
     def kill(self):
-        super().kill()
+        self.running = False
         self.sequence_thread.join()
+        super().kill()
 
 
 if __name__ == '__main__':
     walky_info = {"outputPort" : 5555,
                 "inputPort" : 5556,
                 "inputIP" : '127.0.0.1',
-                  "savePath" : None}
+                  "policy" : 'bounded'}
     Protocol(walky_info)
@@ -0,0 +1,257 @@
+"""
+stimulus-coordination channel between the aligner and pstim
+
+the aligner asks pstim to pause before moving the piezo, pstim answers once the stimulus is
+paused, the aligner aligns and tells it to resume. nothing here blocks: request() sends and
+returns, poll() (from a Qt timer or any loop) picks up replies through a zmq.Poller and turns
+requests that went unanswered for `timeout` seconds into the fallback policy's decision.
+a pause that pstim confirms after its request was given up on is answered with an unpause
+straight away, nothing else would resume the stimulus.
+
+wire format, one two-part message per event, no pickles:
+    [b'alignment', b'pause 17']          aligner -> pstim, 17 is the request id
+    [b'stimbuddy', b'proceed 17']        pstim -> aligner, echoing the id
+    [b'alignment', b'unpause 0']         notifications carry id 0
+    [b'alignment', b'movement 0 -6']     an optional value after the id
+legacy=True speaks the old send_pyobj strings ('pause', 'proceed', 'movementAmount_-6') for a
+pstim that hasn't been updated, replies are then matched to the oldest open request.
+
+    channel = PstimChannel(pub_port=5015, sub_port=5016, timeout=5, fallback='skip')
+    channel.request('pause')
+    for event in channel.poll():        # PstimEvent(kind, msg_id, rtt, timed_out)
+        if event.kind == 'proceed': ...
+
+StandInPstim answers on localhost the way pstim does, with a configurable delay, for running
+and timing the channel without the stimulus rig.
+"""
+
+import collections
+import itertools
+import logging
+import pickle
+import threading as tr
+import time
+
+import numpy as np
+import zmq
+
+from thePeckingOrder import instrumentation, zmqComm
+
+
+log = logging.getLogger(__name__)
+
+REQUEST_TOPIC = b'alignment'
+REPLY_TOPIC = b'stimbuddy'
+
+# what a request that timed out turns into
+#   skip:    give up on this alignment, the caller tries again next round
+#   proceed: align anyway, for rigs where pstim is optional
+#   retry:   ask again, up to `retries` times, then skip
+FALLBACKS = ('skip', 'proceed', 'retry')
+
+PstimEvent = collections.namedtuple('PstimEvent', 'kind msg_id rtt timed_out')
+
+
+def encode_msg(kind, msg_id=0, value=None):
+    body = f'{kind} {msg_id}' if value is None else f'{kind} {msg_id} {value}'
+    return body.encode()
+
+
+def decode_msg(body):
+    """(kind, msg_id, value or None) from a message body, ValueError (or UnicodeDecodeError) if it isn't one"""
+    fields = body.decode().split(' ', 2)
+    return fields[0], int(fields[1]) if len(fields) > 1 else 0, fields[2] if len(fields) > 2 else None
+
+
+def _legacy_body(kind, value):
+    if kind == 'movement':
+        return pickle.dumps(f'movementAmount_{value}')
+    return pickle.dumps(kind)
+
+
+class PstimChannel:
+    def __init__(self, pub_port, sub_port, sub_ip=None, timeout=5.0, fallback='skip', retries=2, legacy=False):
+        """
+        pub_port: port requests are published on (pstim subscribes)
+        sub_port, sub_ip: where pstim publishes its replies
+        timeout: seconds a request waits for its reply before the fallback applies
+        fallback: one of FALLBACKS
+        legacy: pickled strings on the wire, for an old pstim
+        """
+        assert(fallback in FALLBACKS), f'fallback must be one of {FALLBACKS}'
+        self.pub = zmqComm.Publisher(pub_port)
+        self.sub = zmqComm.Subscriber(sub_port, ip=sub_ip)
+        self.poller = zmq.Poller()
+        self.poller.register(self.sub.socket, zmq.POLLIN)
+        self.timeout = timeout
+        self.fallback = fallback
+        self.retries = retries
+        self.legacy = legacy
+
+        self._ids = itertools.count(1)
+        # msg_id -> (kind, first sent, last sent, attempts)
+        self.pending = collections.OrderedDict()
+        # msg_id -> kind of requests given up on, the most recent ones, for replies that come too late
+        self.expired = collections.OrderedDict()
+        self.rtts = collections.deque(maxlen=1000)
+        self.timeouts = 0
+
+    def _send(self, kind, msg_id=0, value=None):
+        body = _legacy_body(kind, value) if self.legacy else encode_msg(kind, msg_id, value)
+        self.pub.socket.send_multipart([REQUEST_TOPIC, body])
+
+    def request(self, kind='pause'):
+        """sends a request that expects a reply, returns its id, poll() reports the outcome"""
+        msg_id = next(self._ids)
+        now = time.perf_counter()
+        self.pending[msg_id] = (kind, now, now, 1)
+        self._send(kind, msg_id)
+        return msg_id
+
+    def notify(self, kind, value=None):
+        """fire and forget, e.g. 'unpause' or ('movement', -6)"""
+        self._send(kind, 0, value)
+
+    def _receive(self, topic, body):
+        if topic != REPLY_TOPIC:
+            log.warning('%s: topic not understood', topic)
+            return None
+        # runs from the gui's Qt timer, a bad message is dropped rather than raised into Qt
+        try:
+            if body[:1] == b'\x80':
+                if not self.legacy:
+                    log.warning('ignoring pickled pstim message, use legacy=True for an old pstim')
+                    return None
+                kind = pickle.loads(body)
+                # replies carry no id, match the oldest open request, else the oldest given up on
+                msg_id = next(iter(self.pending), None) or next(iter(self.expired), None)
+            else:
+                kind, msg_id, _ = decode_msg(body)
+        except Exception:
+            log.warning('dropping malformed pstim message %r', body[:64], exc_info=True)
+            return None
+        if msg_id in self.expired:
+            requested = self.expired.pop(msg_id)
+            log.warning('pstim %s for %s #%s came after it was given up on', kind, requested, msg_id)
+            if requested == 'pause' and kind == 'proceed':
+                # pstim paused anyway and nobody is going to align for it, let it carry on
+                self.notify('unpause')
+            return None
+        if msg_id not in self.pending:
+            log.warning('pstim %s for unknown request %s', kind, msg_id)
+            return None
+        _, sent, _, _ = self.pending.pop(msg_id)
+        rtt = time.perf_counter() - sent
+        self.rtts.append(rtt)
+        instrumentation.observe('pstim_rtt_seconds', rtt)
+        return PstimEvent(kind, msg_id, rtt, False)
+
+    def _expire(self, now):
+        events = []
+        for msg_id, (kind, sent, last, attempts) in list(self.pending.items()):
+            if now - last < self.timeout:
+                continue
+            if self.fallback == 'retry' and attempts <= self.retries:
+                log.info('pstim did not answer %s #%d, asking again', kind, msg_id)
+                self.pending[msg_id] = (kind, sent, now, attempts + 1)
+                self._send(kind, msg_id)
+                continue
+            del self.pending[msg_id]
+            self.expired[msg_id] = kind
+            while len(self.expired) > 100:
+                self.expired.popitem(last=False)
+            self.timeouts += 1
+            instrumentation.inc('pstim_timeouts_total')
+            decision = 'proceed' if self.fallback == 'proceed' else 'skip'
+            log.warning('pstim did not answer %s #%d within %gs, %s', kind, msg_id, self.timeout, decision)
+            events.append(PstimEvent(decision, msg_id, now - sent, True))
+        return events
+
+    def poll(self, timeout=0):
+        """
+        replies that arrived and requests that timed out, as PstimEvents, waiting at most
+        timeout seconds for the first reply (0 returns straight away)
+        """
+        events = []
+        wait = int(timeout * 1000)
+        while dict(self.poller.poll(wait)).get(self.sub.socket) == zmq.POLLIN:
+            parts = self.sub.socket.recv_multipart()
+            if len(parts) == 2:
+                event = self._receive(*parts)
+                if event is not None:
+                    events.append(event)
+            else:
+                log.warning('pstim message with %d parts ignored', len(parts))
+            wait = 0
+        return events + self._expire(time.perf_counter())
+
+    def wait(self, msg_id, timeout=None):
+        """blocks until msg_id is answered or given up on, for scripts, not the gui thread"""
+        deadline = time.perf_counter() + (timeout if timeout is not None else self.timeout * (self.retries + 2))
+        while time.perf_counter() < deadline:
+            for event in self.poll(0.05):
+                if event.msg_id == msg_id:
+                    return event
+        return None
+
+    def latency(self):
+        """round-trip times seen so far: count, median, p95 and max in seconds"""
+        if not self.rtts:
+            return {'count': 0}
+        rtts = np.asarray(self.rtts)
+        return {'count': len(rtts), 'median': float(np.median(rtts)), 'p95': float(np.percentile(rtts, 95)),
+                'max': float(rtts.max())}
+
+    def close(self):
+        self.poller.unregister(self.sub.socket)
+        self.sub.kill()
+        self.pub.kill()
+
+
+class StandInPstim:
+    def __init__(self, listen_port, reply_port, delay=0.0, answer=True, legacy=False):
+        """
+        listen_port: the aligner's pub_port, reply_port: its sub_port
+        delay: seconds between a pause request and the reply
+        answer: False never replies, to exercise timeouts
+        legacy: pickled strings like the old pstim
+        """
+        self.delay = delay
+        self.answer = answer
+        self.legacy = legacy
+        self.received = []
+        self.paused = False
+
+        self.pub = zmqComm.Publisher(reply_port)
+        self.sub = zmqComm.Subscriber(listen_port)
+        self.running = True
+        self.thread = tr.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        poller = zmq.Poller()
+        poller.register(self.sub.socket, zmq.POLLIN)
+        while self.running:
+            if not poller.poll(100):
+                continue
+            topic, body = self.sub.socket.recv_multipart()
+            if self.legacy:
+                kind, msg_id = pickle.loads(body), 0
+            else:
+                kind, msg_id, _ = decode_msg(body)
+            self.received.append(kind)
+            if kind == 'pause':
+                self.paused = True
+                if self.answer:
+                    time.sleep(self.delay)
+                    reply = pickle.dumps('proceed') if self.legacy else encode_msg('proceed', msg_id)
+                    self.pub.socket.send_multipart([REPLY_TOPIC, reply])
+            elif kind == 'unpause':
+                self.paused = False
+        poller.unregister(self.sub.socket)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.sub.kill()
+        self.pub.kill()
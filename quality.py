@@ -0,0 +1,117 @@
+"""
+per-frame quality statistics, computed once when a frame arrives
+
+WalkyTalky assesses every received frame and keeps the FrameStats next to it, medians and
+alignment skip the frames the policy rejects: blank frames (shutter closed, laser off),
+saturated ones and frames that moved against the previous one (the fish twitched).
+
+    quality = FrameQuality('default')
+    stats = quality.assess(image)    # FrameStats(mean, max, saturated, sharpness, motion, rejected)
+    if stats.rejected: ...           # 'blank', 'saturated', 'motion' or '' when kept
+
+statistics come from every step-th row and column, so assessing a 512x512 frame costs about
+a tenth of a millisecond. blank and motion are judged against the recent frames (median of the
+last `window`) so no absolute intensity has to be configured.
+"""
+
+import collections
+import logging
+
+import numpy as np
+
+
+log = logging.getLogger(__name__)
+
+FrameStats = collections.namedtuple('FrameStats', 'mean max saturated sharpness motion rejected')
+
+# rejection thresholds, None turns a check off
+#   blank:      mean below this fraction of the recent median mean
+#   saturated:  more than this fraction of pixels at the saturation value
+#   motion:     change from the previous frame more than this many times the recent median change
+POLICIES = {'off': dict(blank=None, saturated=None, motion=None),
+            'default': dict(blank=0.2, saturated=0.05, motion=4.0),
+            'strict': dict(blank=0.5, saturated=0.01, motion=2.0)}
+
+
+class FrameQuality:
+    def __init__(self, policy='off', saturation_value=None, step=4, window=50, **thresholds):
+        """
+        policy: one of POLICIES, thresholds (blank=, saturated=, motion=) override its values
+        saturation_value: pixel value counted as saturated, the sensor's full scale (e.g. 4095). None for
+            the dtype's max on 8/16 bit frames and no saturation check on wider ones, which includes every
+            json frame (they decode to int64), so set it for labview's json stream
+        step: subsampling of the statistics
+        window: recent frames blank and motion are judged against
+        """
+        assert(policy in POLICIES.keys()), f'policy must be one of {POLICIES.keys()}'
+        unknown = set(thresholds) - set(POLICIES[policy])
+        assert(not unknown), f'unknown thresholds {unknown}'
+        self.policy = policy
+        self.thresholds = dict(POLICIES[policy], **thresholds)
+        self.saturation_value = saturation_value
+        self.step = step
+        self._means = collections.deque(maxlen=window)
+        self._motions = collections.deque(maxlen=window)
+        self._previous = {}  # tag -> last kept subsampled frame
+        self._moved = collections.Counter()  # tag -> motion rejections in a row
+        self._warned = False
+
+    def _saturation(self, dtype):
+        if self.saturation_value is not None:
+            return self.saturation_value
+        if dtype.kind in 'iu' and dtype.itemsize <= 2:
+            return np.iinfo(dtype).max
+        if self.thresholds['saturated'] is not None and not self._warned:
+            self._warned = True
+            log.warning('no saturation_value for %s frames, saturated frames are not rejected', dtype)
+        return None
+
+    def assess(self, image, tag='frame'):
+        """
+        FrameStats of image, updating the recent history it is judged against
+        motion is measured against the last kept frame of the same tag, after a few motion
+        rejections in a row the sample has really moved and the newest frame becomes the reference
+        """
+        sample = np.asarray(image)[::self.step, ::self.step]
+        values = sample.astype(np.float32)
+        mean = float(values.mean())
+        saturation = self._saturation(sample.dtype)
+        saturated = float(np.count_nonzero(sample >= saturation)) / sample.size if saturation is not None else 0.0
+        # mean absolute horizontal gradient relative to brightness, falls with blur
+        sharpness = float(np.abs(np.diff(values, axis=1)).mean()) / max(mean, 1e-9)
+        previous = self._previous.get(tag)
+        motion = 0.0
+        if previous is not None and previous.shape == values.shape:
+            motion = float(np.abs(values - previous).mean()) / max(mean, 1e-9)
+
+        rejected = self._reject(mean, saturated, motion)
+        self._moved[tag] = self._moved[tag] + 1 if rejected == 'motion' else 0
+        # rejected frames would drag the baselines towards themselves
+        if not rejected or self._moved[tag] > 3:
+            self._previous[tag] = values
+        if rejected != 'blank':
+            self._means.append(mean)
+        if previous is not None and not rejected:
+            self._motions.append(motion)
+        return FrameStats(mean, float(values.max()), saturated, sharpness, motion, rejected)
+
+    def _reject(self, mean, saturated, motion):
+        thresholds = self.thresholds
+        if thresholds['blank'] is not None and self._means and mean < thresholds['blank'] * np.median(self._means):
+            return 'blank'
+        if thresholds['saturated'] is not None and saturated > thresholds['saturated']:
+            return 'saturated'
+        if (thresholds['motion'] is not None and len(self._motions) >= 3
+                and motion > thresholds['motion'] * np.median(self._motions)):
+            return 'motion'
+        return ''
+
+    def reset(self):
+        """forget the previous frames, e.g. after moving to another plane"""
+        self._previous = {}
+        self._moved.clear()
+
+
+def accepted(images, stats):
+    """the images whose stats weren't rejected"""
+    return [image for image, s in zip(images, stats) if not s.rejected]
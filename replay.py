@@ -0,0 +1,172 @@
+"""
+stand-in for the labview side, for running without a scope
+
+ReplayPublisher plays recorded frames back in labview's wire format
+(b'tag seq HH:MM:SS.ffffff: [[...]]') on the port WalkyTalky subscribes to, and listens
+to the commands WalkyTalky sends: 'scanner: run_finite{n} zmq: {tag}' is answered with
+n frames tagged tag (what Protocol waits on), otherwise frames stream continuously as 'frame'.
+RESET drops whatever is left of finite runs, as adaptive reps cut them short.
+'encoding: {name}' (WalkyTalky.request_encoding) switches the payloads to frames.FrameEncoder's
+binary encodings, json is labview's own.
+
+    frames = replay.record(4701, 'tcp://10.122.170.21:', n_frames=500)   # off the real scope
+    replay.save_frames('session.npy', frames)
+    ReplayPublisher(replay.load_frames('session.npy'), port=4701, command_port=5005)
+
+frames are recorded before WalkyTalky's crop, so replays go through the same crop.
+"""
+
+import collections
+import json
+import logging
+import re
+import threading as tr
+import time
+
+from datetime import datetime as dt
+
+import numpy as np
+import zmq
+
+from thePeckingOrder import zmqComm
+from thePeckingOrder import frames as _frames  # ReplayPublisher's frames argument shadows the module
+from thePeckingOrder.roi import ROI
+
+
+log = logging.getLogger(__name__)
+
+_RUN_FINITE = re.compile(r'scanner: run_finite(\d+) zmq: (\S+)')
+_ENCODING = re.compile(r'encoding: (\S+)')
+_STOP = b'RESET'
+
+
+def encode_frame(image, tag='frame', seq=0, timestamp=None, encoder=None):
+    """one labview-style frame message, the payload from encoder (a frames.FrameEncoder) if given"""
+    timestamp = timestamp or dt.now().time()
+    header = f'{tag} {seq} {timestamp.strftime("%H:%M:%S.%f")} replay'
+    if encoder is None or encoder.encoding == 'json':
+        payload = json.dumps(np.asarray(image).tolist()).encode()
+    else:
+        payload = encoder.encode(image, tag)
+    return header.encode() + b': ' + payload
+
+
+def save_frames(path, frames):
+    np.save(path, np.asarray(frames))
+
+
+def load_frames(path):
+    """(N, H, W) frames from .npy (memory-mapped) or the first array of an .npz"""
+    if str(path).endswith('.npz'):
+        with np.load(path) as data:
+            return data[data.files[0]]
+    return np.load(path, mmap_mode='r')
+
+
+def record(port, ip=None, n_frames=100, timeout=60):
+    """subscribes to a live labview stream and returns n_frames uncropped frames"""
+    sub = zmqComm.Subscriber(port=port, ip=ip)
+    sub.socket.setsockopt(zmq.RCVTIMEO, int(timeout * 1000))
+    decoder = _frames.FrameDecoder()
+    recorded = []
+    try:
+        while len(recorded) < n_frames:
+            image = zmqComm.decode_frame(sub.socket.recv(), ROI(), decoder)[3]
+            if image is not None:
+                recorded.append(image)
+    finally:
+        sub.kill()
+    return np.asarray(recorded)
+
+
+class ReplayPublisher:
+    def __init__(self, frames, port, command_port=None, command_ip=None, fps=10.0, loop=True, encoding='json',
+                 keyframe_interval=10):
+        """
+        frames: (N, H, W) recorded frames, see load_frames
+        port: port to publish frames on, WalkyTalky's inputPort
+        command_port: WalkyTalky's outputPort to take commands from, None to only stream
+        fps: frame rate for both streamed and finite frames
+        loop: start over at the end of the recording, otherwise stop streaming there
+        encoding: payload encoding to start with, one of frames.encodings(), 'encoding:' commands change it
+        keyframe_interval: see frames.FrameEncoder
+        """
+        self.frames = frames
+        self.fps = fps
+        self.loop = loop
+        self.keyframe_interval = keyframe_interval
+        self.encoder = _frames.FrameEncoder(encoding, keyframe_interval)
+
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.PUB)
+        self.socket.bind(f'tcp://*:{port}')
+
+        self.commands = None
+        if command_port is not None:
+            self.commands = zmqComm.Subscriber(port=command_port, ip=command_ip)
+
+        self.sent = 0
+        self.received_commands = []
+        self._position = 0
+        self._seq = collections.Counter()
+        self._finite = collections.deque()  # tags still owed by run_finite commands
+
+        self.running = True
+        self.thread = tr.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        log.info('replaying %d frames on port %s at %g fps', len(frames), port, fps)
+
+    def _next_frame(self):
+        if self._position >= len(self.frames):
+            if not self.loop:
+                return None
+            self._position = 0
+        image = self.frames[self._position]
+        self._position += 1
+        return image
+
+    def _handle(self, command):
+        self.received_commands.append(command)
+        if command.strip() == _STOP:
+            self._finite.clear()
+            return
+        match = _RUN_FINITE.search(command.decode(errors='ignore'))
+        if match:
+            self._finite.extend([match.group(2)] * int(match.group(1)))
+            return
+        match = _ENCODING.search(command.decode(errors='ignore'))
+        if match:
+            if match.group(1) in _frames.encodings():
+                self.encoder = _frames.FrameEncoder(match.group(1), self.keyframe_interval)
+                log.info('switched to %s frames', match.group(1))
+            else:
+                log.warning('encoding %s not available, staying on %s', match.group(1), self.encoder.encoding)
+
+    def _run(self):
+        period = 1.0 / self.fps
+        next_t = time.perf_counter()
+        while self.running:
+            # commands until the next frame is due
+            timeout = max(next_t - time.perf_counter(), 0)
+            if self.commands is not None:
+                if self.commands.socket.poll(int(timeout * 1000)):
+                    self._handle(self.commands.socket.recv())
+                    continue
+            else:
+                time.sleep(timeout)
+
+            tag = self._finite.popleft() if self._finite else 'frame'
+            image = self._next_frame()
+            if image is not None:
+                self.socket.send(encode_frame(image, tag, self._seq[tag], encoder=self.encoder))
+                self._seq[tag] += 1
+                self.sent += 1
+            next_t += period
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        if self.commands is not None:
+            self.commands.kill()
+        self.socket.close()
+        self.context.term()
@@ -0,0 +1,169 @@
+"""
+several scopes driven from one process
+
+each rig keeps its own WalkyTalky and Karen, what they share is held here: one zmq context (one
+io thread instead of one per socket pair), the workers pools (shared per size already, every rig
+gets the same `workers` so they land on the same pool), and a ComputeScheduler that lets one
+alignment at a time score its stack, so rigs whose alignments come due together take turns on the
+cores instead of slowing each other down. stack gathering is scope time and isn't scheduled.
+
+    controller = RigController(compute_slots=1, workers='auto')
+    controller.add_rig('rig1', 5005, 'tcp://10.122.170.21:', 4701, nplanes=5, align_t=450)
+    controller.add_rig('rig2', 5007, 'tcp://10.122.170.22:', 4701, nplanes=5, align_t=450)
+    controller.spread_alignments()    # rig2's first alignment half an align_t after rig1's
+    controller.status()               # per rig frames, drops, lag, alignments
+    instrumentation.serve_prometheus(9102, registry=controller)    # metrics with a rig label
+    controller.stop()
+
+the runner builds one from [[rigs]] tables, see runner.py.
+"""
+
+import collections
+import contextlib
+import logging
+import threading as tr
+import time
+
+import zmq
+
+from thePeckingOrder import instrumentation, zmqComm
+
+
+log = logging.getLogger(__name__)
+
+
+class ComputeScheduler:
+    """
+    at most `slots` holders at once, the rest wait in arrival order
+    Karen takes a slot around its stack scoring, see volumetric.Karen
+    """
+    def __init__(self, slots=1):
+        assert(slots >= 1), 'need at least one compute slot'
+        self.slots = slots
+        self.busy = 0
+        self.peak = 0
+        self.waits = collections.deque(maxlen=1000)
+        self._queue = collections.deque()
+        self._cond = tr.Condition()
+
+    @contextlib.contextmanager
+    def slot(self, metrics=None):
+        """blocks until a slot is free, yields the seconds waited, metrics gets compute_wait_seconds"""
+        ticket = object()
+        t0 = time.perf_counter()
+        with self._cond:
+            self._queue.append(ticket)
+            while self._queue[0] is not ticket or self.busy >= self.slots:
+                self._cond.wait()
+            self._queue.popleft()
+            self.busy += 1
+            self.peak = max(self.peak, self.busy)
+            # the next in line may fit in another free slot
+            self._cond.notify_all()
+        wait = time.perf_counter() - t0
+        self.waits.append(wait)
+        (metrics if metrics is not None else instrumentation.REGISTRY).observe('compute_wait_seconds', wait)
+        try:
+            yield wait
+        finally:
+            with self._cond:
+                self.busy -= 1
+                self._cond.notify_all()
+
+
+class Rig:
+    def __init__(self, name, wt, metrics, app=None):
+        """one scope: its zmqComm.WalkyTalky, instrumentation.Registry and volumetric.Karen (None for comms only)"""
+        self.name = name
+        self.wt = wt
+        self.metrics = metrics
+        self.app = app
+
+    def status(self):
+        frames = self.wt.frames
+        status = {'received': sum(frames.received.values()), 'dropped': sum(frames.dropped.values()),
+                  'lag': frames.lag, 'buffered': len(self.wt.images), 'encoding': self.wt.encoding}
+        if self.app is not None:
+            status.update(target=self.app.targetAcquired, aligning=self.app.aligning,
+                          since_alignment=time.time() - self.app.lastAlignedTime)
+        return status
+
+    def close(self):
+        if self.app is not None:
+            self.app.stop()
+        self.wt.close()
+
+
+class RigController:
+    def __init__(self, compute_slots=1, workers='auto', metrics=True, linger=1.0):
+        """
+        compute_slots: alignments allowed to score at the same time, 1 gives each the whole pool
+        workers: threads for stack scoring, the same for every rig so they share one pool
+        metrics: record each rig's metrics in a registry of its own, labelled with the rig name
+        linger: seconds a closing socket may spend on unsent messages, so stop() can't hang on a
+            scope that went away
+        """
+        self.context = zmq.Context()
+        self.context.setsockopt(zmq.LINGER, int(linger * 1000))
+        self.scheduler = ComputeScheduler(compute_slots)
+        self.workers = workers
+        self.metrics_enabled = metrics
+        self.rigs = collections.OrderedDict()
+
+    def _registry(self, name):
+        assert(name not in self.rigs), f'rig {name!r} already added'
+        return instrumentation.Registry(enabled=self.metrics_enabled, labels={'rig': name})
+
+    def add_walky_talky(self, name, outputPort, inputIP, inputPort, **options):
+        """
+        a rig with comms only, for scripts that drive their own alignment
+        options: zmqComm.WalkyTalky keywords, preview defaults to off
+        """
+        metrics = self._registry(name)
+        options.setdefault('preview', False)
+        wt = zmqComm.WalkyTalky(outputPort, inputIP, inputPort, context=self.context, metrics=metrics, **options)
+        self.rigs[name] = Rig(name, wt, metrics)
+        log.info('rig %s on %s%s', name, inputIP, inputPort)
+        return self.rigs[name]
+
+    def add_rig(self, name, outputPort, inputIP, inputPort, nplanes=5, align_t=450, wt_options=None, **options):
+        """
+        a rig running volumetric.Karen, which starts straight away
+        wt_options: zmqComm.WalkyTalky keywords, options: Karen keywords
+        """
+        from thePeckingOrder import volumetric
+
+        rig = self.add_walky_talky(name, outputPort, inputIP, inputPort, **(wt_options or {}))
+        options.setdefault('workers', self.workers)
+        rig.app = volumetric.Karen(rig.wt, nplanes, align_t, scheduler=self.scheduler, metrics=rig.metrics, **options)
+        return rig
+
+    def spread_alignments(self):
+        """delays each rig's next alignment by an even share of its align_t, so they don't all come due at once"""
+        apps = [rig.app for rig in self.rigs.values() if rig.app is not None]
+        for n, app in enumerate(apps):
+            app.lastAlignedTime += n * app.alignTimeThresh / len(apps)
+
+    def status(self):
+        """{rig: its Rig.status()}, plus the scheduler under 'compute'"""
+        status = {name: rig.status() for name, rig in self.rigs.items()}
+        waits = sorted(self.scheduler.waits)
+        status['compute'] = {'slots': self.scheduler.slots, 'busy': self.scheduler.busy, 'peak': self.scheduler.peak,
+                             'max_wait': waits[-1] if waits else 0.0}
+        return status
+
+    def snapshot(self):
+        """{rig: its metrics}, the process-wide ones under 'process'"""
+        snapshot = {name: rig.metrics.snapshot() for name, rig in self.rigs.items()}
+        snapshot['process'] = instrumentation.snapshot()
+        return snapshot
+
+    def render_prometheus(self):
+        registries = [instrumentation.REGISTRY] + [rig.metrics for rig in self.rigs.values()]
+        return instrumentation.render_registries(registries)
+
+    def stop(self):
+        for rig in self.rigs.values():
+            rig.close()
+        self.context.term()
+        log.info('stopped %d rigs', len(self.rigs))
@@ -0,0 +1,77 @@
+"""
+regions of interest
+
+an ROI is a rectangle in (row, col) pixel coordinates, optionally with a bool mask
+inside it for irregular tissue outlines. rectangles crop by slicing, so applying one
+is a view and costs nothing regardless of frame size.
+"""
+
+import numpy as np
+
+
+class ROI:
+    def __init__(self, rows=(None, None), cols=(None, None), mask=None):
+        """
+        rows, cols: (start, stop) like a slice, None for open ends
+        mask: optional bool array the shape of the rectangle, True inside the region
+        """
+        self.rows = slice(*rows)
+        self.cols = slice(*cols)
+        self.mask = None if mask is None else np.asarray(mask, dtype=bool)
+
+    @classmethod
+    def from_mask(cls, mask):
+        """ROI over the bounding box of a full-frame bool mask"""
+        mask = np.asarray(mask, dtype=bool)
+        rows = np.flatnonzero(mask.any(axis=1))
+        cols = np.flatnonzero(mask.any(axis=0))
+        if rows.size == 0:
+            raise ValueError('mask is empty')
+        r0, r1, c0, c1 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+        crop = mask[r0:r1, c0:c1]
+        return cls((r0, r1), (c0, c1), mask=None if crop.all() else crop)
+
+    @classmethod
+    def from_slices(cls, slices):
+        """ROI from a (row slice, col slice) pair, e.g. pyqtgraph ROI.getArraySlice"""
+        rows, cols = slices[-2:]
+        return cls((rows.start, rows.stop), (cols.start, cols.stop))
+
+    @property
+    def key(self):
+        """hashable description, used to key cached target masks"""
+        mask_key = None if self.mask is None else (self.mask.shape, hash(np.packbits(self.mask).tobytes()))
+        return (self.rows.start, self.rows.stop, self.cols.start, self.cols.stop, mask_key)
+
+    @property
+    def is_full_frame(self):
+        return self.key == (None, None, None, None, None)
+
+    def apply(self, image):
+        """zero-copy crop of (..., H, W) to the rectangle"""
+        return image[..., self.rows, self.cols]
+
+    def pixels(self, image):
+        """
+        what alignment should look at: the cropped view for a rectangle,
+        or the masked pixels as a (..., 1, N) array when a mask is set
+        """
+        crop = self.apply(np.asarray(image))
+        if self.mask is None:
+            return crop
+        return crop[..., self.mask][..., None, :]
+
+    def area(self, frame_shape):
+        if self.mask is not None:
+            return int(np.count_nonzero(self.mask))
+        h = len(range(*self.rows.indices(frame_shape[0])))
+        w = len(range(*self.cols.indices(frame_shape[1])))
+        return h * w
+
+    def __repr__(self):
+        masked = '' if self.mask is None else f', mask={int(np.count_nonzero(self.mask))}px'
+        return f'ROI(rows={self.rows.start}:{self.rows.stop}, cols={self.cols.start}:{self.cols.stop}{masked})'
+
+
+# the column crop WalkyTalky has always applied to labview frames
+LABVIEW_CROP = ROI(cols=(32, None))
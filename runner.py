@@ -0,0 +1,359 @@
+"""
+headless runner: python -m thePeckingOrder run --config rig.toml [--replay frames.npy]
+
+starts Karen (mode = "volumetric") or a Protocol ("protocol" runs one alignment, "time" and
+"frame" keep re-aligning) from a config file, without Qt, and shuts everything down on ctrl-c.
+with --replay a replay.ReplayPublisher stands in for labview on localhost, for repeatable runs.
+
+    mode = "volumetric"
+
+    [comms]
+    output_port = 5005
+    input_ip = "tcp://10.122.170.21:"
+    input_port = 4701
+    policy = "bounded"          # zmqComm.SUB_POLICIES
+    # hwm = 1000
+    # encoding = "delta+zlib"   # frames.encodings(), left out labview stays on json
+    quality = "off"             # quality.POLICIES, frames medians and stacks leave out
+    # saturation_value = 4095   # sensor full scale, json frames are int64 so quality can't tell it otherwise
+
+    [alignment]
+    method = "otsu"
+    metric = "dice_packed"
+    workers = "auto"
+    backend = "auto"
+    # roi = [0, 512, 0, 480]
+    # library = "~/targets"
+    # target = "fish3_plane2"
+    # drift_log = "drift.bin"
+    adaptive_reps = false       # stop a plane early once the best plane is stable, see adaptive.py
+    min_reps = 2
+    rep_tolerance = 0.01
+    # tiles = [4, 4]            # plane from a tilt fit over tiles, see tiles.py
+
+    [volumetric]
+    nplanes = 5
+    align_t = 450
+
+    [protocol]
+    stack_size = 7
+    n_reps = 3
+    z_size = 2.0
+    t_threshold = 600
+    frame_threshold = 1000
+
+    [instrumentation]
+    enabled = true
+    # prometheus_port = 9102
+    # json_path = "metrics.json"
+
+    [replay]
+    fps = 10.0
+    loop = true
+    keyframe_interval = 10
+
+several scopes from one process (volumetric mode): one [[rigs]] table per scope, each a name
+plus whatever [comms], [alignment] and [volumetric] options differ from those sections. they run
+under a rigs.RigController, sharing its zmq context, worker pools and compute slots.
+
+    [controller]
+    compute_slots = 1           # alignments scoring at once across rigs
+    spread = true               # stagger the rigs' alignment times
+
+    [[rigs]]
+    name = "rig1"
+    input_port = 4701
+    output_port = 5005
+
+    [[rigs]]
+    name = "rig2"
+    input_ip = "tcp://10.122.170.22:"
+    input_port = 4701
+    output_port = 5007
+    target = "fish5_plane3"
+
+with --replay every rig gets its own replay of the same frames on its ports.
+
+`python -m thePeckingOrder record --config rig.toml --out frames.npy --n 500` records frames to replay.
+anything left out falls back to DEFAULTS. json configs work too.
+"""
+
+import argparse
+import copy
+import json
+import logging
+import signal
+import sys
+import threading as tr
+
+try:
+    import tomllib
+except ImportError:
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+
+log = logging.getLogger(__name__)
+
+MODES = ('volumetric', 'protocol', 'time', 'frame')
+
+DEFAULTS = {
+    'mode': 'volumetric',
+    'comms': {'output_port': 5005, 'input_ip': 'tcp://10.122.170.21:', 'input_port': 4701,
+              'policy': 'bounded', 'hwm': None, 'encoding': None, 'quality': 'off',
+              'saturation_value': None},
+    'alignment': {'method': 'otsu', 'metric': 'dice_packed', 'workers': None, 'backend': None,
+                  'roi': None, 'library': None, 'target': None, 'drift_log': None, 'adaptive_reps': False,
+                  'min_reps': 2, 'rep_tolerance': 0.01, 'tiles': None},
+    'volumetric': {'nplanes': 5, 'align_t': 450},
+    'protocol': {'stack_size': 7, 'n_reps': 3, 'z_size': 2.0, 't_threshold': 600, 'frame_threshold': 1000},
+    'instrumentation': {'enabled': False, 'prometheus_port': None, 'json_path': None, 'json_interval': 10.0},
+    'replay': {'fps': 10.0, 'loop': True, 'keyframe_interval': 10},
+    'controller': {'compute_slots': 1, 'spread': True},
+    'rigs': [],
+}
+
+# what a [[rigs]] table may override, the backend is process-wide
+RIG_SECTIONS = ('comms', 'alignment', 'volumetric')
+
+
+def load_config(path=None):
+    """DEFAULTS overlaid with the sections of a .toml or .json file"""
+    config = copy.deepcopy(DEFAULTS)
+    if path is None:
+        return config
+
+    if str(path).endswith('.json'):
+        with open(path) as f:
+            loaded = json.load(f)
+    else:
+        if tomllib is None:
+            raise ImportError('reading toml configs needs python 3.11+ or pip install tomli')
+        with open(path, 'rb') as f:
+            loaded = tomllib.load(f)
+
+    for key, value in loaded.items():
+        if key not in config:
+            raise ValueError(f'unknown config section {key!r}, have {list(config)}')
+        if isinstance(config[key], dict):
+            unknown = set(value) - set(config[key])
+            if unknown:
+                raise ValueError(f'unknown [{key}] options {sorted(unknown)}')
+            config[key].update(value)
+        else:
+            config[key] = value
+
+    if config['mode'] not in MODES:
+        raise ValueError(f'mode must be one of {MODES}')
+    if config['rigs']:
+        if config['mode'] != 'volumetric':
+            raise ValueError('[[rigs]] needs mode = "volumetric"')
+        allowed = {'name'}.union(*(DEFAULTS[section] for section in RIG_SECTIONS)) - {'backend'}
+        names = [rig.get('name') for rig in config['rigs']]
+        if None in names or len(set(names)) != len(names):
+            raise ValueError('every [[rigs]] table needs a unique name')
+        for rig in config['rigs']:
+            unknown = set(rig) - allowed
+            if unknown:
+                raise ValueError(f'unknown [[rigs]] options {sorted(unknown)} for {rig["name"]}')
+    return config
+
+
+def rig_config(config, rig):
+    """the [comms], [alignment] and [volumetric] sections with a [[rigs]] table's overrides"""
+    sections = {section: {key: rig.get(key, value) for key, value in config[section].items()}
+                for section in RIG_SECTIONS}
+    sections['name'] = rig['name']
+    return sections
+
+
+class Runner:
+    def __init__(self, config, replay_path=None):
+        self.config = config
+        self.replay_path = replay_path
+        self.stopped = tr.Event()
+        self.replays = []
+        self.app = None
+        self.controller = None
+        self._dumper = None
+
+    def _setup_instrumentation(self, registry=None):
+        from thePeckingOrder import instrumentation
+
+        options = self.config['instrumentation']
+        if not options['enabled']:
+            return
+        registry = registry or instrumentation.REGISTRY
+        instrumentation.enable()
+        if options['prometheus_port']:
+            instrumentation.serve_prometheus(options['prometheus_port'], registry=registry)
+        if options['json_path']:
+            self._dumper = instrumentation.JsonDumper(options['json_path'], options['json_interval'], registry)
+
+    def _comms(self, comms):
+        comms = dict(comms)
+        if self.replay_path is not None:
+            from thePeckingOrder import replay
+
+            comms['input_ip'] = 'tcp://127.0.0.1:'
+            self.replays.append(replay.ReplayPublisher(replay.load_frames(self.replay_path), port=comms['input_port'],
+                                                       command_port=comms['output_port'],
+                                                       command_ip='tcp://127.0.0.1:', **self.config['replay']))
+        return comms
+
+    @staticmethod
+    def _karen_options(alignment, alignROI):
+        from thePeckingOrder import library
+
+        targetLibrary = library.TargetLibrary(alignment['library']) if alignment['library'] else None
+        return dict(roi=alignROI, library=targetLibrary, target_name=alignment['target'], workers=alignment['workers'],
+                    drift_path=alignment['drift_log'], method=alignment['method'], metric=alignment['metric'],
+                    adaptive_reps=alignment['adaptive_reps'], min_reps=alignment['min_reps'],
+                    rep_tolerance=alignment['rep_tolerance'], tiles=alignment['tiles'])
+
+    @staticmethod
+    def _roi(alignment):
+        from thePeckingOrder import roi
+
+        return roi.ROI(alignment['roi'][:2], alignment['roi'][2:]) if alignment['roi'] else None
+
+    @staticmethod
+    def _wt_options(comms):
+        return dict(policy=comms['policy'], hwm=comms['hwm'], preview=False, encoding=comms['encoding'],
+                    quality_policy=comms['quality'], saturation_value=comms['saturation_value'])
+
+    def _start_rigs(self):
+        from thePeckingOrder import rigs
+
+        options = self.config['controller']
+        self.controller = rigs.RigController(compute_slots=options['compute_slots'],
+                                             workers=self.config['alignment']['workers'],
+                                             metrics=self.config['instrumentation']['enabled'])
+        self._setup_instrumentation(self.controller)
+        for rig in self.config['rigs']:
+            sections = rig_config(self.config, rig)
+            comms, alignment = self._comms(sections['comms']), sections['alignment']
+            self.controller.add_rig(sections['name'], comms['output_port'], comms['input_ip'], comms['input_port'],
+                                    nplanes=sections['volumetric']['nplanes'],
+                                    align_t=sections['volumetric']['align_t'], wt_options=self._wt_options(comms),
+                                    **self._karen_options(alignment, self._roi(alignment)))
+        if options['spread']:
+            self.controller.spread_alignments()
+        log.info('running %d rigs', len(self.controller.rigs))
+
+    def start(self):
+        from thePeckingOrder import backends
+
+        alignment = self.config['alignment']
+        if alignment['backend']:
+            backends.set_backend(alignment['backend'])
+        if self.config['rigs']:
+            self._start_rigs()
+            return
+
+        self._setup_instrumentation()
+        comms = self._comms(self.config['comms'])
+        alignROI = self._roi(alignment)
+        mode = self.config['mode']
+
+        if mode == 'volumetric':
+            from thePeckingOrder import volumetric, zmqComm
+
+            wt = zmqComm.WalkyTalky(outputPort=comms['output_port'], inputIP=comms['input_ip'],
+                                    inputPort=comms['input_port'], **self._wt_options(comms))
+            self.app = volumetric.Karen(walky_talky=wt, nplanes=self.config['volumetric']['nplanes'],
+                                        alignThreshold=self.config['volumetric']['align_t'],
+                                        **self._karen_options(alignment, alignROI))
+        else:
+            from thePeckingOrder import protocol
+
+            port_info = {'outputPort': comms['output_port'], 'inputIP': comms['input_ip'],
+                         'inputPort': comms['input_port'], 'policy': comms['policy'], 'hwm': comms['hwm'],
+                         'encoding': comms['encoding'], 'quality_policy': comms['quality'],
+                         'saturation_value': comms['saturation_value']}
+            options = dict(port_info=port_info, method=alignment['method'], metric=alignment['metric'], roi=alignROI,
+                           workers=alignment['workers'], stack_size=self.config['protocol']['stack_size'],
+                           n_reps=self.config['protocol']['n_reps'], z_size=self.config['protocol']['z_size'],
+                           adaptive_reps=alignment['adaptive_reps'], min_reps=alignment['min_reps'],
+                           rep_tolerance=alignment['rep_tolerance'], tiles=alignment['tiles'])
+            if mode == 'time':
+                self.app = protocol.TimeProtocol(t_threshold=self.config['protocol']['t_threshold'], **options)
+            elif mode == 'frame':
+                self.app = protocol.FrameProtocol(frame_threshold=self.config['protocol']['frame_threshold'], **options)
+            else:
+                self.app = protocol.Protocol(**options)
+                tr.Thread(target=self._run_once, daemon=True).start()
+        log.info('running %s', mode)
+
+    def _run_once(self):
+        try:
+            self.app.run_alignment()
+        finally:
+            self.stopped.set()
+
+    def stop(self):
+        if self.controller is not None:
+            self.controller.stop()
+        if self.app is not None:
+            if self.config['mode'] == 'volumetric':
+                self.app.stop()
+                self.app.wt.close()
+            else:
+                self.app.kill()
+        for replay in self.replays:
+            replay.stop()
+        if self._dumper is not None:
+            self._dumper.stop()
+        log.info('stopped')
+
+    def run(self):
+        """starts, then blocks until ctrl-c / SIGTERM (or a one-shot protocol finishes) and shuts down"""
+        previous = {sig: signal.signal(sig, lambda *_: self.stopped.set()) for sig in (signal.SIGINT, signal.SIGTERM)}
+        try:
+            self.start()
+            while not self.stopped.wait(0.5):
+                pass
+        finally:
+            self.stop()
+            for sig, handler in previous.items():
+                signal.signal(sig, handler)
+
+
+def record(config, out, n_frames):
+    from thePeckingOrder import replay
+
+    frames = replay.record(config['comms']['input_port'], config['comms']['input_ip'], n_frames)
+    replay.save_frames(out, frames)
+    log.info('recorded %d frames %s to %s', len(frames), frames.shape[1:], out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m thePeckingOrder')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = sub.add_parser('run', help='run volumetric or protocol alignment headless')
+    run_parser.add_argument('--config', default=None, help='.toml or .json config, defaults if left out')
+    run_parser.add_argument('--replay', default=None, help='recorded frames (.npy/.npz) to play instead of labview')
+    run_parser.add_argument('--log_level', default='INFO')
+
+    record_parser = sub.add_parser('record', help='record frames from labview for --replay')
+    record_parser.add_argument('--config', default=None)
+    record_parser.add_argument('--out', required=True)
+    record_parser.add_argument('--n', type=int, default=100)
+    record_parser.add_argument('--log_level', default='INFO')
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    config = load_config(args.config)
+
+    if args.command == 'record':
+        record(config, args.out, args.n)
+    else:
+        Runner(config, args.replay).run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+"""
+reusable scratch buffers for the temporaries of the per-frame and per-alignment paths
+
+every alignment used to allocate a fresh stack for the plane medians, a bool mask per plane
+for thresholding, packed words for the binarized stack and float copies for the intensity
+metrics, a few tens of MB per alignment at 512x512 that the allocator then has to give back.
+the arena hands out the same buffer for the same (name, shape, dtype) every time instead:
+
+    from thePeckingOrder import scratch
+    mask = scratch.get('mask', image.shape, bool)      # uninitialized, owned by this thread
+    np.greater(image, threshold, out=mask)
+    image = scratch.median(frames)                     # stacks into a scratch buffer, partitions in place
+
+a buffer stays valid until the same thread asks for the same key again, so it is for
+temporaries only: never return one or keep a reference to it. buffers are per thread, which
+keeps the worker pools and several rigs' alignments off each other's buffers, and each
+thread's arena drops its least recently used buffers past max_bytes.
+`python -m thePeckingOrder.benchmarks allocations` checks the steady state with tracemalloc.
+"""
+
+import collections
+import threading as tr
+
+import numpy as np
+
+
+class Arena:
+    def __init__(self, max_bytes=256 * 2 ** 20):
+        """max_bytes: per thread, least recently used buffers are dropped past it"""
+        self.max_bytes = max_bytes
+        # off: get() allocates every time, for comparing against the arena
+        self.enabled = True
+        # bytes handed out again instead of allocated, all threads (unlocked, approximate)
+        self.reused = 0
+        self._local = tr.local()
+
+    def _buffers(self):
+        try:
+            return self._local.buffers
+        except AttributeError:
+            self._local.buffers = collections.OrderedDict()
+            return self._local.buffers
+
+    def get(self, name, shape, dtype):
+        """uninitialized (shape, dtype) buffer for the temporary `name`, the same one on every call from this thread"""
+        if not self.enabled:
+            return np.empty(shape, dtype)
+        key = (name, tuple(shape), np.dtype(dtype))
+        buffers = self._buffers()
+        buffer = buffers.get(key)
+        if buffer is not None:
+            buffers.move_to_end(key)
+            self.reused += buffer.nbytes
+            return buffer
+        buffer = buffers[key] = np.empty(shape, dtype)
+        while len(buffers) > 1 and sum(b.nbytes for b in buffers.values()) > self.max_bytes:
+            buffers.popitem(last=False)
+        return buffer
+
+    def nbytes(self):
+        """bytes held for the calling thread"""
+        return sum(buffer.nbytes for buffer in self._buffers().values())
+
+    def clear(self):
+        """drops the calling thread's buffers"""
+        self._buffers().clear()
+
+
+ARENA = Arena()
+
+
+def get(name, shape, dtype):
+    return ARENA.get(name, shape, dtype)
+
+
+def stack(name, arrays):
+    """arrays (equal shapes) stacked into the scratch buffer `name`, an (N, ...) array as is"""
+    if isinstance(arrays, np.ndarray):
+        return arrays
+    first = np.asarray(arrays[0])
+    out = ARENA.get(name, (len(arrays),) + first.shape, first.dtype)
+    for n, array in enumerate(arrays):
+        out[n] = array
+    return out
+
+
+def median(images):
+    """
+    np.median(images, axis=0) of a list of frames, allocating only the result
+    the frames are copied into a scratch stack that is partitioned in place
+    """
+    if isinstance(images, np.ndarray) or len(images) == 0:
+        return np.median(images, axis=0)
+    frames = stack('median', images)
+    n = len(frames)
+    dtype = frames.dtype if frames.dtype.kind == 'f' else np.float64
+    middle = n // 2
+    if n % 2:
+        frames.partition(middle, axis=0)
+        return frames[middle].astype(dtype)
+    frames.partition((middle - 1, middle), axis=0)
+    result = np.add(frames[middle - 1], frames[middle], dtype=dtype)
+    result /= 2
+    return result
@@ -0,0 +1,98 @@
+"""
+alignment target with its derived data computed once
+
+the gui scores the live frame against the target every second and every alignment
+scores a stack against it, both only need the target's threshold, mask and popcount,
+which only change when the target does. Target keeps them (per roi) until update().
+
+    target = Target(targetImage)
+    PlaneAlignment(target, stack, method='otsu').match_calculator()
+    target.update(newImage)     # drops everything cached for the old image
+"""
+
+import threading as tr
+
+import numpy as np
+
+from thePeckingOrder import masks
+from thePeckingOrder.filters import threshold_otsu
+
+
+_BINARIZE = {'mean': np.mean,
+             'otsu': threshold_otsu}
+
+
+class Target:
+    def __init__(self, image, method='otsu'):
+        """method: binarization threshold, same names as PlaneAlignment"""
+        assert(method in _BINARIZE.keys()), f'method must be approved method: {_BINARIZE.keys()}'
+        self.method = method
+        self.binarize_method = _BINARIZE[method]
+        self._lock = tr.Lock()
+        self.update(image)
+
+    @classmethod
+    def from_entry(cls, entry):
+        """from a library.LibraryEntry, reusing its stored threshold and packed mask"""
+        target = cls(entry.image, entry.method)
+        target._cache[('threshold', None)] = entry.threshold
+        target._cache[('mask', False, True, None)] = entry.mask
+        return target
+
+    def update(self, image):
+        """swaps in a new target image, everything derived from the old one is dropped"""
+        with self._lock:
+            self.image = np.asarray(image)
+            self.shape = self.image.shape
+            self._cache = {}
+
+    def _cached(self, key, build):
+        cache = self._cache
+        try:
+            return cache[key]
+        except KeyError:
+            pass
+        value = build()
+        with self._lock:
+            # only keep it if the target wasn't replaced meanwhile
+            if cache is self._cache:
+                cache[key] = value
+        return value
+
+    @staticmethod
+    def _roi_key(roi):
+        return None if roi is None or roi.is_full_frame else roi.key
+
+    def restricted(self, roi=None):
+        """the target pixels inside roi, as PlaneAlignment sees them"""
+        if self._roi_key(roi) is None:
+            return self.image
+        return self._cached(('pixels', roi.key), lambda: roi.pixels(self.image))
+
+    def threshold(self, roi=None):
+        return self._cached(('threshold', self._roi_key(roi)), lambda: self.binarize_method(self.restricted(roi)))
+
+    def mask(self, inclusive=False, packed=False, roi=None):
+        """binarized target, a PackedMask with packed"""
+        def build():
+            compare = np.greater_equal if inclusive else np.greater
+            mask = compare(self.restricted(roi), self.threshold(roi))
+            return masks.PackedMask.from_bool(mask) if packed else mask
+        return self._cached(('mask', inclusive, packed, self._roi_key(roi)), build)
+
+    def count(self, inclusive=False, roi=None):
+        """pixels on in mask(), from the packed mask's popcount"""
+        return self._cached(('count', inclusive, self._roi_key(roi)),
+                            lambda: int(self.mask(inclusive, True, roi).count()))
+
+    def normalized(self, roi=None):
+        """zero mean, unit norm float64 pixels, what ncc correlates against"""
+        def build():
+            image = self.restricted(roi).astype(np.float64)
+            image = image - image.mean()
+            norm = np.sqrt(np.sum(image * image))
+            return image / norm if norm > 0 else image
+        return self._cached(('normalized', self._roi_key(roi)), build)
+
+    def __repr__(self):
+        return f'Target(shape={self.shape}, method={self.method!r})'
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from thePeckingOrder import adaptive
+
+
+def _collect(reps, frames_per_plane):
+    """feeds each plane's frames until add says done, returns the frames each plane took"""
+    reps.start_stack()
+    for plane, frames in frames_per_plane.items():
+        reps.start_plane(plane)
+        for frame in frames:
+            if reps.add(frame):
+                break
+        reps.finish_plane()
+    return reps.frames_used
+
+
+def _score(image):
+    return -float(np.abs(image - 10).mean())
+
+
+def test_steady_planes_stop_early():
+    frames = {plane: [np.full((4, 4), 10.0 + abs(plane))] * 5 for plane in (0, 1, -1)}
+    reps = adaptive.AdaptiveReps(_score, min_reps=2, max_reps=5)
+    used = _collect(reps, frames)
+    assert used == {0: 3, 1: 3, -1: 3}
+    assert reps.report() == {'frames': 9, 'budget': 15, 'saved': 6, 'per_plane': used}
+    assert max(reps.scores, key=reps.scores.get) == 0
+
+
+def test_unsettled_plane_takes_max_reps():
+    rng = np.random.default_rng(0)
+    # the running median keeps moving by more than the tolerance
+    frames = {0: [np.full((4, 4), 10.0 + 5 * rng.standard_normal()) for _ in range(5)]}
+    reps = adaptive.AdaptiveReps(_score, min_reps=2, max_reps=5, tolerance=1e-6)
+    assert _collect(reps, frames) == {0: 5}
+
+
+def test_never_fewer_frames_than_earlier_plane():
+    rng = np.random.default_rng(1)
+    frames = {0: [np.full((4, 4), 10.0 + 5 * rng.standard_normal()) for _ in range(5)],
+              1: [np.full((4, 4), 20.0)] * 5}
+    reps = adaptive.AdaptiveReps(_score, min_reps=2, max_reps=5, tolerance=1e-6)
+    used = _collect(reps, frames)
+    assert used[1] >= used[0]
+
+
+def test_finish_plane_returns_median():
+    reps = adaptive.AdaptiveReps(_score, min_reps=1, max_reps=3)
+    reps.start_plane(0)
+    for value in (1.0, 7.0, 3.0):
+        reps.add(np.full((2, 2), value))
+    np.testing.assert_array_equal(reps.finish_plane(), np.full((2, 2), 3.0))
+
+
+def test_empty_plane_raises():
+    reps = adaptive.AdaptiveReps(_score)
+    reps.start_plane(0)
+    with pytest.raises(RuntimeError):
+        reps.finish_plane()
+
+
+def test_bad_rep_bounds():
+    with pytest.raises(AssertionError):
+        adaptive.AdaptiveReps(_score, min_reps=4, max_reps=3)
@@ -0,0 +1,47 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from thePeckingOrder import backends, benchmarks
+
+
+def _run(code, **env):
+    env = dict(os.environ, PYTHONPATH=benchmarks.PACKAGE_PARENT, **env)
+    return subprocess.run([sys.executable, '-c', code], check=True, env=env, cwd=benchmarks.PACKAGE_PARENT,
+                          capture_output=True, text=True).stdout.strip()
+
+
+@pytest.mark.parametrize('backend', backends.available())
+def test_matches_numpy(backend):
+    assert backends.check_equivalence(backend)
+
+
+def test_integer_stacks_use_numpy():
+    rng = np.random.default_rng(0)
+    stack = rng.integers(0, 4000, size=(3, 16, 16))
+    target_mask = rng.random((16, 16)) > 0.5
+    for backend in backends.available():
+        out = backends.BACKENDS[backend](target_mask, stack)
+        ref = backends.otsu_scores_numpy(target_mask, stack)
+        assert all(np.array_equal(a, b) for a, b in zip(out, ref))
+
+
+def test_import_leaves_numba_alone():
+    code = 'import sys, thePeckingOrder.planeAlignment; print("numba" in sys.modules)'
+    assert _run(code, PECKINGORDER_BACKEND='auto') == 'False'
+
+
+def test_environment_applied_on_first_use():
+    code = 'from thePeckingOrder import backends; print(backends.get_backend())'
+    assert _run(code, PECKINGORDER_BACKEND='numpy') == 'numpy'
+    assert _run(code, PECKINGORDER_BACKEND='') == 'numpy'
+    if 'numba' in backends.available():
+        assert _run(code, PECKINGORDER_BACKEND='auto') == 'numba'
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        backends.set_backend('cuda')
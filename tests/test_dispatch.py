@@ -0,0 +1,90 @@
+import pytest
+
+from thePeckingOrder import dispatch, instrumentation
+
+
+class FakePublisher:
+    """stands in for zmqComm.Publisher, records what goes out on the socket"""
+    def __init__(self):
+        self.socket = self
+        self.sent = []
+
+    def send(self, msg):
+        self.sent.append(msg)
+
+
+@pytest.fixture
+def dispatcher():
+    metrics = instrumentation.Registry(enabled=True)
+    dispatcher = dispatch.CommandDispatcher(FakePublisher(), metrics=metrics)
+    yield dispatcher
+    dispatcher.stop()
+
+
+def _queued(dispatcher, *messages, **options):
+    # holding the condition keeps the sender thread off the queue until everything is in
+    with dispatcher._cond:
+        return [dispatcher.send(msg, **options) for msg in messages]
+
+
+def test_parse_and_format_move():
+    assert dispatch._parse_move(b'(pplus)6') == ('labview', 6)
+    assert dispatch._parse_move(b'(pminus)4') == ('labview', -4)
+    assert dispatch._parse_move(b'piezo: move_rel-2.5') == ('piezo', -2.5)
+    assert dispatch._parse_move(b'RESET') is None
+    assert dispatch.format_move('labview', -4) == b'(pminus)4'
+    assert dispatch.format_move('piezo', 2.0) == b'piezo: move_rel+2'
+
+
+def test_emergency_goes_first(dispatcher):
+    with dispatcher._cond:
+        _queued(dispatcher, b's1 s3', b'RUN', coalesce=False)
+        dispatcher.emergency_reset(cancel_pending=False)
+    assert dispatcher.flush(5)
+    assert dispatcher.pub.sent == [b'RESET', b's1 s3', b'RUN']
+
+
+def test_emergency_cancels_pending(dispatcher):
+    with dispatcher._cond:
+        routine = _queued(dispatcher, b's1 s3', b'RUN')
+        dispatcher.emergency_reset()
+    assert dispatcher.flush(5)
+    assert dispatcher.pub.sent == [b'RESET']
+    assert all(command.cancelled for command in routine)
+
+
+def test_consecutive_moves_coalesce(dispatcher):
+    commands = _queued(dispatcher, '(pplus)3', '(pplus)2', '(pminus)1', 'piezo: move_rel+2', 'piezo: move_rel+0.5')
+    assert commands[0] is commands[1] is commands[2]
+    assert commands[0].merged == 3
+    assert dispatcher.flush(5)
+    assert dispatcher.pub.sent == [b'(pplus)4', b'piezo: move_rel+2.5']
+    assert dispatcher.metrics.counter('commands_coalesced_total').value == 3
+    assert dispatcher.metrics.counter('commands_sent_total').value == 2
+
+
+def test_other_commands_break_coalescing(dispatcher):
+    _queued(dispatcher, '(pplus)3', 'RUN', '(pplus)2')
+    assert dispatcher.flush(5)
+    assert dispatcher.pub.sent == [b'(pplus)3', b'RUN', b'(pplus)2']
+
+
+def test_net_zero_move_is_not_sent(dispatcher):
+    cancelled = _queued(dispatcher, '(pplus)3', '(pminus)3', 'RUN')[0]
+    assert dispatcher.flush(5)
+    assert cancelled.cancelled
+    assert dispatcher.pub.sent == [b'RUN']
+
+
+def test_net_zero_move_revived(dispatcher):
+    _queued(dispatcher, '(pplus)3', '(pminus)3', '(pminus)2')
+    assert dispatcher.flush(5)
+    assert dispatcher.pub.sent == [b'(pminus)2']
+
+
+def test_stop_sends_queued_then_ends(dispatcher):
+    _queued(dispatcher, 'RUN', 'RESET')
+    dispatcher.stop()
+    assert dispatcher.pub.sent == [b'RUN', b'RESET']
+    assert not dispatcher.thread.is_alive()
+    assert [command.msg for command in dispatcher.sent_log] == [b'RUN', b'RESET']
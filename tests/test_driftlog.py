@@ -0,0 +1,77 @@
+import numpy as np
+
+from thePeckingOrder import driftlog
+
+
+def test_default_size():
+    log = driftlog.DriftLog()
+    assert log.raw.data.nbytes + log.coarse.data.nbytes < 2.5e6
+
+
+def test_ring_wraps_around():
+    ring = driftlog._Ring(4, np.int64)
+    assert ring.oldest() is None
+    for i in range(3):
+        ring.append(i)
+    assert len(ring.halves()) == 1
+    np.testing.assert_array_equal(ring.view(), [0, 1, 2])
+
+    for i in range(3, 7):
+        ring.append(i)
+    assert ring.size == 4 and ring.oldest() == 3
+    assert [half.tolist() for half in ring.halves()] == [[3], [4, 5, 6]]
+    np.testing.assert_array_equal(ring.view(), [3, 4, 5, 6])
+
+
+def test_raw_keeps_latest_rows():
+    log = driftlog.DriftLog(capacity=5, decimate=2)
+    for t in range(12):
+        log.log_loss(float(t), t=t)
+    assert len(log) == 5
+    np.testing.assert_array_equal(log.rows()['time'], np.arange(7, 12))
+    np.testing.assert_array_equal(log.rows(since=9)['loss'], [9, 10, 11])
+
+
+def test_coarse_rows_per_kind():
+    log = driftlog.DriftLog(capacity=10, decimate=4)
+    log.log_loss(0.2, t=0)
+    log.log_alignment([0.1, 0.5, 0.3], best=1, move=2.0, duration=1.5, t=1)
+    log.log_loss(0.4, t=2)
+    log.log_alignment([0.6, 0.2], best=0, move=-1.0, duration=0.5, t=3)
+
+    loss, alignment = log.coarse.view()
+    assert loss['kind'] == driftlog.LOSS
+    assert loss['time'] == 1 and np.isclose(loss['loss'], 0.3)
+    assert alignment['kind'] == driftlog.ALIGNMENT
+    assert alignment['time'] == 2 and np.isclose(alignment['loss'], 0.55)
+    assert alignment['move'] == 1.0 and alignment['best'] == 0 and alignment['duration'] == 1.0
+
+    aligned = log.alignments()
+    assert aligned['n_scores'].tolist() == [3, 2]
+    np.testing.assert_allclose(aligned[0]['scores'][:3], [0.1, 0.5, 0.3])
+
+
+def test_downsampled_falls_back_to_coarse():
+    log = driftlog.DriftLog(capacity=10, decimate=10)
+    for t in range(100):
+        log.log_loss(float(t), t=t)
+    times, values = log.downsampled()
+    np.testing.assert_array_equal(times, np.arange(90, 100))
+
+    times, values = log.downsampled(since=0)
+    # coarse rows (means of ten) up to where the raw tier starts, then the raw rows
+    np.testing.assert_allclose(times[:9], np.arange(9) * 10 + 4.5)
+    np.testing.assert_array_equal(times[9:], np.arange(90, 100))
+    np.testing.assert_allclose(values, times)
+
+    times, values = log.downsampled(max_points=4, since=0)
+    assert times.size == 4 and np.all(np.diff(times) > 0)
+
+
+def test_file_roundtrip(tmp_path):
+    path = str(tmp_path / 'drift.bin')
+    log = driftlog.DriftLog(capacity=3, path=path)
+    for t in range(5):
+        log.log_loss(float(t), t=t)
+    log.close()
+    np.testing.assert_array_equal(driftlog.DriftLog.load(path)['loss'], np.arange(5))
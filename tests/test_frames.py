@@ -0,0 +1,45 @@
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from thePeckingOrder import benchmarks, frames
+from thePeckingOrder.roi import LABVIEW_CROP, ROI
+
+
+@pytest.mark.parametrize('backend', frames.available())
+def test_array_decoder_matches_json_fuzz(backend):
+    decoder = frames.ArrayDecoder(backend)
+    assert frames.check_equivalence(decoder, n_cases=500, seed=0)
+    assert frames.check_equivalence(decoder, n_cases=500, seed=1)
+
+
+@pytest.mark.parametrize('backend', frames.available())
+def test_array_decoder_labview_frame(backend):
+    rng = np.random.default_rng(0)
+    payload = json.dumps(rng.integers(0, 65536, size=(64, 96)).tolist(), separators=(',', ':')).encode()
+    crop = ROI(cols=(32, None))
+    decoder = frames.ArrayDecoder(backend)
+    for _ in range(2):
+        # the second call reuses the row count from the first
+        out = decoder(payload, crop)
+        expected = frames.decode_json(payload, crop)
+        assert out.dtype == expected.dtype
+        np.testing.assert_array_equal(out, expected)
+
+
+@pytest.mark.parametrize('backend', frames.available())
+def test_array_decoder_shape_change(backend):
+    decoder = frames.ArrayDecoder(backend)
+    for rows in (8, 5, 12):
+        payload = json.dumps(np.arange(rows * 40).reshape(rows, 40).tolist()).encode()
+        np.testing.assert_array_equal(decoder(payload, LABVIEW_CROP), frames.decode_json(payload, LABVIEW_CROP))
+
+
+def test_import_leaves_numba_alone():
+    code = 'import sys, thePeckingOrder.zmqComm; assert "numba" not in sys.modules'
+    env = dict(os.environ, PYTHONPATH=benchmarks.PACKAGE_PARENT)
+    subprocess.run([sys.executable, '-c', code], check=True, env=env, cwd=benchmarks.PACKAGE_PARENT)
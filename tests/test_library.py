@@ -0,0 +1,77 @@
+import os
+
+import numpy as np
+import pytest
+
+from thePeckingOrder import filters, library
+from thePeckingOrder.target import Target
+
+
+@pytest.fixture
+def lib(tmp_path):
+    return library.TargetLibrary(str(tmp_path / 'targets'))
+
+
+def _image(seed, shape=(24, 32)):
+    return np.random.default_rng(seed).integers(0, 4000, size=shape).astype(np.uint16)
+
+
+def test_save_load_roundtrip(lib):
+    image = _image(0)
+    lib.save('fish3_plane2', image, fish='fish3')
+    lib._entries.clear()
+    entry = lib.load('fish3_plane2')
+
+    assert isinstance(entry.image, np.memmap)
+    assert np.array_equal(entry.image, image)
+    assert entry.method == 'otsu'
+    assert entry.threshold == pytest.approx(filters.threshold_otsu(image))
+    assert np.array_equal(entry.mask.unpack(), image > entry.threshold)
+    assert entry.mask.count() == (image > entry.threshold).sum()
+    assert entry.meta['fish'] == 'fish3'
+    assert not os.path.exists(os.path.join(lib.path, 'fish3_plane2', 'fft.npy'))
+
+
+def test_names_and_delete(lib):
+    lib.save('b', _image(1))
+    lib.save('a', _image(2))
+    os.makedirs(os.path.join(lib.path, 'c.tmp'))
+    assert lib.names() == ['a', 'b']
+    assert 'a' in lib
+
+    lib.delete('a')
+    assert lib.names() == ['b']
+    with pytest.raises(KeyError):
+        lib.load('a')
+
+
+def test_save_replaces(lib):
+    lib.save('a', _image(1))
+    replaced = lib.save('a', _image(2))
+    assert np.array_equal(replaced.image, _image(2))
+
+
+@pytest.mark.parametrize('name', ['', '.', '..', '../escape', 'a/b', 'x.tmp', 'nul\0', None])
+def test_bad_names_raise(lib, name):
+    with pytest.raises(ValueError):
+        lib.save(name, _image(0))
+    with pytest.raises(ValueError):
+        lib.load(name)
+
+
+def test_best_match(lib):
+    stack = np.stack([_image(seed) for seed in range(4)])
+    lib.save('plane2', stack[2])
+    lib.save('plane0', stack[0])
+    names, scores = lib.match(stack)
+    assert names == ['plane0', 'plane2'] and scores.shape == (2, 4)
+    assert lib.best_match(stack, ['plane2']) == ('plane2', 2, pytest.approx(1.0))
+
+
+def test_target_from_entry(lib):
+    image = _image(3)
+    entry = lib.save('a', image)
+    target = Target.from_entry(entry)
+    fresh = Target(image)
+    assert target.threshold() == pytest.approx(fresh.threshold())
+    assert np.array_equal(target.mask(packed=True).unpack(), fresh.mask())
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from thePeckingOrder import masks
+
+
+def _dense_dice(a, b):
+    totals = a.sum(axis=(-2, -1)) + b.sum(axis=(-2, -1))
+    return 2.0 * (a & b).sum(axis=(-2, -1)) / np.maximum(totals, 1)
+
+
+@pytest.mark.parametrize('shape', [(8, 8), (13, 17), (64, 64), (5, 1)])
+def test_roundtrip(shape):
+    rng = np.random.default_rng(0)
+    mask = rng.random(shape) > 0.5
+    packed = masks.PackedMask.from_bool(mask)
+    assert packed.words.shape == (masks.PackedMask.n_words(shape),)
+    assert np.array_equal(packed.unpack(), mask)
+    assert packed.count() == mask.sum()
+
+
+@pytest.mark.parametrize('shape', [(3, 13, 17), (10, 32, 32)])
+def test_stack_matches_dense(shape):
+    rng = np.random.default_rng(1)
+    stack = rng.random(shape) > 0.7
+    target = rng.random(shape[1:]) > 0.6
+    packed, packed_target = masks.PackedMask.from_bool(stack), masks.PackedMask.from_bool(target)
+    assert len(packed) == shape[0]
+    assert np.array_equal(packed.unpack(), stack)
+    assert np.array_equal(packed.count(), stack.sum(axis=(1, 2)))
+    assert np.array_equal(packed.intersection(packed_target), (stack & target).sum(axis=(1, 2)))
+    assert np.array_equal(packed.union(packed_target), (stack | target).sum(axis=(1, 2)))
+    assert np.allclose(packed.dice(packed_target), _dense_dice(stack, target))
+    assert np.array_equal(packed[1].unpack(), stack[1])
+    assert np.array_equal((packed & packed_target).unpack(), stack & target)
+
+
+def test_from_planes_generator():
+    rng = np.random.default_rng(2)
+    stack = rng.random((11, 9, 7)) > 0.5
+    # no len() and more planes than the initial guess, so the words have to grow
+    packed = masks.PackedMask.from_planes((plane for plane in stack), stack.shape[1:])
+    assert packed.shape == stack.shape
+    assert np.array_equal(packed.unpack(), stack)
+    sized = masks.PackedMask.from_planes((plane for plane in stack), stack.shape[1:], n_planes=len(stack))
+    assert np.array_equal(sized.words, packed.words)
+
+
+def test_empty():
+    packed = masks.PackedMask.from_planes([], (4, 4))
+    assert len(packed) == 0
+    assert packed.unpack().shape == (0, 4, 4)
+    blank = masks.PackedMask.from_bool(np.zeros((4, 4), dtype=bool))
+    assert blank.count() == 0
+    assert blank.dice(blank) == 0
+
+
+def test_popcount():
+    words = np.array([0, 1, 2**64 - 1, 0b1011], dtype=np.uint64)
+    assert masks.popcount(words) == 0 + 1 + 64 + 3
+    assert np.array_equal(masks.popcount(words.reshape(2, 2), axis=-1), [1, 67])
@@ -0,0 +1,57 @@
+import itertools
+
+import pytest
+
+from thePeckingOrder import planner
+
+
+def test_stack_offsets():
+    assert planner.MovePlanner.stack_offsets(5) == [-2, -1, 0, 1, 2]
+    assert planner.MovePlanner.stack_offsets(4) == [-1, 0, 1, 2]
+    assert planner.MovePlanner.stack_offsets(1) == [0]
+
+
+def test_plan_moves():
+    plan = planner.Plan([0, 1, 2, -1, -2])
+    assert plan.moves == [0, 1, 1, -3, -1]
+    assert plan.end == -2
+
+
+def test_plan_visits_every_plane_once():
+    offsets = planner.MovePlanner.stack_offsets(5)
+    plan = planner.MovePlanner().plan(offsets)
+    assert sorted(plan.order) == offsets
+    assert plan.order[0] == 0
+
+
+@pytest.mark.parametrize('correction', [-2, 0, 1, 3])
+def test_plan_is_cheapest_order(correction):
+    simulator = planner.MoveSimulator()
+    offsets = planner.MovePlanner.stack_offsets(5)
+    plan = planner.MovePlanner(simulator).plan(offsets, expected_correction=correction)
+    cheapest = min(simulator.score(planner.Plan([0] + list(order)), correction)
+                   for order in itertools.permutations([-2, -1, 1, 2]))
+    assert simulator.score(plan, correction) == pytest.approx(cheapest)
+
+
+def test_plan_beats_legacy_order():
+    simulator = planner.MoveSimulator()
+    plan = planner.MovePlanner(simulator).plan(planner.MovePlanner.stack_offsets(5), expected_correction=1)
+    legacy = simulator.score(planner.Plan(planner.LEGACY_ORDER), 1, folded=False)
+    assert simulator.score(plan, 1) < legacy
+
+
+def test_folding_saves_a_settle():
+    simulator = planner.MoveSimulator(seconds_per_step=0, settle_seconds=1)
+    plan = planner.Plan([0, 1, -1])
+    # folded: +1, -2, then -1 -> +2 as the exit; unfolded adds a move home before the correction
+    assert simulator.score(plan, 2) == 3
+    assert simulator.score(plan, 2, folded=False) == 4
+
+
+def test_large_stacks_use_sweeps_only():
+    offsets = planner.MovePlanner.stack_offsets(21)
+    candidates = list(planner.MovePlanner(max_exhaustive=7).candidates(offsets))
+    assert len(candidates) == 2
+    plan = planner.MovePlanner().plan(offsets)
+    assert sorted(plan.order) == offsets
@@ -0,0 +1,92 @@
+import itertools
+import time
+
+import pytest
+
+from thePeckingOrder import pstim
+
+
+_ports = itertools.count(47600, 2)
+
+
+@pytest.fixture
+def rig():
+    """(channel, stand-in) factory on fresh localhost ports, both closed afterwards"""
+    opened = []
+
+    def make(stand_in=None, **channel_options):
+        pub_port = next(_ports)
+        channel = pstim.PstimChannel(pub_port, pub_port + 1, **channel_options)
+        stand = pstim.StandInPstim(pub_port, pub_port + 1, legacy=channel_options.get('legacy', False),
+                                   **(stand_in or {}))
+        opened.append((channel, stand))
+        # slow joiner: both subscriptions need a moment before the first message
+        time.sleep(0.3)
+        return channel, stand
+
+    yield make
+    for channel, stand in opened:
+        stand.stop()
+        channel.close()
+
+
+def _events(channel, seconds):
+    events = []
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        events += channel.poll(0.02)
+    return events
+
+
+def test_reply(rig):
+    channel, stand = rig(timeout=2.0)
+    msg_id = channel.request('pause')
+    event = channel.wait(msg_id)
+    assert event.kind == 'proceed' and event.msg_id == msg_id and not event.timed_out
+    assert stand.paused
+    assert not channel.pending
+    assert channel.latency()['count'] == 1
+
+
+@pytest.mark.parametrize('fallback', ['skip', 'proceed'])
+def test_timeout_fallback(rig, fallback):
+    channel, stand = rig(stand_in={'answer': False}, timeout=0.2, fallback=fallback)
+    msg_id = channel.request('pause')
+    event = channel.wait(msg_id, timeout=2.0)
+    assert event.kind == fallback and event.timed_out
+    assert channel.timeouts == 1
+
+
+def test_retry_then_skip(rig):
+    channel, stand = rig(stand_in={'answer': False}, timeout=0.2, fallback='retry', retries=2)
+    msg_id = channel.request('pause')
+    event = channel.wait(msg_id, timeout=3.0)
+    assert event.kind == 'skip' and event.timed_out
+    assert stand.received.count('pause') == 3
+
+
+def test_late_reply_unpauses(rig):
+    channel, stand = rig(stand_in={'delay': 0.6}, timeout=0.2, fallback='skip')
+    msg_id = channel.request('pause')
+    assert channel.wait(msg_id, timeout=2.0).kind == 'skip'
+    # the late proceed is no event, but pstim gets told to carry on
+    assert _events(channel, 1.5) == []
+    assert 'unpause' in stand.received and not stand.paused
+
+
+def test_legacy(rig):
+    channel, stand = rig(legacy=True, timeout=2.0)
+    msg_id = channel.request('pause')
+    event = channel.wait(msg_id)
+    assert event.kind == 'proceed' and not event.timed_out
+    channel.notify('unpause')
+    time.sleep(0.3)
+    assert stand.received == ['pause', 'unpause'] and not stand.paused
+
+
+@pytest.mark.parametrize('body', [b'\xff\xfe', b'proceed seven', b'\x80garbage'])
+def test_malformed_reply_dropped(rig, body):
+    channel, _ = rig(legacy=body[:1] == b'\x80', timeout=2.0)
+    channel.request('pause')
+    assert channel._receive(pstim.REPLY_TOPIC, body) is None
+    assert len(channel.pending) == 1
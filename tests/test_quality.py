@@ -0,0 +1,46 @@
+import logging
+
+import numpy as np
+
+from thePeckingOrder import quality
+
+
+def _frame(value=1000, saturated_fraction=0.0, dtype=np.int64, shape=(64, 64), seed=0):
+    rng = np.random.default_rng(seed)
+    image = (value + rng.integers(-50, 50, size=shape)).astype(dtype)
+    image[:int(shape[0] * saturated_fraction)] = 4095
+    return image
+
+
+def test_saturation_on_json_frames():
+    """json frames decode to int64, the sensor's full scale has to be given"""
+    checked = quality.FrameQuality('default', saturation_value=4095)
+    stats = checked.assess(_frame(saturated_fraction=0.25))
+    assert stats.saturated > 0.2
+    assert stats.rejected == 'saturated'
+    assert checked.assess(_frame(seed=1)).rejected == ''
+
+
+def test_no_saturation_value_on_int64_warns_once(caplog):
+    unchecked = quality.FrameQuality('default')
+    with caplog.at_level(logging.WARNING, logger='thePeckingOrder.quality'):
+        for seed in range(3):
+            stats = unchecked.assess(_frame(saturated_fraction=0.25, seed=seed))
+            assert stats.saturated == 0.0 and stats.rejected == ''
+    assert len(caplog.records) == 1
+
+
+def test_uint16_uses_dtype_max():
+    checked = quality.FrameQuality('default')
+    image = _frame(dtype=np.uint16)
+    image[:16] = np.iinfo(np.uint16).max
+    assert checked.assess(image).rejected == 'saturated'
+
+
+def test_blank_and_motion():
+    checked = quality.FrameQuality('default', saturation_value=4095)
+    ramp = np.linspace(200, 2000, 64).astype(np.int64)[None, :]
+    for seed in range(5):
+        assert checked.assess(_frame(seed=seed) + ramp).rejected == ''
+    assert checked.assess(_frame(value=50, seed=5)).rejected == 'blank'
+    assert checked.assess(np.roll(_frame(seed=6) + ramp, 16, axis=1)).rejected == 'motion'
@@ -0,0 +1,38 @@
+import numpy as np
+
+from thePeckingOrder import benchmarks, scratch
+
+
+def test_arena_reuses_buffers():
+    arena = scratch.Arena()
+    first = arena.get('mask', (8, 8), bool)
+    assert arena.get('mask', (8, 8), bool) is first
+    assert arena.get('mask', (8, 9), bool) is not first
+    assert arena.reused == first.nbytes
+
+
+def test_arena_drops_least_recently_used():
+    arena = scratch.Arena(max_bytes=1000)
+    arena.get('a', (100,), np.float64)
+    arena.get('b', (100,), np.float64)
+    assert arena.nbytes() == 800
+    arena.get('c', (100,), np.float64)
+    assert arena.nbytes() == 800
+
+
+def test_median_matches_numpy():
+    rng = np.random.default_rng(0)
+    for n in (1, 4, 5):
+        frames = [rng.integers(0, 4000, size=(16, 24)).astype(np.uint16) for _ in range(n)]
+        np.testing.assert_array_equal(scratch.median(frames), np.median(frames, axis=0))
+
+
+def test_steady_state_alignment_allocations():
+    shape = (128, 128)
+    results = benchmarks.steady_state_allocations(shape, n_planes=5, reps=5, alignments=10, warmup=3)
+    arena = results['arena']
+    # nothing builds up from one alignment to the next
+    assert arena['retained'] < 16 * 2 ** 10
+    # beyond the plane medians it hands back, an alignment allocates less than one float64 frame
+    assert arena['temporaries'] < np.prod(shape) * 8
+    assert arena['reused'] > 0
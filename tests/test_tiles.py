@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from thePeckingOrder import tiles
+from thePeckingOrder.planeAlignment import PlaneAlignment
+
+
+def _stack(shape, n_planes=5, seed=0):
+    """smooth blobs, each plane a shifted and noisier copy of the target"""
+    rng = np.random.default_rng(seed)
+    rows, cols = np.mgrid[:shape[0], :shape[1]]
+    target = 1000 + 800 * np.sin(rows / 5.0) * np.cos(cols / 7.0) + rng.normal(0, 30, shape)
+    stack = np.stack([np.roll(target, 2 * abs(z - 2), axis=1) + rng.normal(0, 30 * (1 + abs(z - 2)), shape)
+                      for z in range(n_planes)])
+    return target, stack
+
+
+@pytest.mark.parametrize('metric', tiles.BINARY + tiles.MOMENTS)
+@pytest.mark.parametrize('shape, grid', [((48, 64), (4, 4)), ((50, 70), (4, 4)), ((53, 61), (3, 5))])
+def test_frame_scores_match_calculator(metric, shape, grid):
+    target, stack = _stack(shape)
+    aligner = PlaneAlignment(target, stack, 'otsu', metric)
+    best = aligner.match_calculator()
+    expected = np.array(aligner.match_vals)
+
+    result = aligner.local_z(grid)
+    np.testing.assert_allclose(result.frame_scores, expected, rtol=1e-9, atol=1e-12)
+    assert result.frame_plane == best == 2
+
+
+def test_edges_cover_what_tiles_drop():
+    image = np.arange(53 * 61).reshape(53, 61)
+    tiled = tiles.tile_view(image, (3, 5))
+    covered = tiled.size + sum(edge.size for edge in tiles._edges(image, (3, 5)))
+    assert covered == image.size
+    assert tiled.sum() + sum(edge.sum() for edge in tiles._edges(image, (3, 5))) == image.sum()
+
+
+def test_tile_scores_shape():
+    target, stack = _stack((48, 64))
+    assert tiles.tile_scores(tiles.Target(target), stack, (4, 4)).shape == (5, 4, 4)
+
+
+def test_grid_too_fine():
+    with pytest.raises(ValueError):
+        tiles.tile_view(np.zeros((3, 3)), (4, 4))
@@ -0,0 +1,124 @@
+import datetime
+import itertools
+import time
+
+import numpy as np
+import pytest
+
+from thePeckingOrder import instrumentation, replay, zmqComm
+from thePeckingOrder.protocol import Protocol
+
+
+_ports = itertools.count(47700, 2)
+
+
+def _at(seconds):
+    return (datetime.datetime(2000, 1, 1) + datetime.timedelta(seconds=seconds)).time()
+
+
+def test_tracker_counts_gaps():
+    tracker = zmqComm.FrameTracker(instrumentation.Registry(enabled=True))
+    for seq in (1, 2, 5, 6):
+        tracker.update('target', seq, _at(10), now=_at(10.5))
+    assert tracker.received['target'] == 4
+    assert tracker.dropped['target'] == 2
+    assert tracker.accounted('target') == 6
+    assert tracker.lag == pytest.approx(0.5)
+    assert tracker.metrics.counter('frames_dropped_total').value == 2
+
+    # a restarted acquisition starts its numbers over, that's no gap
+    tracker.update('target', 1, _at(10), now=_at(10))
+    assert tracker.dropped['target'] == 2
+
+
+def test_tracker_lag_wraps_midnight():
+    tracker = zmqComm.FrameTracker()
+    tracker.update('frame', None, _at(86399.5), now=_at(0.25))
+    assert tracker.lag == pytest.approx(0.75)
+
+
+def test_tracker_mark_dropped_and_reset():
+    tracker = zmqComm.FrameTracker()
+    tracker.update('target', 1, _at(0), now=_at(0))
+    tracker.update('frame_0', 1, _at(0), now=_at(0))
+    tracker.mark_dropped('target', 2)
+    tracker.mark_dropped('target', 0)
+    assert tracker.accounted('target') == 3
+
+    tracker.reset('target')
+    assert tracker.accounted('target') == 0
+    assert tracker.accounted('frame_0') == 1
+    tracker.reset()
+    assert tracker.accounted('frame_0') == 0 and not tracker.last_seq
+
+
+def test_frame_wait_moves_with_progress():
+    wait = zmqComm.FrameWait(0.05)
+    assert not wait.expired(0)
+    time.sleep(0.03)
+    assert not wait.expired(1)
+    time.sleep(0.03)
+    assert not wait.expired(1)
+    time.sleep(0.05)
+    assert wait.expired(1)
+
+
+@pytest.fixture
+def scope():
+    """(Protocol, ReplayPublisher) on fresh localhost ports, both closed afterwards"""
+    opened = []
+
+    def make(frames, **options):
+        frame_port = next(_ports)
+        publisher = replay.ReplayPublisher(frames, frame_port, command_port=frame_port + 1, fps=50)
+        protocol = Protocol({'outputPort': frame_port + 1, 'inputIP': 'tcp://localhost:', 'inputPort': frame_port,
+                             'frame_timeout': 1.0}, **options)
+        opened.append((protocol, publisher))
+        return protocol, publisher
+
+    yield make
+    for protocol, publisher in opened:
+        protocol.comms.close()
+        publisher.stop()
+
+
+def test_run_image_gathering(scope):
+    frames = np.arange(1, 9, dtype=np.int64)[:, None, None] * np.ones((8, 12, 40), dtype=np.int64)
+    protocol, publisher = scope(frames, stack_size=3, n_reps=2)
+    protocol.comms.frames.update('target', 7, _at(0))  # left over from an earlier run
+
+    target, stack, position = protocol.run_image_gathering()
+
+    assert target.shape == (12, 8)
+    assert len(stack) == 3 and all(plane.shape == (12, 8) for plane in stack)
+    assert position == pytest.approx(protocol.z_size * 2)
+    for tag in ('target', 'frame_0', 'frame_1', 'frame_2'):
+        assert protocol.comms.frames.accounted(tag) == 2
+    commands = b' '.join(publisher.received_commands)
+    assert b'run_finite2 zmq: frame_2' in commands and b'move_rel' in commands
+
+
+def test_receiver_survives_undecodable_frames():
+    import zmq
+
+    frame_port = next(_ports)
+    context = zmq.Context()
+    pub = context.socket(zmq.PUB)
+    pub.bind(f'tcp://*:{frame_port}')
+    metrics = instrumentation.Registry(enabled=True)
+    wt = zmqComm.WalkyTalky(frame_port + 1, 'tcp://localhost:', frame_port, preview=False, metrics=metrics)
+    try:
+        time.sleep(0.3)
+        good = np.arange(80).reshape(2, 40).tolist()
+        pub.send(b'frame 1 12:00:00.000000 test: [[1, 2')
+        pub.send(b'frame 2 12:00:00.100000 test: ' + str(good).encode())
+        deadline = time.perf_counter() + 5
+        while wt.frames.received['frame'] < 1 and time.perf_counter() < deadline:
+            time.sleep(0.01)
+        assert wt.msg_receiving_thread.is_alive()
+        assert wt.frames.received['frame'] == 1
+        assert metrics.counter('frames_undecodable_total').value == 1
+    finally:
+        wt.close()
+        pub.close()
+        context.term()
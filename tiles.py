@@ -0,0 +1,281 @@
+"""
+tiled local-z estimation
+
+on a large field of view the sample is rarely flat to the focal plane: one side of the frame
+matches plane 2, the other plane 4, and the full-frame score of every plane flattens out.
+local_z splits target and stack into a grid of tiles, scores every tile's z-curve, and fits
+a plane z = offset + tilt through the tiles' best planes, robust to tiles with nothing in them.
+
+    result = PlaneAlignment(target, stack, 'otsu').local_z(grid=(4, 4))
+    result.z          # (rows, cols) best plane per tile, sub-plane
+    result.tilt       # planes per pixel along rows and cols
+    result.plane      # robust global correction, the plane the fitted surface has at the centre
+    result.frame_scores   # whole-frame score per plane, summed from the tiles and edge strips, no second pass
+
+each plane is binarized once with its full-frame threshold, as the global path does, and
+the tiles are sums over a reshaped view of it, so the cost is one full-frame pass plus a
+reduction. the target's per-tile statistics are kept on the target.Target.
+"""
+
+import logging
+
+import numpy as np
+
+from thePeckingOrder import instrumentation, workers
+from thePeckingOrder.roi import ROI
+from thePeckingOrder.target import Target
+
+
+log = logging.getLogger(__name__)
+
+# metrics local_z can score per tile, from counts (binary) or moments (intensity)
+BINARY = ('dice', 'dice_packed', 'jaccard')
+MOMENTS = ('ncc', 'ssim')
+
+
+def tile_view(image, grid):
+    """(..., rows, h, cols, w) view of image, the edges that don't fill a whole tile dropped"""
+    rows, cols = grid
+    h, w = image.shape[-2] // rows, image.shape[-1] // cols
+    if h == 0 or w == 0:
+        raise ValueError(f'{image.shape[-2:]} frame too small for a {grid} grid')
+    image = image[..., :rows * h, :cols * w]
+    return image.reshape(image.shape[:-2] + (rows, h, cols, w))
+
+
+def _edges(image, grid):
+    """the strips tile_view drops: below the tiled rows (full width) and right of the tiled columns"""
+    rows, cols = grid
+    h, w = image.shape[-2] // rows * rows, image.shape[-1] // cols * cols
+    return image[..., h:, :], image[..., :h, w:]
+
+
+def _tile_sum(tiles):
+    return tiles.sum(axis=(-3, -1))
+
+
+def _target_stats(target, grid, metric, compare, roi):
+    """per-tile target statistics, cached on the Target"""
+    def build():
+        image = target.restricted(roi)
+        if metric in BINARY:
+            binary = compare(image, target.threshold(roi))
+            mask, edges = tile_view(binary, grid), _edges(binary, grid)
+            return {'mask': mask, 'count': np.count_nonzero(mask, axis=(-3, -1)),
+                    'edges': edges, 'edge_count': sum(np.count_nonzero(edge) for edge in edges)}
+        image = image.astype(np.float64)
+        values, edges = tile_view(image, grid), _edges(image, grid)
+        n = values.shape[-3] * values.shape[-1]
+        return {'values': values, 'n': n, 'sum': _tile_sum(values), 'sum2': _tile_sum(values * values),
+                'edges': edges, 'edge_n': sum(edge.size for edge in edges),
+                'edge_sum': sum(edge.sum() for edge in edges), 'edge_sum2': sum((edge * edge).sum() for edge in edges),
+                'range': max(float(image.max() - image.min()), np.finfo(float).eps)}
+    key = ('tiles', tuple(grid), metric in BINARY, compare is np.greater_equal, target._roi_key(roi))
+    return target._cached(key, build)
+
+
+def _tile_sums(target, stack, grid, metric, binarize_method, compare, roi, n_workers):
+    """
+    (Z, k, rows, cols) per-tile sums every score is built from: (plane count, intersection) for
+    binary metrics, (sum, sum of squares, sum of products with the target) for the others,
+    and (Z, k) the same sums over the edge strips the tiles leave out
+    """
+    stats = _target_stats(target, grid, metric, compare, roi)
+    stack = np.asarray(stack)
+    if stack.ndim == 2:
+        stack = stack[None]
+    restrict = roi.pixels if roi is not None else (lambda image: image)
+
+    if metric in BINARY:
+        def sum_plane(n):
+            image = restrict(stack[n])
+            binary = compare(image, binarize_method(image))
+            mask = tile_view(binary, grid)
+            edges = [(np.count_nonzero(edge), np.count_nonzero(edge & t_edge))
+                     for edge, t_edge in zip(_edges(binary, grid), stats['edges'])]
+            return (np.stack([np.count_nonzero(mask, axis=(-3, -1)),
+                              np.count_nonzero(mask & stats['mask'], axis=(-3, -1))]),
+                    np.sum(edges, axis=0))
+    else:
+        def sum_plane(n):
+            image = restrict(stack[n]).astype(np.float64)
+            values = tile_view(image, grid)
+            edges = [(edge.sum(), (edge * edge).sum(), (edge * t_edge).sum())
+                     for edge, t_edge in zip(_edges(image, grid), stats['edges'])]
+            return (np.stack([_tile_sum(values), _tile_sum(values * values), _tile_sum(values * stats['values'])]),
+                    np.sum(edges, axis=0))
+
+    with instrumentation.timer('tile_scores_seconds'):
+        sums, edge_sums = zip(*workers.pool_map(sum_plane, range(len(stack)), n_workers))
+    return np.stack(sums), np.stack(edge_sums)
+
+
+def _scores_from_sums(sums, stats, metric, edge_sums=None):
+    """
+    scores from _tile_sums, per tile or, given the edge_sums, for the whole frame: the tiles and the
+    strips they leave out together, the full-frame score of the same metric
+    """
+    whole_frame = edge_sums is not None
+    if whole_frame:
+        sums = sums.sum(axis=(-2, -1)) + edge_sums
+    if metric in BINARY:
+        count, intersection = sums[:, 0], sums[:, 1]
+        t_count = stats['count'].sum() + stats['edge_count'] if whole_frame else stats['count']
+        if metric == 'jaccard':
+            return intersection / np.maximum(count + t_count - intersection, 1)
+        return 2.0 * intersection / np.maximum(count + t_count, 1)
+
+    if whole_frame:
+        n_px = stats['n'] * stats['sum'].size + stats['edge_n']
+        t_sum, t_sum2 = stats['sum'].sum() + stats['edge_sum'], stats['sum2'].sum() + stats['edge_sum2']
+    else:
+        n_px, t_sum, t_sum2 = stats['n'], stats['sum'], stats['sum2']
+    t_mean = t_sum / n_px
+    t_var = t_sum2 / n_px - t_mean ** 2
+    s_mean = sums[:, 0] / n_px
+    s_var = sums[:, 1] / n_px - s_mean ** 2
+    cov = sums[:, 2] / n_px - s_mean * t_mean
+    if metric == 'ncc':
+        den = np.sqrt(np.maximum(s_var * t_var, 0))
+        return np.divide(cov, den, out=np.zeros_like(cov), where=den > 0)
+    c1 = (0.01 * stats['range']) ** 2
+    c2 = (0.03 * stats['range']) ** 2
+    return (((2 * s_mean * t_mean + c1) * (2 * cov + c2))
+            / ((s_mean ** 2 + t_mean ** 2 + c1) * (s_var + t_var + c2)))
+
+
+def tile_scores(target, stack, grid=(4, 4), metric='dice_packed', binarize_method=None, inclusive=False, roi=None,
+                n_workers=None):
+    """
+    (Z, rows, cols) similarity of every tile of every plane to the same tile of target
+    target: target.Target (its binarization is used for the target mask), stack: (Z, H, W)
+    binarize_method: per-plane threshold for binary metrics, the target's method if None
+    """
+    if metric not in BINARY + MOMENTS:
+        raise ValueError(f'tiled scoring supports {BINARY + MOMENTS}, not {metric!r}')
+    compare = np.greater_equal if inclusive else np.greater
+    sums, _ = _tile_sums(target, stack, grid, metric, binarize_method or target.binarize_method, compare, roi, n_workers)
+    return _scores_from_sums(sums, _target_stats(target, grid, metric, compare, roi), metric)
+
+
+def _refine(scores):
+    """sub-plane peak per tile, a parabola through the best plane and its neighbours"""
+    z = scores.shape[0]
+    best = np.argmax(scores, axis=0)
+    below = np.take_along_axis(scores, np.clip(best - 1, 0, z - 1)[None], 0)[0]
+    peak = np.take_along_axis(scores, best[None], 0)[0]
+    above = np.take_along_axis(scores, np.clip(best + 1, 0, z - 1)[None], 0)[0]
+    curvature = below - 2 * peak + above
+    interior = (best > 0) & (best < z - 1) & (curvature < 0)
+    shift = np.divide(below - above, 2 * curvature, out=np.zeros_like(peak), where=interior)
+    return best + np.clip(shift, -0.5, 0.5)
+
+
+def _robust_plane(centres, z, weights, iterations=5, c=4.685):
+    """
+    weighted least squares z = offset + drow * row + dcol * col, reweighted with tukey's
+    biweight on the residuals so a few tiles locked onto the wrong plane don't tilt it
+    returns (offset, drow, dcol), offset at row = col = 0
+    """
+    design = np.column_stack([np.ones(len(z)), centres])
+    robust = np.ones(len(z))
+    coefficients = np.zeros(3)
+    for _ in range(iterations):
+        if np.count_nonzero(weights * robust) < 3:
+            break
+        w = np.sqrt(weights * robust)
+        coefficients = np.linalg.lstsq(design * w[:, None], z * w, rcond=None)[0]
+        residuals = z - design @ coefficients
+        scale = 1.4826 * np.median(np.abs(residuals[weights > 0])) + 1e-9
+        u = residuals / (c * scale)
+        robust = np.where(np.abs(u) < 1, (1 - u ** 2) ** 2, 0.0)
+    return coefficients
+
+
+class LocalZ:
+    def __init__(self, scores, grid, tile_shape, weights, frame_scores=None):
+        """see local_z"""
+        self.scores = scores
+        # (Z,) score of each whole plane, from the same tile and edge sums
+        self.frame_scores = frame_scores
+        self.grid = tuple(grid)
+        self.tile_shape = tile_shape
+        self.weights = weights
+        self.z = _refine(scores)
+
+        rows, cols = grid
+        h, w = tile_shape
+        # tile centres relative to the centre of the tiled area, in pixels
+        row_c, col_c = np.meshgrid((np.arange(rows) - (rows - 1) / 2) * h, (np.arange(cols) - (cols - 1) / 2) * w,
+                                   indexing='ij')
+        self.centres = np.column_stack([row_c.ravel(), col_c.ravel()])
+
+        usable = weights.ravel() > 0
+        if np.count_nonzero(usable) >= 3:
+            offset, drow, dcol = _robust_plane(self.centres, self.z.ravel(), weights.ravel())
+        else:
+            # not enough tiles to fit a tilt, fall back to the best plane of the whole frame
+            offset, drow, dcol = float(np.argmax(scores.sum(axis=(1, 2)))), 0.0, 0.0
+        self.offset = float(offset)
+        self.tilt = (float(drow), float(dcol))
+
+    @property
+    def surface(self):
+        """(rows, cols) plane the fitted tilt puts each tile on"""
+        return (self.offset + self.centres @ np.array(self.tilt)).reshape(self.grid)
+
+    @property
+    def residuals(self):
+        return self.z - self.surface
+
+    @property
+    def frame_plane(self):
+        """best plane by the whole-frame score (edge strips included), what match_calculator would pick"""
+        return int(np.argmax(self.frame_scores))
+
+    @property
+    def plane(self):
+        """robust global correction, the stack plane the fitted surface crosses the centre at"""
+        return int(np.clip(np.rint(self.offset), 0, self.scores.shape[0] - 1))
+
+    def __repr__(self):
+        return (f'LocalZ(grid={self.grid}, plane={self.plane}, offset={self.offset:.2f}, '
+                f'tilt=({self.tilt[0]:.2e}, {self.tilt[1]:.2e}) planes/px)')
+
+
+def local_z(target, stack, grid=(4, 4), metric='dice_packed', method='otsu', inclusive=False, roi=None,
+            n_workers=None, min_structure=0.02):
+    """
+    tile scores, per-tile best plane and a robust tilt fit, see LocalZ
+    target: array or target.Target, stack: (Z, H, W)
+    roi: roi.ROI, tiles cover its rectangle (a mask inside it is ignored)
+    min_structure: tiles whose target is this empty (foreground fraction for binary metrics,
+        relative variance for the others) get no say in the fit
+    """
+    if not isinstance(target, Target) or target.method != method:
+        target = Target(getattr(target, 'image', target), method)
+    if roi is not None and roi.is_full_frame:
+        roi = None
+    elif roi is not None and roi.mask is not None:
+        roi = ROI((roi.rows.start, roi.rows.stop), (roi.cols.start, roi.cols.stop))
+    if metric not in BINARY + MOMENTS:
+        raise ValueError(f'tiled scoring supports {BINARY + MOMENTS}, not {metric!r}')
+    compare = np.greater_equal if inclusive else np.greater
+    sums, edge_sums = _tile_sums(target, stack, grid, metric, target.binarize_method, compare, roi, n_workers)
+    stats = _target_stats(target, grid, metric, compare, roi)
+    scores = _scores_from_sums(sums, stats, metric)
+    if metric in BINARY:
+        h, w = stats['mask'].shape[-3], stats['mask'].shape[-1]
+        fraction = stats['count'] / (h * w)
+        structure = np.minimum(fraction, 1 - fraction)
+    else:
+        h, w = stats['values'].shape[-3], stats['values'].shape[-1]
+        variance = stats['sum2'] / stats['n'] - (stats['sum'] / stats['n']) ** 2
+        structure = variance / max(float(np.median(variance)), np.finfo(float).eps)
+    # tiles whose curve has a clear peak count more
+    prominence = np.max(scores, axis=0) - np.median(scores, axis=0)
+    weights = np.where(structure >= min_structure, prominence, 0.0)
+
+    result = LocalZ(scores, grid, (h, w), weights, _scores_from_sums(sums, stats, metric, edge_sums))
+    log.debug('%r', result)
+    return result
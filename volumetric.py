@@ -3,38 +3,69 @@ basic volumetric functionality with plane alignment
 """
 
 import argparse
+import contextlib
 import logging
 import time
 
 import threading as tr
 import numpy as np
 
-from thePeckingOrder import planeAlignment, zmqComm
-from datetime import datetime as dt
+from thePeckingOrder import adaptive, driftlog, instrumentation, library, planeAlignment, roi, zmqComm
+from thePeckingOrder.target import Target
+
+log = logging.getLogger(__name__)
 
 
 class Karen:
     """
     she manages all the things
     """
-    def __init__(self, walky_talky, nplanes, alignThreshold):
+    def __init__(self, walky_talky, nplanes, alignThreshold, roi=None, library=None, target_name=None, workers=None,
+                 drift_path=None, method='otsu', metric='dice_packed', adaptive_reps=False, min_reps=2,
+                 rep_tolerance=0.01, tiles=None, scheduler=None, metrics=None):
         """
 
         walkyTalky: should be a walkytalky class object that communicates with the labview scope controls
+        roi: optional roi.ROI, alignment only compares the target and stack inside it
+        library, target_name: optional library.TargetLibrary -- reuse the stored target if it exists,
+            otherwise the acquired target is saved under target_name
+        workers: threads used to score the stack, see PlaneAlignment
+        drift_path: optional file every alignment is appended to, see driftlog.DriftLog
+        method, metric: binarization and similarity used to pick the plane, see PlaneAlignment
+        adaptive_reps, min_reps, rep_tolerance: take between min_reps and alignmentParams['reps'] frames
+            per plane, stopping once the best plane is stable, see adaptive.AdaptiveReps
+        tiles: (rows, cols) grid, pick the plane from a tilt fit through per-tile best planes instead of
+            the full-frame score, see tiles.local_z
+        scheduler: rigs.ComputeScheduler shared with other rigs' Karens, the stack scoring waits for
+            a compute slot so alignments on several rigs don't score at the same time
+        metrics: instrumentation.Registry for this rig's alignment timings, the process-wide one by default
         """
         self.wt = walky_talky
         self.nPlanes = nplanes
         self.alignTimeThresh = alignThreshold
+        self.roi = roi
+        self.library = library
+        self.target_name = target_name
+        self.workers = workers
+        self.method = method
+        self.metric = metric
+        self.tiles = tiles
+        self.drift = driftlog.DriftLog(path=drift_path)
+        self.scheduler = scheduler
+        self.metrics = metrics if metrics is not None else instrumentation.REGISTRY
 
         self.running = True
         self.targetAcquired = False
         self.volumeScanning = False
         self.targetImage = None
+        # target.Target built once per target, its mask and counts are reused by every alignment
+        self.target = None
         self.aligning = False
 
         self.moveOffsets = 0
 
-        self.alignmentParams = {'step': 3, 'reps': 5}
+        self.alignmentParams = {'step': 3, 'reps': 5, 'adaptive': adaptive_reps, 'min_reps': min_reps,
+                                'tolerance': rep_tolerance}
         self.lastAlignedTime = time.time()
         self.alignmentMoveDictionary = {0: -self.alignmentParams['step']*2,
                                         1: -self.alignmentParams['step'],
@@ -51,50 +82,112 @@ class Karen:
         self.mainLoopThread = tr.Thread(target=self.mainLoop)
         self.mainLoopThread.start()
 
+    def stop(self, timeout=10):
+        """stops the loops and the comms, an alignment in progress abandons its stack"""
+        self.running = False
+        # gather_stack and _acquire_plane wait on the comms, not on self.running
+        self.wt.running = False
+        for thread in (self.acquireTargetThread, self.mainLoopThread):
+            thread.join(timeout)
+        self.drift.close()
+
     def resetToTarget(self):
         # stop the acquisition & move to target
-        self.wt.pub.socket.send(b"RESET")
+        self.wt.send(b"RESET")
         time.sleep(1)
-        self.wt.pub.socket.send(b"s4 p2")
-        self.wt.pub.socket.send(b"RUN")
+        self.wt.send(b"s4 p2")
+        self.wt.send(b"RUN")
+        # moved to the target plane, don't score motion against frames from before
+        self.wt.quality.reset()
         time.sleep(1)
-        self.wt.pub.socket.send(b"RESET")
+        self.wt.send(b"RESET")
         time.sleep(1)
         # start continuous acquisition
-        self.wt.pub.socket.send(b"s1 s3")
-        self.wt.pub.socket.send(b"RUN")
+        self.wt.send(b"s1 s3")
+        self.wt.send(b"RUN")
         time.sleep(1)
-        self.wt.pub.socket.send(b"RESET")
+        self.wt.send(b"RESET")
 
     def acquireTarget(self):
+        if self.library is not None and self.target_name in self.library:
+            entry = self.library.load(self.target_name)
+            self.targetImage = entry.image
+            self.target = Target.from_entry(entry) if entry.method == self.method else Target(entry.image, self.method)
+            self.targetAcquired = True
+            log.info('target plane %s loaded from library', self.target_name)
+            return
+
         self.wt.make_current()
-        logging.info(f'{dt.now()} acquiring target plane')
-        while len(self.wt.images) <= 15:
+        log.info('acquiring target plane')
+        while self.running and len(self.wt.images) <= 15:
             pass
+        if not self.running:
+            return
+        self.targetImage = self.wt.median_image()
+        self.target = Target(self.targetImage, self.method)
         self.targetAcquired = True
-        self.targetImage = np.median(self.wt.images, axis=0)
-        logging.info(f'{dt.now()} target plane acquired')
+        log.info('target plane acquired')
+
+        if self.library is not None and self.target_name is not None:
+            self.library.save(self.target_name, self.targetImage)
         return
 
     def startVolumeScanning(self):
-        logging.info(f'{dt.now()} began volume scanning')
-        self.wt.pub.socket.send(f's4 s2 p0 "1000 (p1 "20 (s3 s5? p3 "20){self.nPlanes})5000'.encode()) # n planes and arb high number for reps
-        self.wt.pub.socket.send(b"RUN")
+        log.info('began volume scanning')
+        self.wt.send(f's4 s2 p0 "1000 (p1 "20 (s3 s5? p3 "20){self.nPlanes})5000'.encode()) # n planes and arb high number for reps
+        self.wt.send(b"RUN")
         self.volumeScanning = True
 
     def runAlignment(self):
         self.aligning = True
         self.volumeScanning = False
-        logging.info(f'{dt.now()} beginning alignment...')
-        self.resetToTarget()
-        compStack = self.wt.gather_stack(spacing=self.alignmentParams['step'], reps=self.alignmentParams['reps'])
-        pa = planeAlignment.PlaneAlignment(target=self.targetImage, stack=compStack, method='otsu')
-        myMatch = pa.match_calculator()
-        moveAmount = self.alignmentMoveDictionary[myMatch]
-        if moveAmount != 0:
-            self.wt.move_piezo_n(moveAmount)
-
-        logging.info(f'{dt.now()} alignment: status: completed with {moveAmount} movement')
+        log.info('beginning alignment...')
+        alignStart = time.time()
+        with self.metrics.timer('alignment_total_seconds'):
+            with self.metrics.timer('alignment_reset_seconds'):
+                self.resetToTarget()
+            pa = planeAlignment.PlaneAlignment(target=self.target, stack=None, method=self.method,
+                                               metric=self.metric, roi=self.roi, workers=self.workers)
+            repControl = None
+            if self.alignmentParams['adaptive']:
+                repControl = adaptive.AdaptiveReps.for_alignment(pa, self.target, min_reps=self.alignmentParams['min_reps'],
+                                                           max_reps=self.alignmentParams['reps'],
+                                                           tolerance=self.alignmentParams['tolerance'])
+            with self.metrics.timer('alignment_gather_seconds'):
+                try:
+                    compStack = self.wt.gather_stack(spacing=self.alignmentParams['step'], reps=self.alignmentParams['reps'],
+                                                     return_home=False, adaptive=repControl)
+                except RuntimeError:
+                    # a plane got no frames at all, go back to the target and try again next align_t
+                    log.exception('alignment: status: failed, stack abandoned')
+                    self.wt.finish_stack(0)
+                    self.lastAlignedTime = time.time()
+                    self.aligning = False
+                    return
+            if not self.running:
+                # stopped mid-stack, leave the piezo where it is
+                self.aligning = False
+                return
+            if repControl is not None:
+                repControl.log_report()
+            compute = self.scheduler.slot(self.metrics) if self.scheduler is not None else contextlib.nullcontext()
+            with compute, self.metrics.timer('alignment_match_seconds'):
+                pa.image_stack = compStack
+                if self.tiles:
+                    # one pass: pa.match_vals (logged below) are the full-frame scores from the tile sums
+                    local = pa.local_z(self.tiles)
+                    log.info('local z: %r, full frame picked plane %d', local, local.frame_plane)
+                    myMatch = local.plane
+                else:
+                    myMatch = pa.match_calculator()
+            moveAmount = self.alignmentMoveDictionary[myMatch]
+            with self.metrics.timer('alignment_move_seconds'):
+                # return move and correction in one go
+                self.wt.finish_stack(moveAmount)
+        self.metrics.inc('alignments_total')
+        self.drift.log_alignment(pa.match_vals, myMatch, moveAmount, time.time() - alignStart)
+
+        log.info('alignment: status: completed with %s movement', moveAmount)
         self.lastAlignedTime = time.time()
         self.aligning = False
 
@@ -112,12 +205,33 @@ class Karen:
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--nplanes', type=float, required=True)
+    parser.add_argument('--nplanes', type=int, required=True)
     parser.add_argument('--align_t', type=int, default=450)
+    parser.add_argument('--roi', type=int, nargs=4, default=None, metavar=('ROW0', 'ROW1', 'COL0', 'COL1'),
+                        help='align only inside this rectangle of the (cropped) frame')
+    parser.add_argument('--library', default=None, help='target library folder')
+    parser.add_argument('--target', default=None, help='target name in the library, loaded if present else saved')
+    parser.add_argument('--workers', default=None, help="threads for stack scoring, an int or 'auto'")
+    parser.add_argument('--drift_log', default=None, help='file to append alignment history to')
+    parser.add_argument('--adaptive_reps', action='store_true',
+                        help='stop acquiring a plane once the best plane is stable instead of always taking all reps')
+    parser.add_argument('--tiles', type=int, nargs=2, default=None, metavar=('ROWS', 'COLS'),
+                        help='pick the plane from a tilt fit over a grid of tiles')
+    parser.add_argument('--metrics_port', type=int, default=None, help='serve prometheus-style metrics on this port')
 
     args = parser.parse_args()
 
-    myWalky = zmqComm.WalkyTalky(outputPort='5005', inputIP='tcp://10.122.170.21:', inputPort=4701)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    if args.metrics_port is not None:
+        instrumentation.enable()
+        instrumentation.serve_prometheus(args.metrics_port)
+
+    myWalky = zmqComm.WalkyTalky(outputPort='5005', inputIP='tcp://10.122.170.21:', inputPort=4701, preview=False)
 
     # she doesnt have a start method and doesnt play nice with others, once you start her shes goes going
-    Karen(walky_talky=myWalky, nplanes=args.nplanes, alignThreshold=args.align_t)
+    alignROI = roi.ROI(args.roi[:2], args.roi[2:]) if args.roi else None
+    targetLibrary = library.TargetLibrary(args.library) if args.library else None
+    Karen(walky_talky=myWalky, nplanes=args.nplanes, alignThreshold=args.align_t, roi=alignROI,
+          library=targetLibrary, target_name=args.target, workers=args.workers,
+          drift_path=args.drift_log, adaptive_reps=args.adaptive_reps, tiles=args.tiles)
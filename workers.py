@@ -0,0 +1,48 @@
+"""
+shared thread pools for analysis work
+
+numpy drops the GIL for histogramming, compares and sums, so per-plane work scales
+across threads. pools are created once per size and reused for every alignment.
+"""
+
+import atexit
+import os
+import threading as tr
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+_pools = {}
+_lock = tr.Lock()
+
+
+def resolve(workers):
+    """None/0/1 -> 1 (serial), 'auto' -> one per core, ints as given"""
+    if workers == 'auto':
+        return os.cpu_count() or 1
+    return max(int(workers or 1), 1)
+
+
+def get_pool(workers):
+    workers = resolve(workers)
+    with _lock:
+        if workers not in _pools:
+            _pools[workers] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'pecking{workers}')
+        return _pools[workers]
+
+
+def pool_map(fxn, items, workers=None):
+    """list(map(fxn, items)), on the shared pool when workers > 1"""
+    if resolve(workers) <= 1:
+        return [fxn(item) for item in items]
+    return list(get_pool(workers).map(fxn, items))
+
+
+def shutdown():
+    with _lock:
+        for pool in _pools.values():
+            pool.shutdown(wait=False)
+        _pools.clear()
+
+
+atexit.register(shutdown)
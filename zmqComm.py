@@ -1,4 +1,5 @@
 import zmq
+import collections
 import logging
 import json
 import time
@@ -9,51 +10,326 @@ import numpy as np
 
 from datetime import datetime as dt
 
+from thePeckingOrder import dispatch, frames, instrumentation, quality, scratch
+from thePeckingOrder.planner import MovePlanner
+from thePeckingOrder.roi import LABVIEW_CROP
 
-logging.basicConfig(level=logging.DEBUG)  # NOTSET, DEBUG, INFO, WARNING
+
+log = logging.getLogger(__name__)
+
+# SUB socket queueing, see Subscriber
+#   bounded:  at most hwm frames queued, newer frames are dropped past that (gaps show up in FrameTracker), the default
+#   lossless: no receive limit, a consumer that falls behind grows the queue without bound (memory),
+#             and labview's PUB side still drops past its own SNDHWM, so it isn't lossless end to end
+#   latest:   CONFLATE, only the newest frame is kept, for live views
+SUB_POLICIES = {'lossless': dict(hwm=0, conflate=False),
+                'bounded': dict(hwm=1000, conflate=False),
+                'latest': dict(hwm=1, conflate=True)}
+
+
+def parse_header(header):
+    """
+    (tag, seq, timestamp) from a frame header b'tag seq HH:MM:SS.ffffff ...'
+    seq is None when the second field isn't a frame number
+    """
+    fields = header.split(b' ')
+    tag = fields[0].decode(errors='replace')
+    seq = int(fields[1]) if len(fields) > 1 and fields[1].isdigit() else None
+    dateString = str(header).split(' ')[2]
+    timestamp = dt.strptime(dateString, "%H:%M:%S.%f").time()
+    return tag, seq, timestamp
+
+
+def decode_frame(data, crop=LABVIEW_CROP, decoder=None):
+    """
+    (tag, seq, timestamp, image) from one raw b'tag seq time ...: payload' message
+    decoder: frames.FrameDecoder for json or binary (compressed/delta) payloads, frames.ArrayDecoder
+        for json only, json.loads when None
+    image is None for a delta frame the decoder has no reference frame for
+    """
+    header, payload = data.split(b': ', 1)
+    tag, seq, timestamp = parse_header(header.strip())
+    # assuming the following message structure: 'tag: message'
+    if decoder is None:
+        array = crop.apply(np.array(json.loads(payload)))
+    elif isinstance(decoder, frames.FrameDecoder):
+        # binary payloads can start or end on whitespace bytes, leave them alone
+        array = decoder(payload, crop, tag)
+    else:
+        array = decoder(payload.strip(), crop)
+    return tag, seq, timestamp, array
+
+
+class FrameTracker:
+    """
+    per-tag frame accounting for one SUB stream: frames received, frames known to be dropped
+    (gaps in the sequence numbers) and how far behind the sender the consumer is
+    metrics: instrumentation.Registry the drops and lag go to, the process-wide one by default
+    """
+    def __init__(self, metrics=None):
+        self.metrics = metrics if metrics is not None else instrumentation.REGISTRY
+        self.received = collections.Counter()
+        self.dropped = collections.Counter()
+        self.last_seq = {}
+        self.lag = 0.0
+        self._lock = tr.Lock()
+
+    def update(self, tag, seq, timestamp, now=None):
+        with self._lock:
+            self.received[tag] += 1
+            if seq is not None:
+                last = self.last_seq.get(tag)
+                # a lower number is a restarted acquisition, not a gap
+                if last is not None and seq > last + 1:
+                    missed = seq - last - 1
+                    self.dropped[tag] += missed
+                    self.metrics.inc('frames_dropped_total', missed)
+                    log.warning('%d %s frame(s) dropped between #%d and #%d', missed, tag, last, seq)
+                self.last_seq[tag] = seq
+
+        # time of day on both ends, wrapped around midnight
+        now = now or dt.now().time()
+        seconds = lambda t: t.hour * 3600 + t.minute * 60 + t.second + t.microsecond * 1e-6
+        self.lag = (seconds(now) - seconds(timestamp)) % 86400
+        self.metrics.observe('frame_lag_seconds', self.lag)
+
+    def accounted(self, tag):
+        """frames of tag that arrived or are known lost, what a fixed-count acquisition should wait on"""
+        with self._lock:
+            return self.received[tag] + self.dropped[tag]
+
+    def mark_dropped(self, tag, n):
+        """n frames of tag given up on, the tail of an acquisition that stopped arriving"""
+        if n <= 0:
+            return
+        with self._lock:
+            self.dropped[tag] += n
+        self.metrics.inc('frames_dropped_total', n)
+        log.warning('%d %s frame(s) never arrived', n, tag)
+
+    def reset(self, tag=None):
+        with self._lock:
+            for counts in (self.received, self.dropped, self.last_seq):
+                if tag is None:
+                    counts.clear()
+                else:
+                    counts.pop(tag, None)
+
+
+class FrameWait:
+    """
+    deadline for a wait on frames that may never come (a dropped tail, a sender that went away)
+    it moves out whenever progress changes, so a slow but live stream is waited for as long as
+    it takes and a stalled one is given up on `timeout` seconds after its last frame
+    """
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.progress = None
+        self.since = time.perf_counter()
+
+    def expired(self, progress):
+        now = time.perf_counter()
+        if progress != self.progress:
+            self.progress, self.since = progress, now
+            return False
+        return now - self.since > self.timeout
+
+
+class PreviewStream:
+    """
+    display-side view of the acquisition stream: msg_receiver hands it every frame it decodes and
+    it only keeps the newest, so the display never opens a connection or decodes anything of its
+    own, and frames nobody looks at cost a reference swap
+    """
+    def __init__(self, step=2):
+        """step: default downsampling of latest(), every step-th row and column"""
+        self.step = step
+        # frames published so far, bumps whenever a newer frame is available
+        self.seq = 0
+        self._image = None
+
+    def publish(self, image):
+        """called by msg_receiver with each decoded frame"""
+        self._image, self.seq = image, self.seq + 1
+
+    def latest(self, step=None):
+        """newest frame downsampled by step (default self.step), IndexError before the first one"""
+        image = self._image
+        if image is None:
+            raise IndexError('no preview frame yet')
+        step = self.step if step is None else step
+        return image[::step, ::step]
+
+    def stop(self):
+        self._image = None
 
 
 class WalkyTalky:
-    def __init__(self, outputPort, inputIP, inputPort):
-        self.sub = Subscriber(port=inputPort, ip=inputIP)
-        self.pub = Publisher(port=outputPort)
+    def __init__(self, outputPort, inputIP, inputPort, crop=LABVIEW_CROP, planner=None, policy='bounded',
+                 preview=True, preview_step=2, hwm=None, encoding=None, quality_policy='off', context=None,
+                 metrics=None, frame_timeout=3.0, saturation_value=None):
+        """
+        one SUB connection to labview, every frame decoded once, feeding two consumers:
+        acquisition (self.images) is ordered and keeps every frame, gather_stack and targets use it
+        preview (self.preview) only holds the newest frame, for live displays, see latest_frame
+
+        crop: roi.ROI rectangle applied to every received frame as a view (no copy)
+        planner: planner.MovePlanner deciding the order gather_stack visits planes in
+        policy: acquisition SUB socket queueing, one of SUB_POLICIES
+        hwm: overrides the policy's receive high-water mark
+        preview: keep the newest frame for display, without it latest_frame falls back to self.images
+        preview_step: preview downsampling
+        encoding: frame encoding to ask labview for, one of frames.encodings(), e.g. 'delta+zlib'
+            on a busy link. None leaves labview on json. whatever arrives is decoded either way,
+            self.encoding says what that was
+        quality_policy: quality.POLICIES entry deciding which frames medians and stacks skip,
+            every frame's quality.FrameStats is kept in self.stats either way
+        context: zmq.Context to open the sockets on, shared between the rigs of one process (see
+            rigs.RigController), a context of its own when None
+        metrics: instrumentation.Registry the frame counters and timings go to, one per rig when a
+            process drives several, the process-wide registry by default
+        frame_timeout: seconds without a new frame before a finite acquisition stops waiting for the
+            rest of its reps and counts them dropped, many frame periods and well over the 200 ms
+            receive timeout, see FrameWait
+        saturation_value: the sensor's full-scale count (e.g. 4095 for 12 bit), what quality counts as
+            saturated. json frames decode to int64, which says nothing about the sensor, so without it
+            their saturation check is off
+        """
+        self.metrics = metrics if metrics is not None else instrumentation.REGISTRY
+        self.sub = Subscriber(port=inputPort, ip=inputIP, policy=policy, hwm=hwm, context=context)
+        # wake up now and then to notice close()
+        self.sub.socket.setsockopt(zmq.RCVTIMEO, 200)
+        self.pub = Publisher(port=outputPort, context=context)
+        # owns self.pub.socket from here on, send commands through self.send
+        self.commands = dispatch.CommandDispatcher(self.pub, metrics=self.metrics)
+        self.crop = crop
+        # payload -> cropped ndarray, json without building python ints or binary frames, owned by msg_receiver
+        self.decoder = frames.FrameDecoder()
+        self.planner = planner or MovePlanner()
+        # piezo offset from the target plane, in steps, while a stack is being gathered
+        self.stack_position = 0
+        self.frame_timeout = frame_timeout
 
         self.running = True
 
         self.images = []
         self.timestamps = []
+        self.tags = []
+        # quality.FrameStats per frame, alongside images
+        self.stats = []
+        self.quality = quality.FrameQuality(quality_policy, saturation_value=saturation_value)
+        # received/dropped counts per tag and consumer lag
+        self.frames = FrameTracker(self.metrics)
+        self.preview = PreviewStream(preview_step) if preview else None
+
+        # labview may not be listening yet, msg_receiver repeats the request until frames switch over
+        assert(encoding is None or encoding in frames.encodings()), f'encoding must be one of {frames.encodings()}'
+        self.requested_encoding = encoding
+        self._encoding_requests = []
 
         self.msg_receiving_thread = tr.Thread(target=self.msg_receiver)
         self.msg_receiving_thread.start()
 
-    def kill(self):
+    def send(self, msg, priority=dispatch.ROUTINE):
+        """queues a labview command, safe from any thread"""
+        return self.commands.send(msg, priority)
+
+    def emergency_reset(self):
+        return self.commands.emergency_reset()
+
+    def request_encoding(self, encoding):
+        """asks the sender to switch frame encoding, senders that don't know the command keep sending json"""
+        assert(encoding in frames.encodings()), f'encoding must be one of {frames.encodings()}'
+        self.requested_encoding = encoding
+        self._encoding_requests = []
+        self._negotiate_encoding()
+
+    def _negotiate_encoding(self, attempts=5, interval=1.0):
+        requested, sent = self.requested_encoding, self._encoding_requests
+        if requested is None or self.encoding == requested or len(sent) > attempts:
+            return
+        now = time.perf_counter()
+        if sent and now - sent[-1] < interval:
+            return
+        if len(sent) == attempts:
+            log.info('sender stays on %s frames, %s not supported', self.encoding, requested)
+        else:
+            self.send(f'encoding: {requested}'.encode())
+        sent.append(now)
+
+    @property
+    def encoding(self):
+        """encoding of the last frame received, None before the first one"""
+        return self.decoder.last_encoding
+
+    def close(self):
+        """stops the receiver threads and sends whatever commands are still queued"""
         self.running = False
-        try:
-            self.msg_receiving_thread.terminate()
-        except:
-            pass
+        self.commands.stop()
+        if self.preview is not None:
+            self.preview.stop()
+        self.msg_receiving_thread.join()
+        self.sub.kill()
+        self.pub.kill()
 
-        try:
-            self.msg_receiving_thread.join()
-        except:
-            pass
+    def kill(self):
+        self.close()
         print('wt killed')
         sys.exit()
 
     def msg_receiver(self):
         while self.running:
-            data = self.sub.socket.recv()
-            msg_parts = [part.strip() for part in data.split(b': ', 1)]
-            # tag = msg_parts[0].split(b' ')[0]
-            dateString = str(msg_parts[0]).split(' ')[2]
-            timestamp = dt.strptime(dateString, "%H:%M:%S.%f").time()
-            array = np.array(json.loads(msg_parts[1]))[:,
-                    32:]  # assuming the following message structure: 'tag: message'
+            try:
+                data = self.sub.socket.recv()
+            except zmq.Again:
+                continue
+            self.metrics.inc('frames_received_total')
+            try:
+                with self.metrics.timer('frame_decode_seconds'):
+                    tag, seq, timestamp, array = decode_frame(data, self.crop, self.decoder)
+            except Exception as e:
+                # an unknown codec or a corrupt payload costs the frame, not the receiver
+                self.metrics.inc('frames_undecodable_total')
+                log.warning('dropping undecodable frame (%d bytes): %r', len(data), e)
+                continue
+            self._negotiate_encoding()
+            if array is None:
+                # delta frame after joining mid-stream, the gap shows up as dropped on the next frame
+                self.metrics.inc('frames_undecodable_total')
+                continue
+            if self.preview is not None:
+                self.preview.publish(array)
+            self.frames.update(tag, seq, timestamp)
+            stats = self.quality.assess(array, tag)
+            if stats.rejected:
+                self.metrics.inc('frames_rejected_total')
+                log.debug('%s frame #%s rejected: %s', tag, seq, stats.rejected)
 
             # logging.info(f'{dt.now()} received data')
 
             self.images.append(array)
+            self.stats.append(stats)
             self.timestamps.append(timestamp)
+            self.tags.append(tag)
+            self.metrics.set('frame_queue_depth', len(self.images))
+
+    def latest_frame(self, step=None):
+        """newest frame for display, IndexError before the first one"""
+        if self.preview is not None:
+            return self.preview.latest(step)
+        step = step or 1
+        return self.images[-1][::step, ::step]
+
+    @property
+    def latest_stats(self):
+        """quality.FrameStats of the newest acquired frame, None before the first one"""
+        stats = self.stats
+        return stats[-1] if stats else None
+
+    @property
+    def latest_seq(self):
+        """changes whenever latest_frame has something new"""
+        return self.preview.seq if self.preview is not None else len(self.images)
 
     def make_current(self):
         relTimer = dt.now().time()
@@ -64,6 +340,8 @@ class WalkyTalky:
         if self.timestamps[-1] < t:
             self.timestamps = []
             self.images = []
+            self.stats = []
+            self.tags = []
             return
 
         for n, time in enumerate(self.timestamps):
@@ -73,130 +351,198 @@ class WalkyTalky:
                 break
         self.timestamps = self.timestamps[n:]
         self.images = self.images[n:]
+        self.stats = self.stats[n:]
+        self.tags = self.tags[n:]
+
+    def frames_tagged(self, tag, include_rejected=False):
+        """buffered frames carrying tag, in arrival order, without the ones self.quality rejected"""
+        images, tags, stats = self.images, self.tags, self.stats
+        return [image for image, t, s in zip(images, tags, stats) if t == tag and (include_rejected or not s.rejected)]
+
+    def accepted_images(self):
+        """buffered frames self.quality didn't reject"""
+        return quality.accepted(self.images, self.stats)
 
     def move_piezo_n(self, n):
+        # a new plane, don't compare its frames against the old one's
+        self.quality.reset()
         # move n down
         if n > 0:
-            self.pub.socket.send(f'(pplus){n * 2}'.encode())
+            self.send(f'(pplus){n * 2}'.encode())
         else:
-            self.pub.socket.send(f'(pminus){abs(n) * 2}'.encode())
+            self.send(f'(pminus){abs(n) * 2}'.encode())
 
         time.sleep(0.2)
-        self.pub.socket.send(b"RUN")
-        time.sleep(1)
-        self.pub.socket.send(b"RESET")
-
-    def gather_stack(self, spacing, reps):
-        # hard coded atm for a 5-stack, 5um steps. reps flexible
-        # stop scanning
-        self.pub.socket.send(b"s4")
-        self.pub.socket.send(b"RUN")
-
-        time.sleep(1)
-        self.pub.socket.send(b"RESET")
+        self.send(b"RUN")
         time.sleep(1)
+        self.send(b"RESET")
+
+    def median_image(self):
+        """median of the buffered frames, leaving out rejected ones unless that leaves nothing"""
+        images = self.accepted_images()
+        if not images:
+            log.warning('all %d frames rejected, taking the median of them anyway', len(self.images))
+            images = self.images
+        with self.metrics.timer('median_seconds'):
+            return scratch.median(images)
+
+    def _give_up(self, reps):
+        """counts the reps that never arrived as dropped, under the tag the plane's frames came in with"""
+        received = len(self.timestamps)
+        tags = self.tags
+        self.frames.mark_dropped(tags[-1] if tags else 'unknown', reps - received)
+        if not received:
+            raise RuntimeError(f'no frames arrived within {self.frame_timeout}s')
+
+    def _acquire_plane(self, command, reps, adaptive=None, plane=0):
+        """
+        runs a finite acquisition and returns the median of its reps
+        with adaptive (adaptive.AdaptiveReps) frames are fed to it as they arrive and the
+        acquisition is cut short once it has enough for this plane
+        reps that don't arrive within frame_timeout count as dropped and the median is over the
+        frames that did, RuntimeError when there were none
+        """
+        wait = FrameWait(self.frame_timeout)
+        if adaptive is None:
+            self.send(command)
+            self.send(b"RUN")
+            while self.running and len(self.timestamps) <= reps - 1:
+                if wait.expired(len(self.timestamps)):
+                    self._give_up(reps)
+                    break
+                time.sleep(0.001)
+            if not self.running:
+                return None
+            image = self.median_image()
+            self.make_current()
+            return image
 
-        # clear stack
+        # frames still in flight from the last plane's cut-short acquisition
         try:
             self.make_current()
         except IndexError:
-            pass # here if already empty
-
-        # get target plane
-        self.pub.socket.send(f'p0 s2 "500 (s3 s5? "20){reps} p1'.encode())
-        self.pub.socket.send(b"RUN")
-
-        while len(self.timestamps) <= reps - 1:
             pass
-
-        target = np.median(self.images, axis=0)
+        adaptive.start_plane(plane)
+        self.send(command)
+        self.send(b"RUN")
+        seen = 0
+        done = False
+        while self.running and not done:
+            images, stats = self.images, self.stats
+            while not done and seen < min(len(images), len(stats)):
+                if not stats[seen].rejected:
+                    done = adaptive.add(images[seen])
+                seen += 1
+            if not done and wait.expired(len(images)):
+                # finish_plane below makes do with what arrived, or raises if nothing was usable
+                self._give_up(reps)
+                break
+            time.sleep(0.001)
+        if len(self.images) < reps:
+            # stop the rest of the finite run
+            self.send(b"RESET")
+        if not self.running:
+            # closing, the stack is abandoned
+            return None
+        image = adaptive.finish_plane()
         self.make_current()
+        return image
 
-        stackAbove = []
-
-        # GET ONE ABOVE
-        self.pub.socket.send(b"RESET")
-        time.sleep(1)
-        self.move_piezo_n(spacing)
-        time.sleep(1)
-        self.pub.socket.send(f'(s3 s5? "20){reps}'.encode())
-        self.pub.socket.send(b"RUN")
-        while len(self.timestamps) <= reps - 1:
-            pass
-        someImage = np.median(self.images, axis=0)
-        stackAbove.append(someImage)
-        self.make_current()
+    def gather_stack(self, spacing, reps, n_planes=5, return_home=True, adaptive=None):
+        """
+        acquires n_planes planes spaced `spacing` steps apart around the current (target) plane
+        returns them ordered from lowest to highest offset, target in the middle
 
-        # GET SECOND ABOVE
-        self.pub.socket.send(b"RESET")
-        time.sleep(1)
-        self.move_piezo_n(spacing)
-        time.sleep(1)
-        self.pub.socket.send(f'(s3 s5? "20){reps}'.encode())
-        self.pub.socket.send(b"RUN")
-        while len(self.timestamps) <= reps - 1:
-            pass
-        someImage = np.median(self.images, axis=0)
-        stackAbove.append(someImage)
-        self.make_current()
+        the visiting order comes from self.planner. with return_home=False the piezo is left
+        on the last plane and the caller finishes with finish_stack(correction), folding the
+        alignment correction into the move back
 
-        # GET FIRST BELOW
-        stackBelow = []
-        self.pub.socket.send(b"RESET")
+        adaptive: adaptive.AdaptiveReps, takes up to reps frames per plane, fewer once the best
+            plane is clear. see its report() for the frames taken
+        """
+        # stop scanning
+        self.send(b"s4")
+        self.send(b"RUN")
 
         time.sleep(1)
-        self.move_piezo_n(-spacing*3)
+        self.send(b"RESET")
         time.sleep(1)
 
-        self.pub.socket.send(f'(s3 s5? "20){reps}'.encode())
-        self.pub.socket.send(b"RUN")
-        while len(self.timestamps) <= reps - 1:
-            pass
-        someImage = np.median(self.images, axis=0)
-        stackBelow.append(someImage)
-        self.make_current()
-        # GET SECOND BELOW
-        self.pub.socket.send(b"RESET")
-        time.sleep(1)
-        self.move_piezo_n(-spacing)
-        time.sleep(1)
-        self.pub.socket.send(f'(s3 s5? "20){reps}'.encode())
-        self.pub.socket.send(b"RUN")
-        while len(self.timestamps) <= reps - 1:
-            pass
-        someImage = np.median(self.images, axis=0)
-        stackBelow.append(someImage)
-        self.make_current()
+        # clear stack
+        try:
+            self.make_current()
+        except IndexError:
+            pass # here if already empty
 
+        plan = self.planner.plan(self.planner.stack_offsets(n_planes))
+        planes = {}
+        if adaptive is not None:
+            adaptive.start_stack()
+
+        # get target plane, we are sitting on it
+        planes[0] = self._acquire_plane(f'p0 s2 "500 (s3 s5? "20){reps} p1', reps, adaptive, 0)
+        position = 0
+
+        for plane in plan.order[1:]:
+            self.send(b"RESET")
+            time.sleep(1)
+            self.move_piezo_n((plane - position) * spacing)
+            position = plane
+            time.sleep(1)
+            planes[plane] = self._acquire_plane(f'(s3 s5? "20){reps}', reps, adaptive, plane)
+
+        self.stack_position = position * spacing
+        if return_home:
+            self.finish_stack(0)
+
+        return [planes[plane] for plane in sorted(planes)]
+
+    def finish_stack(self, correction=0):
+        """
+        one move from where gather_stack left the piezo to target + correction, then resume scanning
+        replaces the old return-home move followed by a separate correction move
+        """
         time.sleep(1)
 
-        self.pub.socket.send(b"RESET")
+        self.send(b"RESET")
         time.sleep(1)
 
-        offsetBack = spacing*2*2
-        self.pub.socket.send(f"(pplus){offsetBack} s1 s3".encode())
-        self.pub.socket.send(b"RUN")
+        net = correction - self.stack_position
+        move = dispatch.format_move('labview', net * 2).decode() + ' ' if net != 0 else ''
+        self.send(f"{move}s1 s3")
+        self.send(b"RUN")
+        self.stack_position = 0
+        # back on the target plane, the last stack plane's frames are no motion reference
+        self.quality.reset()
 
         time.sleep(1)
-        self.pub.socket.send(b"RESET")
+        self.send(b"RESET")
         time.sleep(1)
 
-        finalStack = [stackBelow[-1], stackBelow[0], target, stackAbove[0], stackAbove[-1]]
-        return finalStack
-
 
 # pstim pub/subs
 class Subscriber:
     """
     Subscriber wrapper class for zmq.
     Default topic is every topic ("").
+    policy picks the receive queueing (SUB_POLICIES), hwm overrides its high-water mark
+    context: a shared zmq.Context to use instead of one of its own, kill() leaves it running
     """
-    def __init__(self, port="1234", topic="", ip=None):
+    def __init__(self, port="1234", topic="", ip=None, policy='bounded', hwm=None, context=None):
+        assert(policy in SUB_POLICIES.keys()), f'policy must be one of {SUB_POLICIES.keys()}'
         self.port = port
         self.topic = topic
-        self.context = zmq.Context()
+        self.policy = policy
+        self._owns_context = context is None
+        self.context = zmq.Context() if context is None else context
         self.socket = self.context.socket(zmq.SUB)
 
+        # options only apply to connections made after they are set
+        options = SUB_POLICIES[policy]
+        self.socket.setsockopt(zmq.RCVHWM, options['hwm'] if hwm is None else hwm)
+        if options['conflate']:
+            self.socket.setsockopt(zmq.CONFLATE, 1)
+
         if ip is None:
             ip = 'tcp://localhost:'
         if not isinstance(ip, str):
@@ -205,24 +551,28 @@ class Subscriber:
         self.socket.connect(ip + str(self.port))
 
         self.socket.subscribe(self.topic)
-        logging.info(f"{dt.now()} Subscriber initialized on {ip + str(self.port)}")
+        log.info("Subscriber initialized on %s (%s)", ip + str(self.port), policy)
 
     def kill(self):
         self.socket.close()
-        self.context.term()
+        if self._owns_context:
+            self.context.term()
 
 
 class Publisher:
     """
     Publisher wrapper class for zmq.
+    context: as for Subscriber
     """
-    def __init__(self, port="1234"):
+    def __init__(self, port="1234", context=None):
         self.port = port
-        self.context = zmq.Context()
+        self._owns_context = context is None
+        self.context = zmq.Context() if context is None else context
         self.socket = self.context.socket(zmq.PUB)
         self.socket.bind("tcp://*:" + str(self.port))
-        logging.info(f"{dt.now()} Publisher initialized on {'tcp://localhost:' + str(self.port)}")
+        log.info("Publisher initialized on tcp://localhost:%s", self.port)
 
     def kill(self):
         self.socket.close()
-        self.context.term()
+        if self._owns_context:
+            self.context.term()